@@ -8,42 +8,92 @@ import cv2
 import mediapipe as mp
 import numpy as np
 import os
+import io
+import sys
+import argparse
 import pickle
+import hashlib
+import copy
+import shutil
+import tempfile
+import json
+import random
 import pandas as pd
 import time
 import threading
+import queue
 import joblib
 import tkinter as tk
 import openpyxl
 from openpyxl import load_workbook
 from openpyxl.utils import get_column_letter
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Alignment, Border, Font, Side
 from tkinter import ttk
 from tkinter import messagebox
 from datetime import datetime, timedelta
 from sklearn.svm import SVC
 from sklearn.preprocessing import StandardScaler
 from sklearn.decomposition import PCA
+from sklearn.model_selection import StratifiedKFold, LeaveOneOut, cross_val_predict
+from sklearn.linear_model import LogisticRegression
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import product
 from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Image, Spacer
 from reportlab.lib.pagesizes import letter
 from reportlab.lib import colors
 from reportlab.lib.styles import getSampleStyleSheet
+try:
+    import fcntl    # candado del almacén de asistencias (POSIX)
+except ImportError:
+    fcntl = None
+    import msvcrt   # Windows
+try:
+    import pyarrow  # noqa: F401  (Parquet para el archivo histórico; sin él se usa pickle)
+    HAVE_PYARROW = True
+except Exception:
+    HAVE_PYARROW = False
 
 # ---------------- Configuration ----------------
 DB_PATH = "known_faces.pkl"
 SVM_PATH = "svm_model.pkl" # Ruta del modelo SVM guardado
-EXCEL_PATH = "asistencias.xlsx" # Ruta del archivo Excel de asistencias
+EXCEL_PATH = "asistencias.xlsx" # Ruta del archivo Excel de asistencias (almacén "caliente": solo el día en curso)
+ARCHIVE_DIR = "asistencias_archivo"   # historial: {ARCHIVE_DIR}/{grupo}/{YYYY-MM}.parquet (.pkl sin pyarrow)
+ARCHIVE_ON_START = True         # mover al archivo las filas de días anteriores al iniciar
+STORE_LOCK_TIMEOUT = 30         # segundos esperando el candado del Excel (otro kiosco/proceso escribiendo)
+WRITER_BATCH_MAX = 64           # eventos de asistencia aplicados por escritura del Excel
+WRITER_BATCH_WAIT_MS = 20       # espera para juntar eventos de otros hilos en el mismo lote
+VIEWER_PAGE_SIZE = 25           # filas por página en el visor de asistencias de consola
 LOGO_PATH = "logo_ceti.jpg"
+REPORTS_DIR = "reportes"        # carpeta de la exportación por lote (Reporte_{grupo}_{materia}_{fecha}.pdf)
+REPORTS_MANIFEST = "reportes_manifest.json"   # junto a los PDF: huella (filas + encabezado + logo) de cada uno
+REPORT_LAYOUT_VERSION = 3       # subir al cambiar el diseño de los PDF (invalida el manifiesto)
+REPORT_ROWS_PER_TABLE = 40      # filas por tabla en los PDF (cada tabla repite el encabezado)
+REPORT_COL_WEIGHTS = {"Alumno": 2.5, "Fecha": 1.3}   # ancho relativo de columnas (resto = 1)
+REPORT_LOGO_PX = 270            # lado mayor del logo incrustado (90 pt a ~200 dpi); el original se reduce una vez
+REPORT_N_JOBS = -1              # procesos para generar PDFs en paralelo (-1 = todos los núcleos)
+LATE_TOLERANCE_MIN = 10         # minutos de tolerancia tras el inicio de clase antes de contar retardo
+SHOW_POPUPS = True              # ventanas emergentes de asistencia (el benchmark de reproducción las apaga)
 
 NUM_LANDMARKS = 420             # número de puntos de referencia
 CAPTURE_SECONDS_PER_ANGLE = 4   # segundos que tarda en capturar cada ángulo
 EXIT_SECONDS_AFTER_ENTRY = 30   # segundos que tarda en tomar la salida después de haber tomado la entrada
 DIST_FALLBACK_THRESHOLD = 0.60  # umbral de retroceso de distancia
+DIST_FALLBACK_THRESHOLD_3D = 0.75  # umbral equivalente para embeddings 3D (3n valores; se recalibra al migrar)
 GROUP_OPTIONS = ["7O", "7P"]    # opciones de grupo
 SUBJECT_OPTIONS = ["ML", "PDI"] # opciones de materia
 SELECTED_EYE_IDX = (33, 263)    # índices de ojos izquierdo y derecho
 DRAW_BOX_COLOR = (255, 0, 0)    # azul BGR (detección en angulos de registro)
-YAW_THRESHOLD_DEGREES = 12      # umbral de yaw para ángulos de registro
+YAW_THRESHOLD_DEGREES = 35      # umbral de yaw (3D real) para ángulos de registro; equivale a ~12° de la heurística nariz/ojos anterior
+POSE_IDX = (33, 263, 10, 152)   # ojo izq., ojo der., frente, mentón (base de la pose 3D)
+DEFAULT_FRAME_SHAPE = (480, 640)  # alto, ancho supuestos si no se conoce el frame
+EMBEDDING_MODE = "2d"           # "2d" = x, y alineados por ojos | "3d" = x, y, z con Procrustes (sobrescribible en MODEL_PARAMS_PATH)
+CANONICAL_FACE_PATH = "canonical_face.npy"   # plantilla canónica para el modo 3D
 PCA_VARIANCE = 0.90             # varianza explicada para PCA
+LANDMARKS_PATH = "selected_landmarks.json"   # subconjunto optimizado de puntos (si existe, sustituye a NUM_LANDMARKS)
+LANDMARK_ACC_TOLERANCE = 0.02   # pérdida máxima de accuracy aceptada al reducir puntos
+LANDMARK_CANDIDATE_SIZES = [40, 60, 100, 150, 210, 300]  # tamaños de subconjunto a probar
 
 # --- Constantes optimizadas (ajusta si quieres) ---
 SMOOTH_ALPHA = 0.85            # EMA alpha (más suavizado)
@@ -56,7 +106,60 @@ CONFIRM_FRAMES = 4             # cuántos frames concordantes para confirmar ide
 CONFIRM_RATIO = 0.66           # ratio mínimo de votos iguales dentro del buffer
 RESET_STATE_SECONDS = 30       # si no se ve a la persona en este tiempo, reiniciar estado
 MORE_SAMPLES_ON_REGISTER = True
-MORE_SAMPLES_COUNT = 20        # si se usa capture_more_samples (mejora reentreno)
+MORE_SAMPLES_COUNT = 20        # muestras rápidas de la fase "multi" del registro (mejora reentreno)
+REG_TRACK_MIN_IOU = 0.3        # IoU mínimo con el bbox anterior para seguir al rostro en registro
+MAX_SAMPLES_PER_ANGLE = 8      # muestras por ángulo guardadas (diversas, farthest-point sampling)
+
+# --- Calidad de frame (registro y reconocimiento) ---
+QUALITY_GATE_RECOGNITION = True  # saltar clasificación en rostros de baja calidad
+QUALITY_MIN_BLUR = 60.0        # varianza mínima del Laplaciano en el ROI del rostro
+QUALITY_MIN_IOD_PX = 40        # distancia mínima entre ojos en píxeles (rostro muy pequeño)
+QUALITY_MAX_PITCH = 20         # grados máximos de cabeceo (arriba/abajo)
+QUALITY_MAX_ROLL = 15          # grados máximos de inclinación lateral
+QUALITY_MAX_JITTER_PX = 6.0    # desplazamiento medio máximo de landmarks entre frames
+QUALITY_JITTER_IDX = (33, 263, 1, 61, 291, 152)  # ojos, nariz, boca, mentón
+QUALITY_ROI_MAX = 128          # el ROI se reduce a este tamaño para el Laplaciano
+
+# --- Evaluación del modelo (validación cruzada) ---
+ACCEPT_ACC = 0.70              # accuracy mínima (validación cruzada) para aceptar un modelo nuevo
+CV_FOLDS = 5                   # pliegues máximos de validación cruzada estratificada
+CV_N_JOBS = -1                 # procesos para evaluar pliegues en paralelo (-1 = todos los núcleos)
+
+# --- Hiperparámetros del modelo (sobrescribibles con MODEL_PARAMS_PATH) ---
+MODEL_PARAMS_PATH = "model_params.json"   # configuración elegida con la búsqueda de hiperparámetros
+SVM_C = 1.0                    # regularización del SVM
+SVM_GAMMA = "scale"            # gamma del kernel RBF
+PCA_MIN_COMPONENTS = 20        # "intentar mínimo N componentes" (0 = sin mínimo)
+SVM_CALIBRATION = "platt"      # "platt" = SVC(probability=True) | "margin" = decision_function + calibrador logístico
+CALIBRATION_FOLDS = 3          # pliegues para obtener márgenes fuera de muestra del calibrador
+TUNING_RESULTS_PATH = "tuning_results.csv"
+TUNING_GRID = {
+    "C": [0.3, 1.0, 3.0, 10.0],
+    "gamma": ["scale", 0.001, 0.01],
+    "pca_variance": [0.80, 0.90, 0.95],
+    "min_components": [0, 20],
+    "num_landmarks": [105, 210, NUM_LANDMARKS],
+    "calibration": ["platt", "margin"],
+}
+
+# --- Instrumentación por etapa (tecla 'p' la activa en caliente) ---
+PROFILE_ENABLED = False        # medir cada etapa del loop (apagado = sin costo)
+PROFILE_OVERLAY = False        # mostrar p50/p90 por etapa sobre el video
+PROFILE_WINDOW = 300           # muestras recientes por etapa (histograma móvil)
+PROFILE_DUMP_SECONDS = 60      # cada cuánto volcar el resumen a disco (0 = nunca)
+PROFILE_DUMP_PATH = "perfil_etapas.json"   # .json = último resumen | .csv = una fila por etapa y volcado
+PROFILE_HIST_EDGES_US = (100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000)  # límites de los buckets (µs)
+
+# --- Métricas del kiosco (endpoint HTTP estilo Prometheus) ---
+METRICS_ENABLED = False        # servir /metrics mientras corre el reconocimiento
+METRICS_HOST = "127.0.0.1"     # "0.0.0.0" para que lo lea un Prometheus de la red
+METRICS_PORT = 9108
+
+# --- Modo sin ventana (servidor, sin display ni Tk) ---
+HEADLESS_SOURCE = 0            # índice de cámara, archivo de video o directorio de imágenes
+HEADLESS_SUBJECT = None        # materia fija de la sesión (None = horario, o la materia del alumno en la BD)
+SCHEDULE_PATH = "horario.json" # {"7O": [{"dias": [0, 2, 4], "inicio": "07:00", "fin": "08:40", "materia": "ML"}], ...}
+EVENTS_PATH = "eventos.jsonl"  # eventos JSON, uno por línea ("-" = salida estándar)
 
 # ---------------- Configuración MediaPipe ----------------
 mp_face_mesh = mp.solutions.face_mesh # Módulo de MediaPipe Face Mesh7
@@ -152,13 +255,18 @@ def load_database(path=DB_PATH):
             if isinstance(v, dict):
                 samples = v.get("samples")
                 if isinstance(samples, dict):
-                    for ang, s in samples.items():
-                        if s is not None:
-                            try:
-                                samples[ang] = np.array(s, dtype=float)
-                            except Exception:
-                                samples[ang] = None
-                    db[k]["samples"] = samples
+                    # "raw" = landmarks 3D crudos por muestra (opcional, para migrar embeddings)
+                    for field in ("samples", "raw"):
+                        per_ang = v.get(field)
+                        if not isinstance(per_ang, dict):
+                            continue
+                        for ang, s in per_ang.items():
+                            if s is not None:
+                                try:
+                                    per_ang[ang] = np.array(s, dtype=float)
+                                except Exception:
+                                    per_ang[ang] = None
+                        db[k][field] = per_ang
                 else:
                     # formato antiguo: el valor completo es un vector -> lo convertimos en samples
                     try:
@@ -183,27 +291,32 @@ def load_database(path=DB_PATH):
 
 # ---------------- Guardar BD Pickle ----------------
 def save_database(db, path=DB_PATH):
-    """Guarda db (pickle). Convertir numpy -> listas para evitar problemas con versiones."""
+    """Guarda db (pickle). Convertir numpy -> listas para evitar problemas con versiones. Retorna True si se guardó."""
     safe_db = {}
     for name, info in db.items():
         safe_info = dict(info)
-        samples = safe_info.get("samples", {}) or {}
-        safe_samples = {}
-        for ang, vec in samples.items():
-            if vec is None:
-                safe_samples[ang] = None
-            else:
-                try:
-                    safe_samples[ang] = np.array(vec).tolist()
-                except Exception:
+        for field in ("samples", "raw"):
+            if field == "raw" and field not in safe_info:
+                continue
+            samples = safe_info.get(field, {}) or {}
+            safe_samples = {}
+            for ang, vec in samples.items():
+                if vec is None:
                     safe_samples[ang] = None
-        safe_info["samples"] = safe_samples
+                else:
+                    try:
+                        safe_samples[ang] = np.array(vec).tolist()
+                    except Exception:
+                        safe_samples[ang] = None
+            safe_info[field] = safe_samples
         safe_db[name] = safe_info
     try:
         with open(path, "wb") as f:
             pickle.dump(safe_db, f)
+        return True
     except Exception as e:
         print(f"[DB] Error guardando DB en '{path}': {e}")
+        return False
 # fin-save_database
 
 # ---------------- Encabezado personalizado por grupo para exportar asistencia a PDF --------------
@@ -226,6 +339,115 @@ CUSTOM_HEADERS = {
     }
 }
 
+# ---------------- Contexto de render de reportes ----------------
+class ReportContext:
+    """
+    Lo que todos los PDF de una corrida comparten: hoja de estilos, TableStyle y el
+    logo ya decodificado y reducido (JPEG en memoria). Se arma una sola vez por
+    proceso; el logo se vuelve a preparar solo si cambia el archivo.
+    """
+    def __init__(self):
+        self.styles = getSampleStyleSheet()
+        self.table_styles = {
+            # grupo y grupo/materia
+            "listado": TableStyle([
+                ("BACKGROUND", (0, 0), (-1, 0), colors.lightgrey),
+                ("TEXTCOLOR", (0, 0), (-1, 0), colors.black),
+                ("ALIGN", (0, 0), (-1, -1), "CENTER"),
+                ("FONTNAME", (0, 0), (-1, 0), "Helvetica-Bold"),
+                ("FONTSIZE", (0, 0), (-1, -1), 8),
+                ("BOTTOMPADDING", (0, 0), (-1, 0), 8),
+                ("GRID", (0, 0), (-1, -1), 0.5, colors.grey),
+            ]),
+            # grupo/materia/fecha
+            "fecha": TableStyle([
+                ("BACKGROUND", (0, 0), (-1, 0), colors.lightgrey),
+                ("ALIGN", (0, 0), (-1, -1), "CENTER"),
+                ("GRID", (0, 0), (-1, -1), 0.5, colors.grey),
+                ("FONTNAME", (0, 0), (-1, 0), "Helvetica-Bold"),
+                ("FONTSIZE", (0, 0), (-1, -1), 8),
+            ]),
+        }
+        self._logo_stamp = None
+        self._logo_jpeg = None
+
+    def _load_logo(self, path):
+        st = os.stat(path)   # FileNotFoundError -> el reporte sale sin logo
+        stamp = (os.path.abspath(path), st.st_mtime_ns, st.st_size)
+        if stamp == self._logo_stamp:
+            return
+        img = cv2.imread(path, cv2.IMREAD_COLOR)
+        if img is None:
+            raise ValueError(f"no se pudo decodificar {path}")
+        h, w = img.shape[:2]
+        escala = REPORT_LOGO_PX / max(h, w)
+        if escala < 1:
+            img = cv2.resize(img, (max(1, round(w * escala)), max(1, round(h * escala))),
+                             interpolation=cv2.INTER_AREA)
+        ok, buf = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, 90])
+        if not ok:
+            raise ValueError(f"no se pudo recodificar {path}")
+        self._logo_jpeg = buf.tobytes()
+        self._logo_stamp = stamp
+
+    def logo(self, width=90, height=90, path=LOGO_PATH):
+        """Flowable nuevo del logo (cada documento necesita el suyo) sobre los bytes en caché."""
+        self._load_logo(path)
+        return Image(io.BytesIO(self._logo_jpeg), width=width, height=height)
+
+_REPORT_CONTEXT = None
+
+def report_context():
+    """ReportContext del proceso (los workers del lote crean el suyo la primera vez)."""
+    global _REPORT_CONTEXT
+    if _REPORT_CONTEXT is None:
+        _REPORT_CONTEXT = ReportContext()
+    return _REPORT_CONTEXT
+
+# ---------------- Tablas de reporte paginadas (streaming) ----------------
+class FlowableStream(list):
+    """
+    Lista de flowables que se rellena desde un generador conforme reportlab la consume:
+    build() consulta len() en cada vuelta y siempre toma el primer elemento, así que
+    en memoria solo hay unas cuantas tablas sin importar cuántas filas tenga el reporte.
+    """
+    def __init__(self, head, gen, ahead=2):
+        super().__init__(head)
+        self.gen = gen
+        self.ahead = ahead   # >= 2: keepWithNext mira el siguiente flowable
+
+    def __len__(self):
+        while self.gen is not None and list.__len__(self) < self.ahead:
+            nxt = next(self.gen, None)
+            if nxt is None:
+                self.gen = None
+            else:
+                self.append(nxt)
+        return list.__len__(self)
+
+def report_col_widths(columns, total_width):
+    """Anchos fijos (todas las tablas del reporte quedan alineadas)."""
+    weights = [REPORT_COL_WEIGHTS.get(str(c), 1.0) for c in columns]
+    return [total_width * w / sum(weights) for w in weights]
+
+def iter_frame_chunks(df, size=REPORT_ROWS_PER_TABLE):
+    for i in range(0, len(df), size):
+        yield df.iloc[i:i + size]
+
+def report_tables(columns, chunks, style, col_widths):
+    """Una Table de hasta REPORT_ROWS_PER_TABLE filas por bloque, con el encabezado repetido."""
+    header = [str(c) for c in columns]
+    for chunk in chunks:
+        tabla = Table([header] + chunk.astype(str).values.tolist(), colWidths=col_widths, repeatRows=1)
+        tabla.setStyle(style)
+        yield tabla
+
+def build_report(nombre_pdf, elementos, columns, chunks, style):
+    """Construye el PDF: `elementos` (logo, títulos, encabezados) seguido de las tablas por bloques."""
+    doc = SimpleDocTemplate(nombre_pdf, pagesize=letter)
+    widths = report_col_widths(columns, doc.width)
+    doc.build(FlowableStream(elementos, report_tables(columns, chunks, style, widths)))
+
 def exportar_pdf_grupo(grupo: str, ruta_excel="asistencias.xlsx"):
     """
     Exporta a PDF el listado filtrado por grupo desde un archivo Excel.
@@ -248,23 +470,22 @@ def exportar_pdf_grupo(grupo: str, ruta_excel="asistencias.xlsx"):
     # Cargar Excel
     # -------------------------------
     try:
-        dfs = pd.read_excel(ruta_excel, sheet_name=None)  # Carga TODAS las hojas
-        df = pd.concat(dfs.values(), ignore_index=True)   # Une todas en un solo DataFrame
-
+        store = attendance_query(ruta_excel)   # todas las hojas, en caché
+        columnas = store.columns
     except Exception as e:
         print(f"[ERROR] No se puede abrir el archivo Excel: {e}")
         return
 
-    if "Grupo" not in df.columns:
+    if "Grupo" not in columnas:
         print("[ERROR] La tabla no contiene la columna 'Grupo'.")
         return
 
     # -------------------------------
     # Filtrar registros del grupo
     # -------------------------------
-    df_grupo = df[df["Grupo"].str.upper() == grupo]
+    pos = store.positions(grupo=grupo)
 
-    if df_grupo.empty:
+    if len(pos) == 0:
         print(f"[ADVERTENCIA] No hay registros para el grupo '{grupo}'.")
         return
 
@@ -274,19 +495,23 @@ def exportar_pdf_grupo(grupo: str, ruta_excel="asistencias.xlsx"):
     fecha = datetime.now().strftime("%Y-%m-%d")
     nombre_pdf = f"Reporte_{grupo}_{fecha}.pdf"
 
+    huella = report_digest("grupo", columnas, store.iter_chunks(pos), grupo)
+    if report_up_to_date(nombre_pdf, huella):
+        print(f"[OK] {nombre_pdf} ya está al día (mismas filas, encabezado y logo).\n")
+        return
+
     print(f"[INFO] Generando archivo: {nombre_pdf}")
 
     # -------------------------------
     # Crear documento PDF
     # -------------------------------
-    doc = SimpleDocTemplate(nombre_pdf, pagesize=letter)
-
+    ctx = report_context()
     elementos = []
-    estilos = getSampleStyleSheet()
+    estilos = ctx.styles
 
     # Logo
     try:
-        img = Image(LOGO_PATH, width=90, height=90)
+        img = ctx.logo()
         elementos.append(img)
         elementos.append(Spacer(1, 12))
     except Exception as e:
@@ -304,24 +529,9 @@ def exportar_pdf_grupo(grupo: str, ruta_excel="asistencias.xlsx"):
 
     elementos.append(Spacer(1, 18))
 
-    # Convertir a tabla
-    tabla_datos = [df_grupo.columns.tolist()] + df_grupo.astype(str).values.tolist()
-
-    tabla = Table(tabla_datos)
-    tabla.setStyle(TableStyle([
-        ("BACKGROUND", (0, 0), (-1, 0), colors.lightgrey),
-        ("TEXTCOLOR", (0, 0), (-1, 0), colors.black),
-        ("ALIGN", (0, 0), (-1, -1), "CENTER"),
-        ("FONTNAME", (0, 0), (-1, 0), "Helvetica-Bold"),
-        ("FONTSIZE", (0, 0), (-1, -1), 8),
-        ("BOTTOMPADDING", (0, 0), (-1, 0), 8),
-        ("GRID", (0, 0), (-1, -1), 0.5, colors.grey),
-    ]))
-
-    elementos.append(tabla)
-
-    # Finalizar PDF
-    doc.build(elementos)
+    # Finalizar PDF (tablas por bloques, se generan mientras se escribe el PDF)
+    build_report(nombre_pdf, elementos, columnas, store.iter_chunks(pos), ctx.table_styles["listado"])
+    record_report(nombre_pdf, huella)
 
     print(f"[OK] PDF creado correctamente: {nombre_pdf}\n")
 # fin exportar_pdf_grupo
@@ -349,8 +559,8 @@ def exportar_pdf_grupo_materia(grupo: str, materia: str, ruta_excel="asistencias
     # Cargar Excel
     # -------------------------------
     try:
-        dfs = pd.read_excel(ruta_excel, sheet_name=None)
-        df = pd.concat(dfs.values(), ignore_index=True)
+        store = attendance_query(ruta_excel)
+        columnas = store.columns
     except Exception as e:
         print(f"[ERROR] No se puede abrir el archivo Excel: {e}")
         return
@@ -358,25 +568,23 @@ def exportar_pdf_grupo_materia(grupo: str, materia: str, ruta_excel="asistencias
     # -------------------------------
     # Validar columnas requeridas
     # -------------------------------
-    if "Grupo" not in df.columns or "Materia" not in df.columns:
+    if "Grupo" not in columnas or "Materia" not in columnas:
         print("[ERROR] La tabla no contiene las columnas necesarias ('Grupo', 'Materia').")
         return
 
     # -------------------------------
     # Filtro 1: Por grupo
     # -------------------------------
-    df_filtrado = df[df["Grupo"].str.upper() == grupo]
-
-    if df_filtrado.empty:
+    if len(store.positions(grupo=grupo)) == 0:
         print(f"[ADVERTENCIA] No hay registros para el grupo '{grupo}'.")
         return
 
     # -------------------------------
     # Filtro 2: Por materia
     # -------------------------------
-    df_filtrado = df_filtrado[df_filtrado["Materia"].str.upper() == materia]
+    pos = store.positions(grupo=grupo, materia=materia)
 
-    if df_filtrado.empty:
+    if len(pos) == 0:
         print(f"[ADVERTENCIA] No hay registros para la materia '{materia}' en el grupo '{grupo}'.")
         return
 
@@ -386,18 +594,23 @@ def exportar_pdf_grupo_materia(grupo: str, materia: str, ruta_excel="asistencias
     fecha = datetime.now().strftime("%Y-%m-%d")
     nombre_pdf = f"Reporte_{grupo}_{materia}_{fecha}.pdf"
 
+    huella = report_digest("grupo_materia", columnas, store.iter_chunks(pos), grupo)
+    if report_up_to_date(nombre_pdf, huella):
+        print(f"[OK] {nombre_pdf} ya está al día (mismas filas, encabezado y logo).\n")
+        return
+
     print(f"[INFO] Generando archivo: {nombre_pdf}")
 
     # -------------------------------
     # Crear documento PDF
     # -------------------------------
-    doc = SimpleDocTemplate(nombre_pdf, pagesize=letter)
+    ctx = report_context()
     elementos = []
-    estilos = getSampleStyleSheet()
+    estilos = ctx.styles
 
     # Logo
     try:
-        img = Image(LOGO_PATH, width=90, height=90)
+        img = ctx.logo()
         elementos.append(img)
         elementos.append(Spacer(1, 12))
     except Exception as e:
@@ -417,22 +630,9 @@ def exportar_pdf_grupo_materia(grupo: str, materia: str, ruta_excel="asistencias
 
     elementos.append(Spacer(1, 12))
 
-    # Tabla
-    tabla_datos = [df_filtrado.columns.tolist()] + df_filtrado.astype(str).values.tolist()
-    tabla = Table(tabla_datos)
-
-    tabla.setStyle(TableStyle([
-        ("BACKGROUND", (0, 0), (-1, 0), colors.lightgrey),
-        ("TEXTCOLOR", (0, 0), (-1, 0), colors.black),
-        ("ALIGN", (0, 0), (-1, -1), "CENTER"),
-        ("FONTNAME", (0, 0), (-1, 0), "Helvetica-Bold"),
-        ("FONTSIZE", (0, 0), (-1, -1), 8),
-        ("BOTTOMPADDING", (0, 0), (-1, 0), 8),
-        ("GRID", (0, 0), (-1, -1), 0.5, colors.grey),
-    ]))
-
-    elementos.append(tabla)
-    doc.build(elementos)
+    # Tablas por bloques
+    build_report(nombre_pdf, elementos, columnas, store.iter_chunks(pos), ctx.table_styles["listado"])
+    record_report(nombre_pdf, huella)
 
     print(f"[OK] PDF creado correctamente: {nombre_pdf}\n")
 # fin exportar_pdf_grupo_materia
@@ -465,14 +665,12 @@ def exportar_pdf_grupo_materia_fecha(grupo: str, materia: str, fecha: str = "",
         print("Grupos disponibles:", ", ".join(CUSTOM_HEADERS.keys()))
         return
 
-    encabezado = CUSTOM_HEADERS[grupo]
-
     # -------------------------------
     # Cargar Excel
     # -------------------------------
     try:
-        dfs = pd.read_excel(ruta_excel, sheet_name=None)
-        df = pd.concat(dfs.values(), ignore_index=True)
+        store = attendance_query(ruta_excel)
+        columnas = store.columns
     except Exception as e:
         print(f"[ERROR] No se puede abrir el archivo Excel: {e}")
         return
@@ -481,31 +679,29 @@ def exportar_pdf_grupo_materia_fecha(grupo: str, materia: str, fecha: str = "",
     # Validar columnas requeridas
     # -------------------------------
     for col in ["Grupo", "Materia", "Fecha"]:
-        if col not in df.columns:
+        if col not in columnas:
             print(f"[ERROR] La tabla no contiene la columna '{col}'.")
             return
 
     # -------------------------------
     # Filtro 1: Por grupo
     # -------------------------------
-    df_f = df[df["Grupo"].str.upper() == grupo]
-    if df_f.empty:
+    if len(store.positions(grupo=grupo)) == 0:
         print(f"[ADVERTENCIA] No hay registros para el grupo '{grupo}'.")
         return
 
     # -------------------------------
     # Filtro 2: Por materia
     # -------------------------------
-    df_f = df_f[df_f["Materia"].str.upper() == materia]
-    if df_f.empty:
+    if len(store.positions(grupo=grupo, materia=materia)) == 0:
         print(f"[ADVERTENCIA] No hay registros en '{materia}' para el grupo '{grupo}'.")
         return
 
     # -------------------------------
     # Filtro 3: Por fecha
     # -------------------------------
-    df_f = df_f[df_f["Fecha"].astype(str) == fecha]
-    if df_f.empty:
+    pos = store.positions(grupo=grupo, materia=materia, fecha=fecha)
+    if len(pos) == 0:
         print(f"[ADVERTENCIA] No hay registros para la fecha '{fecha}' en el grupo {grupo} - materia {materia}.")
         return
 
@@ -513,18 +709,36 @@ def exportar_pdf_grupo_materia_fecha(grupo: str, materia: str, fecha: str = "",
     # Crear nombre PDF
     # -------------------------------
     nombre_pdf = f"Reporte_{grupo}_{materia}_{fecha}.pdf"
+    huella = report_digest("grupo_materia_fecha", columnas, store.iter_chunks(pos), grupo)
+    if report_up_to_date(nombre_pdf, huella):
+        print(f"[OK] {nombre_pdf} ya está al día (mismas filas, encabezado y logo).\n")
+        return
+
     print(f"[INFO] Generando: {nombre_pdf}")
 
+    render_pdf_grupo_materia_fecha(nombre_pdf, columnas, store.iter_chunks(pos), grupo, materia, fecha)
+    record_report(nombre_pdf, huella)
+
+    print(f"[OK] PDF creado correctamente: {nombre_pdf}\n")
+# fin exportar_pdf_grupo_materia_fecha
+
+def render_pdf_grupo_materia_fecha(nombre_pdf, columnas, chunks, grupo, materia, fecha):
+    """
+    Documento del reporte grupo/materia/fecha (lo usan la exportación individual y la
+    de lote). `chunks` son las filas en DataFrames de hasta REPORT_ROWS_PER_TABLE.
+    """
+    encabezado = CUSTOM_HEADERS[grupo]
+
     # -------------------------------
     # Crear documento PDF
     # -------------------------------
-    doc = SimpleDocTemplate(nombre_pdf, pagesize=letter)
+    ctx = report_context()
     elementos = []
-    estilos = getSampleStyleSheet()
+    estilos = ctx.styles
 
     # Logo
     try:
-        img = Image(LOGO_PATH, width=90, height=90)
+        img = ctx.logo()
         elementos.append(img)
         elementos.append(Spacer(1, 12))
     except:
@@ -550,31 +764,519 @@ def exportar_pdf_grupo_materia_fecha(grupo: str, materia: str, fecha: str = "",
 
     elementos.append(Spacer(1, 16))
 
-    # Tabla
-    tabla_datos = [df_f.columns.tolist()] + df_f.astype(str).values.tolist()
-    tabla = Table(tabla_datos)
-    tabla.setStyle(TableStyle([
-        ("BACKGROUND", (0, 0), (-1, 0), colors.lightgrey),
-        ("ALIGN", (0, 0), (-1, -1), "CENTER"),
-        ("GRID", (0, 0), (-1, -1), 0.5, colors.grey),
-        ("FONTNAME", (0, 0), (-1, 0), "Helvetica-Bold"),
-        ("FONTSIZE", (0, 0), (-1, -1), 8),
-    ]))
+    # Tablas por bloques
+    build_report(nombre_pdf, elementos, columnas, chunks, ctx.table_styles["fecha"])
+# fin render_pdf_grupo_materia_fecha
+
+# ---------------- Exportación por lote (todos los grupo/materia/fecha) ----------------
+def rows_digest(columns, chunks):
+    """Huella estable de un conjunto de filas (columnas + valores), calculada por bloques."""
+    h = hashlib.sha1("|".join(map(str, columns)).encode("utf-8"))
+    for chunk in chunks:
+        h.update(pd.util.hash_pandas_object(chunk.astype(str), index=False).values.tobytes())
+    return h.hexdigest()
+
+_FILE_DIGESTS = {}   # ruta -> (mtime_ns, tamaño, sha1)
+
+def file_digest(path):
+    """SHA-1 de un archivo, recalculado solo si cambia su mtime/tamaño. "" si no existe."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return ""
+    cached = _FILE_DIGESTS.get(path)
+    if cached and cached[:2] == (st.st_mtime_ns, st.st_size):
+        return cached[2]
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    _FILE_DIGESTS[path] = (st.st_mtime_ns, st.st_size, h.hexdigest())
+    return h.hexdigest()
+
+def report_digest(kind, columns, chunks, grupo):
+    """Huella de todo lo que entra a un PDF: tipo y versión del diseño, filas, encabezado del grupo y logo."""
+    h = hashlib.sha1(f"{kind}|v{REPORT_LAYOUT_VERSION}|".encode("utf-8"))
+    h.update(rows_digest(columns, chunks).encode("utf-8"))
+    h.update(json.dumps(CUSTOM_HEADERS.get(grupo, {}), sort_keys=True, ensure_ascii=False).encode("utf-8"))
+    h.update(file_digest(LOGO_PATH).encode("utf-8"))
+    return h.hexdigest()
+
+def _manifest_path(nombre_pdf):
+    return os.path.join(os.path.dirname(nombre_pdf) or ".", REPORTS_MANIFEST)
+
+def report_up_to_date(nombre_pdf, digest):
+    """True si el PDF existe y el manifiesto de su carpeta tiene la misma huella."""
+    if not os.path.exists(nombre_pdf):
+        return False
+    return load_report_manifest(_manifest_path(nombre_pdf)).get(os.path.basename(nombre_pdf)) == digest
+
+def record_report(nombre_pdf, digest):
+    path = _manifest_path(nombre_pdf)
+    manifest = load_report_manifest(path)
+    manifest[os.path.basename(nombre_pdf)] = digest
+    try:
+        save_report_manifest(manifest, path)
+    except Exception as e:
+        print(f"[PDF] Error guardando manifiesto: {e}")
+
+def load_report_manifest(path):
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception as e:
+        print(f"[PDF] Manifiesto ilegible ({e}); se regenerará todo.")
+        return {}
+
+def save_report_manifest(manifest, path):
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=1, ensure_ascii=False, sort_keys=True)
+    os.replace(tmp, path)
+
+def _render_report_job(nombre_pdf, df_f, grupo, materia, fecha):
+    try:
+        render_pdf_grupo_materia_fecha(nombre_pdf, df_f.columns, iter_frame_chunks(df_f), grupo, materia, fecha)
+        return nombre_pdf, None
+    except Exception as e:
+        return nombre_pdf, str(e)
+
+def exportar_pdfs_lote(ruta_excel=EXCEL_PATH, out_dir=REPORTS_DIR, n_jobs=REPORT_N_JOBS, force=False):
+    """
+    Genera un Reporte_{grupo}_{materia}_{fecha}.pdf por cada combinación presente en el
+    Excel, leyendo las asistencias una sola vez y repartiendo los PDFs en procesos.
+    Un reporte se omite si su archivo existe y su huella (report_digest) coincide con
+    la del manifiesto de la corrida anterior (REPORTS_MANIFEST dentro de out_dir).
+    Retorna {"generados": [...], "omitidos": n, "errores": {pdf: error}}.
+    """
+    try:
+        store = attendance_query(ruta_excel)
+        groups = store.group_rows("grupo", "materia", "fecha")
+        df = store.frame()
+    except Exception as e:
+        print(f"[ERROR] No se puede abrir el archivo Excel: {e}")
+        return None
+
+    os.makedirs(out_dir, exist_ok=True)
+    manifest_path = os.path.join(out_dir, REPORTS_MANIFEST)
+    manifest = {} if force else load_report_manifest(manifest_path)
+
+    jobs, digests, omitidos, sin_encabezado = [], {}, 0, set()
+    for (grupo, materia, fecha), pos in groups.items():
+        if grupo not in CUSTOM_HEADERS:
+            sin_encabezado.add(grupo)
+            continue
+        df_f = df.iloc[pos]
+        nombre_pdf = os.path.join(out_dir, f"Reporte_{grupo}_{materia}_{fecha}.pdf")
+        key = os.path.basename(nombre_pdf)
+        digests[key] = report_digest("grupo_materia_fecha", df_f.columns, [df_f], grupo)
+        if manifest.get(key) == digests[key] and os.path.exists(nombre_pdf):
+            omitidos += 1
+            continue
+        jobs.append((nombre_pdf, df_f, grupo, materia, fecha))
+    if sin_encabezado:
+        print(f"[PDF] Grupos sin encabezado en CUSTOM_HEADERS (omitidos): {', '.join(sorted(sin_encabezado))}")
+
+    print(f"[PDF] {len(groups)} reportes en el Excel: {len(jobs)} por generar, {omitidos} sin cambios.")
+    t0 = time.perf_counter()
+    if len(jobs) > 1 and n_jobs != 1:
+        results = joblib.Parallel(n_jobs=n_jobs)(joblib.delayed(_render_report_job)(*job) for job in jobs)
+    else:
+        results = [_render_report_job(*job) for job in jobs]
+
+    generados, errores = [], {}
+    for nombre_pdf, err in results:
+        key = os.path.basename(nombre_pdf)
+        if err is None:
+            generados.append(nombre_pdf)
+            manifest[key] = digests[key]
+        else:
+            errores[key] = err
+            manifest.pop(key, None)
+            print(f"[ERROR] {key}: {err}")
+    try:
+        save_report_manifest(manifest, manifest_path)
+    except Exception as e:
+        print(f"[PDF] Error guardando manifiesto: {e}")
+
+    print(f"[OK] {len(generados)} PDF generados en '{out_dir}' en {time.perf_counter() - t0:.1f}s "
+          f"({omitidos} sin cambios, {len(errores)} con error).\n")
+    return {"generados": generados, "omitidos": omitidos, "errores": errores}
+# fin exportar_pdfs_lote
+
+# ---------------- Resumen de asistencia (porcentaje, retardos, permanencia) ----------------
+SUMMARY_COLUMNS = ["Grupo", "Materia", "Alumno", "Registro", "Sesiones", "Asistencias",
+                   "Porcentaje", "Retardos", "Minutos promedio"]
+
+def schedule_start_seconds(p, schedule):
+    """
+    Inicio de clase (segundos) que el horario da a cada fila de `p` según grupo, materia
+    y día de la semana; NaN si el horario no la cubre. Tabla [grupo, materia, día]
+    indexada con los códigos de los categóricos.
+    """
+    grupos = {c: i for i, c in enumerate(p["grupo"].cat.categories)}
+    materias = {c: i for i, c in enumerate(p["materia"].cat.categories)}
+    tabla = np.full((len(grupos) + 1, len(materias) + 1, 8), np.nan)   # índice -1 = sin valor
+    for grupo, bloques in schedule.items():
+        gi = grupos.get(str(grupo).strip().upper())
+        for b in bloques:
+            mi = materias.get(str(b["materia"]).strip().upper())
+            if gi is None or mi is None:
+                continue
+            h, m = map(int, b["inicio"].split(":"))
+            for dia in b.get("dias", range(7)):
+                tabla[gi, mi, dia] = np.fmin(tabla[gi, mi, dia], h * 3600 + m * 60)
+    dias = p["fecha"].dt.weekday.fillna(-1).to_numpy(dtype=int)
+    return tabla[p["grupo"].cat.codes.to_numpy(), p["materia"].cat.codes.to_numpy(), dias]
+
+def attendance_summary(grupo=None, materia=None, desde=None, hasta=None, path=EXCEL_PATH, schedule=None):
+    """
+    Resumen por alumno de cada grupo/materia entre `desde` y `hasta` (YYYY-MM-DD, incluidas):
+      - Sesiones: fechas con al menos un registro de ese grupo/materia en el periodo.
+      - Asistencias / Porcentaje: fechas en que el alumno tiene entrada.
+      - Retardos: entradas después del inicio de clase + LATE_TOLERANCE_MIN, solo en las
+        sesiones que cubre el horario (SCHEDULE_PATH). <NA> si ninguna sesión del alumno
+        tiene horario: sin él no hay hora de inicio contra la cual medir.
+      - Minutos promedio: Salida - Entrada de los registros con ambas horas.
+    Todo con groupby sobre las columnas ya tipadas de AttendanceQuery.parsed().
+    """
+    store = attendance_query(path)
+    store.require(grupo=grupo or None, desde=desde, hasta=hasta)   # solo las particiones del periodo
+    p = store.parsed()
+    if schedule is None:
+        schedule = load_schedule()
+
+    mask = p["fecha"].notna().to_numpy()
+    if grupo:
+        mask = mask & (p["grupo"] == store.normalize("grupo", grupo)).to_numpy()
+    if materia:
+        mask = mask & (p["materia"] == store.normalize("materia", materia)).to_numpy()
+    if desde:
+        mask = mask & (p["fecha"] >= pd.Timestamp(desde)).to_numpy()
+    if hasta:
+        mask = mask & (p["fecha"] <= pd.Timestamp(hasta)).to_numpy()
+    p = p[mask]
+    if p.empty:
+        return pd.DataFrame(columns=SUMMARY_COLUMNS)
+
+    clase = ["grupo", "materia"]
+    inicio = schedule_start_seconds(p, schedule)
+
+    entrada = p["entrada_s"].to_numpy()
+    duracion = (p["salida_s"].to_numpy() - entrada) / 60.0
+    p = p.assign(
+        asistio=p["fecha"].where(~np.isnan(entrada)),   # NaT = sin entrada (nunique lo ignora)
+        retardo=entrada > inicio + LATE_TOLERANCE_MIN * 60,   # False si el horario no cubre la sesión
+        con_horario=~np.isnan(inicio),
+        minutos=np.where(duracion >= 0, duracion, np.nan),
+    )
+
+    # un solo agrupador por alumno; cada columna es una reducción cython sobre él
+    g = p.groupby(clase + ["alumno"], observed=True, sort=False)
+    out = pd.DataFrame({
+        "Registro": g["registro"].first(),
+        "Asistencias": g["asistio"].nunique(),
+        "Retardos": g["retardo"].sum(),
+        "con_horario": g["con_horario"].any(),
+        "minutos": g["minutos"].mean(),
+    })
+    sesiones = p.groupby(clase, observed=True)["fecha"].nunique()
+    out["Sesiones"] = sesiones.reindex(out.index.droplevel("alumno")).to_numpy()
+    out = out.reset_index()
+
+    out["Porcentaje"] = (100.0 * out["Asistencias"] / out["Sesiones"]).round(1)
+    out["Minutos promedio"] = out.pop("minutos").round(1)
+    out = out.rename(columns={"grupo": "Grupo", "materia": "Materia", "alumno": "Alumno"})
+    for c in ("Grupo", "Materia", "Alumno"):
+        out[c] = out[c].astype(str)
+    out["Retardos"] = out["Retardos"].astype("Int64").where(out.pop("con_horario"), pd.NA)
+    return out[SUMMARY_COLUMNS].sort_values(["Grupo", "Materia", "Alumno"], ignore_index=True)
+# fin attendance_summary
+
+def exportar_resumen(grupo: str, materia: str = "", desde: str = "", hasta: str = "", ruta_excel="asistencias.xlsx"):
+    """
+    Exporta el resumen de asistencia (attendance_summary) de un grupo, y opcionalmente
+    una materia, a PDF y CSV: Resumen_{grupo}_{materia|TODAS}_{desde}_{hasta}.pdf/.csv
+    """
+    grupo = grupo.upper().strip()
+    materia = materia.upper().strip()
+    desde, hasta = desde.strip(), hasta.strip()
+
+    if grupo not in CUSTOM_HEADERS:
+        print(f"[ERROR] No hay encabezados definidos para el grupo '{grupo}'.")
+        print("Grupos disponibles:", ", ".join(CUSTOM_HEADERS.keys()))
+        return
+
+    for f in (desde, hasta):
+        if f:
+            try:
+                datetime.strptime(f, "%Y-%m-%d")
+            except ValueError:
+                print(f"[ERROR] Fecha inválida '{f}' (use YYYY-MM-DD).")
+                return
+
+    try:
+        t0 = time.perf_counter()
+        resumen = attendance_summary(grupo, materia or None, desde or None, hasta or None, path=ruta_excel)
+        dt_ms = (time.perf_counter() - t0) * 1000.0
+    except Exception as e:
+        print(f"[ERROR] No se puede calcular el resumen: {e}")
+        return
+
+    if resumen.empty:
+        print(f"[ADVERTENCIA] No hay registros para el grupo '{grupo}'"
+              + (f" en '{materia}'" if materia else "") + " en ese periodo.")
+        return
+
+    periodo = f"{desde or 'inicio'}_{hasta or datetime.now().strftime('%Y-%m-%d')}"
+    base = f"Resumen_{grupo}_{materia or 'TODAS'}_{periodo}"
+    nombre_pdf, nombre_csv = base + ".pdf", base + ".csv"
+    print(f"[INFO] Resumen de {len(resumen)} alumno(s)/materia calculado en {dt_ms:.1f} ms")
+
+    sin_horario = resumen["Retardos"].isna()
+    if sin_horario.any():
+        print(f"[ADVERTENCIA] {int(sin_horario.sum())} fila(s) sin horario en {SCHEDULE_PATH}: no se cuentan retardos.")
+    resumen = resumen.assign(Retardos=resumen["Retardos"].astype(object).where(~sin_horario, "sin horario"))
+
+    resumen.to_csv(nombre_csv, index=False, encoding="utf-8-sig")   # BOM: Excel respeta los acentos
+    print(f"[OK] CSV creado correctamente: {nombre_csv}")
+
+    huella = report_digest("resumen", resumen.columns, [resumen], grupo)
+    if report_up_to_date(nombre_pdf, huella):
+        print(f"[OK] {nombre_pdf} ya está al día (mismas filas, encabezado y logo).\n")
+        return
+
+    ctx = report_context()
+    estilos = ctx.styles
+    elementos = []
+
+    # Logo
+    try:
+        elementos.append(ctx.logo())
+        elementos.append(Spacer(1, 12))
+    except Exception as e:
+        print(f"[WARN] No se pudo cargar el logo: {e}")
+
+    # Título
+    elementos.append(Paragraph("<b>Resumen de Asistencias</b>", estilos["Title"]))
+    elementos.append(Paragraph(
+        f"<b>Grupo:</b> {grupo} &nbsp;&nbsp; "
+        f"<b>Materia:</b> {materia or 'Todas'} &nbsp;&nbsp; "
+        f"<b>Periodo:</b> {desde or 'inicio'} a {hasta or 'hoy'}",
+        estilos["Heading2"]
+    ))
+    elementos.append(Spacer(1, 16))
+
+    # Encabezados personalizados
+    for k, v in CUSTOM_HEADERS[grupo].items():
+        elementos.append(Paragraph(f"<b>{k.replace('_',' ').title()}:</b> {v}", estilos["Normal"]))
+    elementos.append(Paragraph(
+        f"<i>Retardo: entrada más de {LATE_TOLERANCE_MIN} min después del inicio de clase según el horario; "
+        f"solo se cuentan las sesiones que cubre ('sin horario' si ninguna).</i>",
+        estilos["Normal"]
+    ))
+    elementos.append(Spacer(1, 16))
 
-    elementos.append(tabla)
-    doc.build(elementos)
+    tabla = resumen.assign(**{"Porcentaje": resumen["Porcentaje"].map("{:.1f}%".format),
+                              "Minutos promedio": resumen["Minutos promedio"].map(
+                                  lambda m: "-" if pd.isna(m) else f"{m:.1f}")})
+    build_report(nombre_pdf, elementos, tabla.columns, iter_frame_chunks(tabla), ctx.table_styles["listado"])
+    record_report(nombre_pdf, huella)
 
     print(f"[OK] PDF creado correctamente: {nombre_pdf}\n")
-# fin exportar_pdf_grupo_materia_fecha
+# fin exportar_resumen
+
+# ---------------- Candado del almacén (varios kioscos / procesos) ----------------
+def unique_tmp_path(path):
+    """Temporal en la misma carpeta que `path` (os.replace atómico), distinto por escritor."""
+    base, ext = os.path.splitext(os.path.basename(path))
+    fd, tmp = tempfile.mkstemp(prefix=f"{base}_", suffix=".tmp" + ext, dir=os.path.dirname(os.path.abspath(path)))
+    os.close(fd)
+    return tmp
+
+class StoreLock:
+    """
+    Candado exclusivo del almacén: un archivo `{path}.lock` bloqueado con flock (POSIX) o
+    msvcrt.locking (Windows) entre procesos, más un RLock entre hilos del mismo proceso.
+    Es reentrante, así write_group_sheet puede tomarlo dentro de un lote del escritor.
+    Toda lectura-modificación-escritura del Excel debe hacerse con él tomado.
+    """
+    _held = {}                  # ruta absoluta -> [RLock, profundidad, archivo .lock]
+    _guard = threading.Lock()
+
+    def __init__(self, path=EXCEL_PATH, timeout=STORE_LOCK_TIMEOUT):
+        self.key = os.path.abspath(path)
+        self.timeout = timeout
+        with StoreLock._guard:
+            self.entry = StoreLock._held.setdefault(self.key, [threading.RLock(), 0, None])
+
+    def _os_lock(self, fh):
+        deadline = time.monotonic() + self.timeout
+        while True:
+            try:
+                if fcntl is not None:
+                    fcntl.flock(fh.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                else:
+                    fh.seek(0)
+                    msvcrt.locking(fh.fileno(), msvcrt.LK_NBLCK, 1)
+                return
+            except OSError:
+                if time.monotonic() >= deadline:
+                    raise TimeoutError(f"El almacén {self.key} sigue bloqueado tras {self.timeout}s")
+                time.sleep(0.02)
+
+    def __enter__(self):
+        entry = self.entry
+        if not entry[0].acquire(timeout=self.timeout):
+            raise TimeoutError(f"El almacén {self.key} sigue bloqueado tras {self.timeout}s")
+        if entry[1] == 0:
+            try:
+                fh = open(self.key + ".lock", "a+b")
+                try:
+                    self._os_lock(fh)
+                except BaseException:
+                    fh.close()
+                    raise
+            except BaseException:
+                entry[0].release()
+                raise
+            entry[2] = fh
+        entry[1] += 1
+        return self
+
+    def __exit__(self, *exc):
+        entry = self.entry
+        entry[1] -= 1
+        if entry[1] == 0:
+            fh, entry[2] = entry[2], None
+            try:
+                if fcntl is not None:
+                    fcntl.flock(fh.fileno(), fcntl.LOCK_UN)
+                else:
+                    fh.seek(0)
+                    msvcrt.locking(fh.fileno(), msvcrt.LK_UNLCK, 1)
+            finally:
+                fh.close()
+        entry[0].release()
+        return False
+# fin-StoreLock
+
+# ---------------- Escritura de Excel en streaming (openpyxl write_only) ----------------
+_HEADER_FONT = Font(bold=True)
+_HEADER_BORDER = Border(*(Side(style="thin"),) * 4)
+_HEADER_ALIGN = Alignment(horizontal="center", vertical="top")
+
+def excel_value(v):
+    """Valor de celda: escalares de numpy a Python y NaN/NaT a celda vacía (igual que to_excel)."""
+    if isinstance(v, np.generic):
+        v = v.item()
+    if v is None or v is pd.NaT or (isinstance(v, float) and v != v):
+        return None
+    return v
+
+def frame_rows(df):
+    return df.itertuples(index=False, name=None)
+
+def sheet_rows(ws):
+    """(encabezado, iterador de filas) de una hoja abierta en modo read_only."""
+    rows = ws.iter_rows(values_only=True)
+    return next(rows, ()), rows
+
+def write_workbook_tmp(path, sheets):
+    """
+    Escribe `sheets` = [(nombre, columnas, filas), ...] con un Workbook write_only: cada
+    fila se serializa al agregarse y no queda en memoria, así el costo depende del número
+    de filas y no de armar un DataFrame por hoja. Se escribe a un temporal propio
+    (unique_tmp_path) junto a `path` y se retorna su ruta; replace_workbook lo publica.
+    """
+    tmp = unique_tmp_path(path)
+    try:
+        wb = openpyxl.Workbook(write_only=True)
+        for name, columns, rows in sheets:
+            ws = wb.create_sheet(title=name)
+            header = []
+            for c in columns:
+                cell = WriteOnlyCell(ws, value=str(c))
+                cell.font, cell.border, cell.alignment = _HEADER_FONT, _HEADER_BORDER, _HEADER_ALIGN
+                header.append(cell)
+            ws.append(header)
+            for row in rows:
+                ws.append([excel_value(v) for v in row])
+        wb.save(tmp)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return tmp
+
+def replace_workbook(tmp, path):
+    """
+    Reemplaza `path` por el temporal escrito con write_workbook_tmp. Todo Workbook abierto
+    sobre `path` debe estar cerrado antes: en Windows os.replace falla con PermissionError.
+    """
+    try:
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    bump_store_generation(path)
+
+def write_workbook_streaming(path, sheets):
+    """write_workbook_tmp + replace_workbook, para cuando no se lee de `path` mientras se escribe."""
+    replace_workbook(write_workbook_tmp(path, sheets), path)
+
+def exportar_excel_historial(destino="asistencias_historial.xlsx", ruta_excel=EXCEL_PATH, archive_dir=ARCHIVE_DIR):
+    """
+    Excel con todo el historial (archivo particionado + día en curso), una hoja por grupo.
+    Las particiones se leen una a la vez y sus filas pasan directo al Workbook write_only.
+    """
+    if os.path.abspath(destino) == os.path.abspath(ruta_excel):
+        print("[EXCEL] El destino no puede ser el Excel de asistencias en uso.")
+        return
+    t0 = time.perf_counter()
+    parts = list_partitions(archive_dir)
+    hot = load_workbook(ruta_excel, read_only=True) if os.path.exists(ruta_excel) else None
+    try:
+        hojas = list(hot.sheetnames) if hot is not None else []
+        hojas += sorted({g for g, _ in parts} - {h.upper() for h in hojas})
+        total = [0]
+
+        def filas(hoja, columnas, rows_hot):
+            for key in sorted(k for k in parts if k[0] == hoja.upper()):
+                for row in frame_rows(read_partition(parts[key]).reindex(columns=columnas, fill_value="-")):
+                    total[0] += 1
+                    yield row
+            for row in rows_hot:
+                total[0] += 1
+                yield row
+
+        def sheets():
+            for hoja in hojas:
+                if hot is not None and hoja in hot.sheetnames:
+                    columnas, rows_hot = sheet_rows(hot[hoja])
+                else:
+                    columnas, rows_hot = ATTENDANCE_COLUMNS, ()
+                columnas = list(columnas) or ATTENDANCE_COLUMNS
+                yield hoja, columnas, filas(hoja, columnas, rows_hot)
+
+        write_workbook_streaming(destino, sheets())
+    finally:
+        if hot is not None:
+            hot.close()
+    print(f"[EXCEL] {total[0]} filas ({len(hojas)} hojas) exportadas a {destino} "
+          f"en {time.perf_counter() - t0:.1f}s")
+# fin exportar_excel_historial
 
 # ---------------- Función para asegurar existencia de archivo Excel ----------------
 def ensure_excel_exists(path=EXCEL_PATH):
     if not os.path.exists(path):
         try:
-            with pd.ExcelWriter(path, engine="openpyxl") as writer:
-                for g in GROUP_OPTIONS:
-                    df = pd.DataFrame(columns=["Fecha", "Alumno", "Registro", "Grupo", "Materia", "Entrada", "Salida"])
-                    df.to_excel(writer, sheet_name=g, index=False)
+            with StoreLock(path):
+                if not os.path.exists(path):   # otro proceso pudo crearlo mientras esperábamos
+                    write_workbook_streaming(path, ((g, ATTENDANCE_COLUMNS, ()) for g in GROUP_OPTIONS))
         except Exception as e:
             print(f"[EXCEL] Error creando {path}: {e}")
 
@@ -590,66 +1292,353 @@ def read_group_sheet(group, path=EXCEL_PATH):
 # ---------------- Función para guardar hoja de grupo en Excel ----------------
 def write_group_sheet(df, group, path=EXCEL_PATH):
     try:
-        # Si el archivo existe, cargar todas las hojas
-        if os.path.exists(path):
-            with pd.ExcelWriter(path.replace(".xlsx", "_tmp.xlsx"), engine="openpyxl") as writer:
-                try:
-                    existing = pd.read_excel(path, sheet_name=None)
-                except:
-                    existing = {}
-
-                # Reescribir cada hoja, reemplazando solo la del grupo
-                for sheet_name, old_df in existing.items():
-                    if sheet_name == group:
-                        df.to_excel(writer, sheet_name=group, index=False)
-                    else:
-                        old_df.to_excel(writer, sheet_name=sheet_name, index=False)
-        else:
-            # Crear archivo nuevo con todas las hojas
-            with pd.ExcelWriter(path.replace(".xlsx", "_tmp.xlsx"), engine="openpyxl") as writer:
-                for g in GROUP_OPTIONS:
-                    if g == group:
-                        df.to_excel(writer, sheet_name=g, index=False)
-                    else:
-                        empty = pd.DataFrame(columns=["Fecha","Alumno","Registro","Grupo","Materia","Entrada","Salida"])
-                        empty.to_excel(writer, sheet_name=g, index=False)
-
-        # Reemplazar archivo original
-        os.replace(path.replace(".xlsx", "_tmp.xlsx"), path)
-
+        with StoreLock(path):
+            write_group_sheet_locked(df, group, path)
     except Exception as e:
         print(f"[EXCEL] Error guardando sheet {group}: {e}")
  # fin write_group_sheet
 
-# # ---------------- Mensaje emergente de estado de asistencia del alumno ----------------
-def popup_info(texto):
-    messagebox.showinfo("Asistencia", texto)
+def write_group_sheet_locked(df, group, path=EXCEL_PATH):
+    """Como write_group_sheet, con StoreLock ya tomado; los errores se propagan."""
+    # Si el archivo existe, las demás hojas se copian fila por fila (read_only -> write_only)
+    src = load_workbook(path, read_only=True) if os.path.exists(path) else None
+    try:
+        nombres = list(src.sheetnames) if src is not None else list(GROUP_OPTIONS)
+        if group not in nombres:
+            nombres.append(group)
+
+        def sheets():
+            for sheet_name in nombres:
+                if sheet_name == group:
+                    yield group, df.columns, frame_rows(df)
+                elif src is not None:
+                    yield (sheet_name,) + sheet_rows(src[sheet_name])
+                else:
+                    yield sheet_name, ATTENDANCE_COLUMNS, ()
 
-# ---------------- Añadir o actualizar asistencia en Excel ----------------
-def add_or_update_attendance(person_name, registro, group, subject, tipo, path=EXCEL_PATH):
+        # Escribe a un temporal propio; el original se reemplaza ya con `src` cerrado
+        tmp = write_workbook_tmp(path, sheets())
+    finally:
+        if src is not None:
+            src.close()
+    replace_workbook(tmp, path)
+
+# ---------------- Archivo histórico particionado (grupo / mes) ----------------
+ATTENDANCE_COLUMNS = ["Fecha", "Alumno", "Registro", "Grupo", "Materia", "Entrada", "Salida"]
+
+def archive_ext():
+    return ".parquet" if HAVE_PYARROW else ".pkl"
+
+def read_partition(path):
+    if path.endswith(".parquet"):
+        return pd.read_parquet(path)
+    return pd.read_pickle(path)
+
+def write_partition(df, path):
+    """Escritura atómica (tmp + replace) de una partición."""
+    tmp = unique_tmp_path(path)
+    try:
+        if path.endswith(".parquet"):
+            df.to_parquet(tmp, index=False)
+        else:
+            df.to_pickle(tmp)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+def archive_frame(df, dtypes=None):
     """
-    Actualiza o crea una fila de asistencia según alumno + materia.
-    Controla entradas duplicadas, salidas duplicadas y salidas sin entrada.
-    Devuelve códigos estándar para registrar_entrada() y registrar_salida().
+    Filas listas para una partición: las columnas numéricas conservan su dtype (o el de
+    `dtypes`, para alinear particiones que se guardaron como texto) y las de texto llevan
+    "-" en lugar de NaN, como se ve en el Excel.
+    """
+    out = df.copy()
+    for c in out.columns:
+        target = (dtypes or {}).get(c, out[c].dtype)
+        if pd.api.types.is_numeric_dtype(target):
+            if not pd.api.types.is_numeric_dtype(out[c]):
+                out[c] = pd.to_numeric(out[c], errors="coerce")   # "nan" / "-" -> NaN
+            if out[c].notna().all() and out[c].dtype != target:
+                out[c] = out[c].astype(target)
+        else:
+            out[c] = out[c].map(lambda v: "-" if pd.isna(v) or v == "nan" else str(v))
+    return out
+
+def list_partitions(archive_dir=ARCHIVE_DIR):
+    """{(GRUPO, "YYYY-MM"): ruta} de las particiones existentes."""
+    parts = {}
+    if not os.path.isdir(archive_dir):
+        return parts
+    for g in os.scandir(archive_dir):
+        if not g.is_dir():
+            continue
+        for f in os.scandir(g.path):
+            mes, ext = os.path.splitext(f.name)
+            if ext in (".parquet", ".pkl"):
+                # si conviven ambos formatos (pyarrow instalado después) gana el preferido
+                if (g.name.upper(), mes) not in parts or ext == archive_ext():
+                    parts[(g.name.upper(), mes)] = f.path
+    return parts
+
+def archive_attendance(path=EXCEL_PATH, archive_dir=ARCHIVE_DIR, before=None):
+    """
+    Mueve las filas con Fecha anterior a `before` (YYYY-MM-DD, por defecto hoy) del Excel
+    a particiones {archive_dir}/{hoja}/{YYYY-MM}. Primero se escriben las particiones y
+    luego se reescribe el Excel; si algo falla entre ambos pasos, volver a correrlo no
+    duplica filas (cada partición se guarda sin duplicados). Retorna filas movidas.
     """
+    if not os.path.exists(path):
+        return 0
+    try:
+        with StoreLock(path):   # nadie más reescribe el Excel mientras se parte
+            before = before or datetime.now().strftime("%Y-%m-%d")
+            try:
+                sheets = pd.read_excel(path, sheet_name=None)
+            except Exception as e:
+                print(f"[ARCHIVO] Error leyendo {path}: {e}")
+                return 0
+
+            movidas, particiones, restantes = 0, 0, {}
+            for sheet, df in sheets.items():
+                fechas = df["Fecha"].astype(str).str.strip() if "Fecha" in df.columns else pd.Series("", index=df.index)
+                viejas = fechas.str.match(r"^\d{4}-\d{2}-\d{2}$") & (fechas < before)
+                restantes[sheet] = df[~viejas]
+                if not viejas.any():
+                    continue
+                old = archive_frame(df[viejas])
+                os.makedirs(os.path.join(archive_dir, sheet), exist_ok=True)
+                for mes, rows in old.groupby(fechas[viejas].str[:7]):
+                    destino = os.path.join(archive_dir, sheet, mes + archive_ext())
+                    previas = [ruta for ruta in (os.path.join(archive_dir, sheet, mes + ext) for ext in (".parquet", ".pkl"))
+                               if os.path.exists(ruta)]
+                    if previas:
+                        tipos = rows.dtypes.to_dict()
+                        rows = pd.concat([archive_frame(read_partition(r), tipos) for r in previas] + [rows],
+                                         ignore_index=True)
+                        rows = rows.drop_duplicates(ignore_index=True)
+                    write_partition(rows, destino)
+                    for r in previas:
+                        if r != destino:
+                            os.remove(r)
+                    particiones += 1
+                movidas += int(viejas.sum())
+
+            if movidas:
+                write_workbook_streaming(path, ((sheet, df.columns, frame_rows(df)) for sheet, df in restantes.items()))
+                print(f"[ARCHIVO] {movidas} filas anteriores a {before} movidas a '{archive_dir}' ({particiones} particiones).")
+    except TimeoutError as e:
+        print(f"[ARCHIVO] {e}; se intentará en el próximo inicio.")
+        return 0
+    return movidas
+# fin archive_attendance
+
+# ---------------- Consultas de asistencia (caché compartida) ----------------
+_STORE_GENERATION = {}   # ruta absoluta -> número de escrituras hechas por este proceso
+
+def bump_store_generation(path=EXCEL_PATH):
+    key = os.path.abspath(path)
+    _STORE_GENERATION[key] = _STORE_GENERATION.get(key, 0) + 1
+
+class AttendanceQuery:
+    """
+    Las hojas del Excel (día en curso) más las particiones del archivo histórico que
+    alguna consulta ha pedido, en un solo DataFrame. positions() y require() cargan
+    solo las particiones grupo/mes que el filtro puede tocar; el resto del historial
+    no se lee. Se recarga si cambian el mtime/tamaño del Excel o la generación que
+    incrementan write_group_sheet y archive_attendance. Grupo, Materia, Fecha y Alumno
+    se indexan como categóricos normalizados (mayúsculas, sin espacios) -> posiciones
+    de fila, así un filtro es una intersección de índices y no un .str.upper() sobre
+    toda la tabla.
+    """
+    INDEXED = {"grupo": "Grupo", "materia": "Materia", "fecha": "Fecha", "alumno": "Alumno"}
+
+    def __init__(self, path=EXCEL_PATH, archive_dir=ARCHIVE_DIR):
+        self.path = path
+        self.archive_dir = archive_dir
+        self.df = None
+        self.keys = pd.DataFrame()   # columnas indexadas ya normalizadas
+        self.index = {}
+        self.stamp = None
+        self.builds = 0         # veces que se rearmó df: las posiciones de fila viejas ya no valen
+        self._parsed = None
+        self.hot = None
+        self.available = {}     # (GRUPO, "YYYY-MM") -> ruta, listado del archivo
+        self.wanted = set()     # particiones incluidas en df
+        self._parts = {}        # ruta -> (mtime_ns, DataFrame)
+
+    def _stamp(self):
+        st = os.stat(self.path)
+        return st.st_mtime_ns, st.st_size, _STORE_GENERATION.get(os.path.abspath(self.path), 0)
+
+    @staticmethod
+    def normalize(col, value):
+        value = str(value).strip()
+        return value if col == "fecha" else value.upper()
+
+    def _partition(self, path):
+        mtime = os.stat(path).st_mtime_ns
+        cached = self._parts.get(path)
+        if cached is None or cached[0] != mtime:
+            cached = self._parts[path] = (mtime, read_partition(path))
+        return cached[1]
+
+    def partitions_for(self, grupo=None, fecha=None, desde=None, hasta=None):
+        """Particiones que pueden tener filas para el filtro (sin filtros = todas)."""
+        grupo = self.normalize("grupo", grupo) if grupo is not None else None
+        meses = (str(fecha).strip()[:7],) if fecha is not None else None
+        desde = str(desde)[:7] if desde else None
+        hasta = str(hasta)[:7] if hasta else None
+        return {key for key in self.available
+                if (grupo is None or key[0] == grupo)
+                and (meses is None or key[1] in meses)
+                and (desde is None or key[1] >= desde)
+                and (hasta is None or key[1] <= hasta)}
+
+    def require(self, grupo=None, fecha=None, desde=None, hasta=None):
+        """Incluye en frame() las particiones que necesita el filtro (lee solo las nuevas)."""
+        self.frame()
+        need = self.partitions_for(grupo, fecha, desde, hasta) - self.wanted
+        if need:
+            self.wanted |= need
+            self._build()
+        return self.df
+
+    def frame(self):
+        """Excel + particiones ya requeridas (compartido: no modificarlo)."""
+        stamp = self._stamp()
+        if self.df is None or stamp != self.stamp:
+            dfs = pd.read_excel(self.path, sheet_name=None)   # Carga TODAS las hojas
+            self.hot = pd.concat(dfs.values(), ignore_index=True) if dfs else pd.DataFrame()
+            available = list_partitions(self.archive_dir)
+            # se conservan las particiones ya pedidas; las creadas desde la última lectura
+            # (archive_attendance) traen filas que estaban en el Excel, así que también entran
+            nuevas = set(available) - set(self.available) if self.stamp is not None else set()
+            self.wanted = (self.wanted & set(available)) | nuevas
+            self.available = available
+            self.stamp = stamp
+            self._build()
+        return self.df
+
+    def _build(self):
+        # historial (por grupo y mes) primero, luego el día en curso
+        parts = [self._partition(self.available[k]) for k in sorted(self.wanted)]
+        df = pd.concat(parts + [self.hot], ignore_index=True) if parts else self.hot
+        self.index = {}
+        keys = {}
+        for key, col in self.INDEXED.items():
+            if col in df.columns:
+                vals = df[col].astype(str).str.strip()
+                if key != "fecha":
+                    vals = vals.str.upper()
+                keys[key] = cats = vals.astype("category")
+                self.index[key] = cats.groupby(cats, observed=True).indices
+        self.keys = pd.DataFrame(keys)
+        self.df = df
+        self._parsed = None
+        self.builds += 1
+
+    def parsed(self):
+        """
+        Columnas ya tipadas para agregaciones (una fila por fila del Excel): grupo y
+        materia normalizados y alumno (tal cual) categóricos, fecha datetime64 y
+        entrada/salida en segundos desde las 00:00 (NaN si es "-"). Se calcula una vez
+        por recarga del archivo.
+        """
+        df = self.frame()
+        if self._parsed is None:
+            def col(name):
+                return df[name] if name in df.columns else pd.Series("-", index=df.index)
+
+            def seconds(name):
+                return pd.to_timedelta(col(name).astype(str).str.strip(), errors="coerce").dt.total_seconds()
+
+            p = pd.DataFrame({key: self.keys[key] if key in self.keys.columns else pd.Categorical(col(c))
+                              for key, c in (("grupo", "Grupo"), ("materia", "Materia"))})
+            p["alumno"] = col("Alumno").astype(str).str.strip().astype("category")
+            p["fecha"] = pd.to_datetime(col("Fecha").astype(str).str.strip(), format="%Y-%m-%d", errors="coerce")
+            p["registro"] = col("Registro").astype(str)
+            p["entrada_s"] = seconds("Entrada")
+            p["salida_s"] = seconds("Salida")
+            self._parsed = p
+        return self._parsed
+
+    @property
+    def columns(self):
+        return self.frame().columns
+
+    def positions(self, grupo=None, materia=None, fecha=None, alumno=None, desde=None, hasta=None):
+        """
+        Posiciones (ordenadas) de las filas que cumplen todos los filtros dados.
+        `desde`/`hasta` (YYYY-MM-DD, incluidas) acotan por rango de fechas.
+        """
+        df = self.require(grupo=grupo, fecha=fecha, desde=desde, hasta=hasta)
+        rows = None
+        for key, value in (("grupo", grupo), ("materia", materia), ("fecha", fecha), ("alumno", alumno)):
+            if value is None:
+                continue
+            pos = self.index.get(key, {}).get(self.normalize(key, value))
+            if pos is None:
+                return np.empty(0, dtype=np.intp)
+            rows = pos if rows is None else np.intersect1d(rows, pos, assume_unique=True)
+        if desde or hasta:
+            sel = [pos for f, pos in self.index.get("fecha", {}).items()
+                   if (not desde or f >= str(desde)) and (not hasta or f <= str(hasta))]
+            if not sel:
+                return np.empty(0, dtype=np.intp)
+            pos = np.concatenate(sel)
+            rows = pos if rows is None else np.intersect1d(rows, pos, assume_unique=True)
+        return np.arange(len(df)) if rows is None else np.sort(rows)
+
+    def iter_chunks(self, pos, size=REPORT_ROWS_PER_TABLE):
+        """Las filas `pos` en bloques de `size` (sin copiar el resultado completo)."""
+        df = self.frame()
+        for i in range(0, len(pos), size):
+            yield df.iloc[pos[i:i + size]]
+
+    def values(self, key):
+        """Valores distintos (normalizados) de una columna indexada (todo el historial)."""
+        self.require()
+        return sorted(self.index.get(key, {}).keys())
+
+    def group_rows(self, *keys):
+        """{(valor, ...): posiciones de fila} para cada combinación presente de `keys` (todo el historial)."""
+        self.require()
+        if any(k not in self.keys.columns for k in keys):
+            return {}
+        groups = self.keys.groupby(list(keys), observed=True, sort=True).indices
+        return {(k if isinstance(k, tuple) else (k,)): pos for k, pos in groups.items()}
+# fin-AttendanceQuery
 
-    ensure_excel_exists(path)
-    df = read_group_sheet(group, path)
+_ATTENDANCE_QUERIES = {}
 
-    hoy = datetime.now().strftime("%Y-%m-%d")
-    hora_actual = datetime.now().strftime("%H:%M:%S")
+def attendance_query(path=EXCEL_PATH):
+    """AttendanceQuery compartido por ruta (reportes, tablas y consola usan el mismo)."""
+    key = os.path.abspath(path)
+    q = _ATTENDANCE_QUERIES.get(key)
+    if q is None:
+        q = _ATTENDANCE_QUERIES[key] = AttendanceQuery(path)
+    return q
+
+# # ---------------- Mensaje emergente de estado de asistencia del alumno ----------------
+def popup_info(texto):
+    if not SHOW_POPUPS:
+        return
+    messagebox.showinfo("Asistencia", texto)
 
+# ---------------- Escritor único de asistencias (cola + lotes) ----------------
+def apply_attendance_event(df, person_name, registro, group, subject, tipo, hoy, hora_actual):
+    """
+    Aplica una entrada/salida a la hoja `df` de su grupo. Retorna (df, código) con los
+    códigos de add_or_update_attendance; no imprime ni abre ventanas (corre en el
+    hilo del escritor).
+    """
     # Asegurar columnas correctas
-    expected_cols = ["Fecha", "Alumno", "Registro", "Grupo", "Materia", "Entrada", "Salida"]
-    for col in expected_cols:
+    for col in ATTENDANCE_COLUMNS:
         if col not in df.columns:
             df[col] = "-"
 
-    # Normalización
-    person_name = str(person_name).strip()
-    registro = str(registro).strip()
-    subject = str(subject).strip()
-
     # Buscar registros del día + alumno + materia
     mask = (
         (df["Fecha"] == hoy) &
@@ -658,18 +1647,11 @@ def add_or_update_attendance(person_name, registro, group, subject, tipo, path=E
     )
     rows = df[mask]
 
-    # -------------------------------------------------------------
-    #                           ENTRADA
-    # -------------------------------------------------------------
     if tipo == "entrada":
-
         # Ya existe entrada → no duplicar
         if not rows.empty and any(rows["Entrada"] != "-"):
-            print(f"[Asistencia] Entrada YA existe para {person_name} en {subject}.")
-            popup_info("¡La entrada ya fue registrada!")
-            return "entrada_duplicada"
+            return df, "entrada_duplicada"
 
-        # Crear nueva fila de entrada
         new_row = {
             "Fecha": hoy,
             "Alumno": person_name,
@@ -679,51 +1661,143 @@ def add_or_update_attendance(person_name, registro, group, subject, tipo, path=E
             "Entrada": hora_actual,
             "Salida": "-",
         }
+        return pd.concat([df, pd.DataFrame([new_row])], ignore_index=True), "entrada_ok"
 
-        df = pd.concat([df, pd.DataFrame([new_row])], ignore_index=True)
-        write_group_sheet(df, group, path)
-
-        print(f"[ENTRY] Entrada registrada para {person_name} ({subject})")
-        popup_info(f"Entrada registrada\nHora: {hora_actual}")
-        return "entrada_ok"
-
-    # -------------------------------------------------------------
-    #                           SALIDA
-    # -------------------------------------------------------------
-    elif tipo == "salida":
-
+    if tipo == "salida":
         if rows.empty:
-            print(f"[WARN] No hay entrada previa para {person_name} en {subject}.")
-            popup_info(f"No puede registrar salida sin entrada previa en {subject}.")
-            return "sin_entrada"
+            return df, "sin_entrada"
 
         # Buscar fila con entrada registrada pero sin salida
         pendiente = rows[(rows["Entrada"] != "-") & (rows["Salida"] == "-")]
-
         if pendiente.empty:
-            print(f"[Asistencia] Salida YA existe para {person_name} en {subject}.")
-            popup_info("Asistencia del día ya está completa.")
-            return "salida_duplicada"
+            return df, "salida_duplicada"
 
-        # Registrar la salida
-        idx = pendiente.index[0] # tomar la primera fila pendiente
-        df.at[idx, "Salida"] = hora_actual # actualizar salida
-        write_group_sheet(df, group, path)
+        df.at[pendiente.index[0], "Salida"] = hora_actual   # la primera fila pendiente
+        return df, "salida_ok"
 
-        print(f"[EXIT] Salida registrada para {person_name} ({subject})")
-        popup_info(f"Salida registrada\nHora: {hora_actual}")
-        return "salida_ok"
+    return df, "error"
 
-    # -------------------------------------------------------------
-    #                        ERROR DE TIPO
-    # -------------------------------------------------------------
-    else:
+class AttendanceWriter:
+    """
+    Único hilo que escribe asistencias en `path`. Los productores (ventana, headless,
+    otra cámara en un hilo) encolan eventos con submit() y esperan su código; el hilo
+    junta hasta WRITER_BATCH_MAX eventos, toma StoreLock, relee cada hoja de grupo
+    afectada una vez, aplica los eventos en orden de llegada y la escribe una sola vez.
+    Entre procesos, releer con el candado tomado evita perder entradas/salidas.
+    """
+    def __init__(self, path=EXCEL_PATH):
+        self.path = path
+        self.queue = queue.Queue()
+        self.batches = 0
+        self.thread = threading.Thread(target=self._run, name="escritor-asistencias", daemon=True)
+        self.thread.start()
+
+    def depth(self):
+        """Eventos encolados que aún no toma un lote (gauge de KioskMetrics)."""
+        return self.queue.qsize()
+
+    def submit(self, person_name, registro, group, subject, tipo, when=None):
+        """Encola un evento; la hora es la del momento en que se reconoció, no la de escritura."""
+        when = when or datetime.now()
+        ticket = {
+            "event": (str(person_name).strip(), str(registro).strip(), group, str(subject).strip(), tipo,
+                      when.strftime("%Y-%m-%d"), when.strftime("%H:%M:%S")),
+            "done": threading.Event(),
+            "result": None,
+        }
+        self.queue.put(ticket)
+        return ticket
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + WRITER_BATCH_WAIT_MS / 1000.0
+            while len(batch) < WRITER_BATCH_MAX:
+                try:
+                    batch.append(self.queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            self._apply(batch)
+            self.batches += 1
+
+    def _apply(self, batch):
+        by_group = {}
+        for t in batch:
+            by_group.setdefault(t["event"][2], []).append(t)
+        try:
+            ensure_excel_exists(self.path)
+            with StoreLock(self.path):
+                for group, tickets in by_group.items():
+                    try:
+                        df = read_group_sheet(group, self.path)
+                        for t in tickets:
+                            df, t["result"] = apply_attendance_event(df, *t["event"])
+                        if any(t["result"] in ATTENDANCE_WRITTEN for t in tickets):
+                            write_group_sheet_locked(df, group, self.path)
+                    except Exception as e:
+                        print(f"[EXCEL] Error guardando {len(tickets)} asistencia(s) del grupo {group}: {e}")
+                        for t in tickets:
+                            t["result"] = "error"
+        except Exception as e:   # candado no disponible
+            print(f"[EXCEL] No se pudieron guardar {len(batch)} asistencia(s): {e}")
+            for t in batch:
+                if t["result"] is None:
+                    t["result"] = "error"
+        finally:
+            for t in batch:
+                t["done"].set()
+# fin-AttendanceWriter
+
+_ATTENDANCE_WRITERS = {}
+_ATTENDANCE_WRITERS_LOCK = threading.Lock()
+
+def attendance_writer(path=EXCEL_PATH):
+    """AttendanceWriter del proceso para `path` (se crea con el primer evento)."""
+    key = os.path.abspath(path)
+    with _ATTENDANCE_WRITERS_LOCK:
+        w = _ATTENDANCE_WRITERS.get(key)
+        if w is None:
+            w = _ATTENDANCE_WRITERS[key] = AttendanceWriter(path)
+    return w
+
+# ---------------- Añadir o actualizar asistencia en Excel ----------------
+def add_or_update_attendance(person_name, registro, group, subject, tipo, path=EXCEL_PATH):
+    """
+    Actualiza o crea una fila de asistencia según alumno + materia.
+    Controla entradas duplicadas, salidas duplicadas y salidas sin entrada.
+    La escritura la hace AttendanceWriter (en lote, con el almacén bloqueado); aquí
+    solo se espera el resultado y se avisa al usuario.
+    Devuelve códigos estándar para registrar_entrada() y registrar_salida().
+    """
+    if tipo not in ("entrada", "salida"):
         print(f"[ERROR] Tipo inválido en add_or_update_attendance(): {tipo}")
-        return "error"  
+        return "error"
+
+    ticket = attendance_writer(path).submit(person_name, registro, group, subject, tipo)
+    ticket["done"].wait()
+    res = ticket["result"]
+    person_name, subject, hora_actual = ticket["event"][0], ticket["event"][3], ticket["event"][6]
+
+    if res == "entrada_duplicada":
+        print(f"[Asistencia] Entrada YA existe para {person_name} en {subject}.")
+        popup_info("¡La entrada ya fue registrada!")
+    elif res == "entrada_ok":
+        print(f"[ENTRY] Entrada registrada para {person_name} ({subject})")
+        popup_info(f"Entrada registrada\nHora: {hora_actual}")
+    elif res == "sin_entrada":
+        print(f"[WARN] No hay entrada previa para {person_name} en {subject}.")
+        popup_info(f"No puede registrar salida sin entrada previa en {subject}.")
+    elif res == "salida_duplicada":
+        print(f"[Asistencia] Salida YA existe para {person_name} en {subject}.")
+        popup_info("Asistencia del día ya está completa.")
+    elif res == "salida_ok":
+        print(f"[EXIT] Salida registrada para {person_name} ({subject})")
+        popup_info(f"Salida registrada\nHora: {hora_actual}")
+    return res
     # fin add_or_update_attendance
 # -----------------------------------------------------------------------------
 
-def registrar_entrada(label, db, state):
+def registrar_entrada(label, db, state, path=EXCEL_PATH):
     alumno = db.get(label, {})
     registro = alumno.get("registro", "-")
     grupo = alumno.get("group", GROUP_OPTIONS[0])
@@ -740,16 +1814,17 @@ def registrar_entrada(label, db, state):
         registro=registro,
         group=grupo,
         subject=materia,
-        tipo="entrada"
+        tipo="entrada",
+        path=path
     )
 
     # -------- Manejo de resultados --------
     if res == "entrada_duplicada":
-        return
+        return res
 
     if res != "entrada_ok":
         print(f"[registrar_entrada] Resultado inesperado: {res}")
-        return
+        return res
 
     # -------- Entrada válida --------
     st = state.setdefault(label, {})
@@ -769,11 +1844,12 @@ def registrar_entrada(label, db, state):
     }
 
     print(f"[registrar_entrada] Timer iniciado para {label}")
+    return res
 
     # fin registrar_entrada
 
 
-def registrar_salida(label, db, state):
+def registrar_salida(label, db, state, path=EXCEL_PATH):
     alumno = db.get(label, {})
     registro = alumno.get("registro", "-")
     grupo = alumno.get("group", GROUP_OPTIONS[0])
@@ -788,15 +1864,16 @@ def registrar_salida(label, db, state):
     # No permitir salida sin entrada previa
     if not state.get(label, {}).get("entry_marked", False):
         popup_info("No puede registrar salida sin tener una entrada previa")
-        return
+        return "sin_entrada"
 
     # Registrar asistencia
-    add_or_update_attendance(
+    res = add_or_update_attendance(
         person_name=label,
         registro=registro,
         group=grupo,
         subject=materia,
-        tipo="salida"
+        tipo="salida",
+        path=path
     )
 
     # Actualizar estado interno
@@ -812,6 +1889,7 @@ def registrar_salida(label, db, state):
         "start_time": time.time()
     }
     print(f"[registrar_salida] Timer iniciado para {label}")
+    return res
 
     # fin registrar_salida
 
@@ -825,10 +1903,25 @@ def build_selected_indices(num=NUM_LANDMARKS, total=468, include=SELECTED_EYE_ID
             idxs.append(e)
     idxs = sorted(set(idxs))
     return idxs
-SELECTED_IDX = build_selected_indices()
+
+def load_selected_indices(path=LANDMARKS_PATH):
+    """Usa el subconjunto optimizado guardado en path; si no existe, el muestreo uniforme."""
+    if os.path.exists(path):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                idxs = [int(i) for i in json.load(f)]
+            idxs = sorted(set(i for i in idxs if 0 <= i < 468) | set(SELECTED_EYE_IDX))
+            if len(idxs) > len(SELECTED_EYE_IDX):
+                return idxs
+        except Exception as e:
+            print(f"[LANDMARKS] Error leyendo '{path}': {e} — se usa muestreo uniforme.")
+    return build_selected_indices()
+SELECTED_IDX = load_selected_indices()
 
 # ---------------- Extracción de puntos de referencia ----------------
-def extract_selected_landmarks(face_landmarks, selected_idx=SELECTED_IDX):
+def extract_selected_landmarks(face_landmarks, selected_idx=None):
+    if selected_idx is None:
+        selected_idx = SELECTED_IDX   # al llamar: optimize_landmarks_menu puede cambiarlo
     coords = []
     for i in selected_idx:
         try:
@@ -874,52 +1967,294 @@ def fix_length(vec, target_len):
         return np.concatenate([vec, pad])
     return vec[:target_len]
 
-# ---------------- Estimación de yaw (giro horizontal) ----------------
-def estimate_yaw_deg(face_landmarks):
+# ---------------- Embeddings 3D (x, y, z de FaceMesh) ----------------
+def landmarks_3d(face_landmarks, frame_shape=DEFAULT_FRAME_SHAPE, selected_idx=None):
+    """
+    Landmarks seleccionados como matriz (n, 3) en unidades isotrópicas:
+    x y z se multiplican por ancho/alto para que x, y, z compartan escala.
+    """
+    if selected_idx is None:
+        selected_idx = SELECTED_IDX
+    h, w = frame_shape[:2]
+    ar = w / float(h)
+    lms = face_landmarks.landmark
+    return np.array([(lms[i].x * ar, lms[i].y, lms[i].z * ar) for i in selected_idx], dtype=float)
+
+def raw3d_to_2d(raw3d, aspect):
+    """Convierte landmarks 3D isotrópicos al vector crudo 2D intercalado de extract_selected_landmarks."""
+    P = np.asarray(raw3d, dtype=float).reshape(-1, 3)
+    return np.column_stack([P[:, 0] / aspect, P[:, 1]]).ravel()
+
+def procrustes_align(P, T):
+    """
+    Alineación por similitud (traslación, escala y rotación 3D) de una o varias nubes
+    P (m, n, 3) a la plantilla T (n, 3). Kabsch vectorizado con SVD por lotes.
+    Retorna las nubes alineadas, centradas y con norma de Frobenius 1.
+    """
+    P = np.asarray(P, dtype=float)
+    single = P.ndim == 2
+    if single:
+        P = P[None]
+    Pc = P - P.mean(axis=1, keepdims=True)
+    Pc = Pc / (np.sqrt((Pc ** 2).sum(axis=(1, 2), keepdims=True)) + 1e-12)
+    Tc = T - T.mean(axis=0)
+    Tc = Tc / (np.linalg.norm(Tc) + 1e-12)
+    H = np.einsum("mni,nj->mij", Pc, Tc)
+    U, _, Vt = np.linalg.svd(H)
+    # corregir reflexiones (det = -1)
+    d = np.sign(np.linalg.det(U @ Vt))
+    U[:, :, 2] *= d[:, None]
+    aligned = Pc @ (U @ Vt)
+    return aligned[0] if single else aligned
+
+def build_canonical_face(raws, iterations=5):
+    """Plantilla canónica por Procrustes generalizado sobre muestras crudas (m, n, 3)."""
+    raws = np.asarray(raws, dtype=float)
+    T = raws[0] - raws[0].mean(axis=0)
+    for _ in range(iterations):
+        T = procrustes_align(raws, T).mean(axis=0)
+    return T
+
+_CANONICAL_FACE = {"T": None, "loaded": False}
+
+def get_canonical_face(path=CANONICAL_FACE_PATH):
+    """Plantilla canónica guardada (cacheada); None si no existe o no coincide con SELECTED_IDX."""
+    if not _CANONICAL_FACE["loaded"]:
+        _CANONICAL_FACE["loaded"] = True
+        if os.path.exists(path):
+            try:
+                T = np.load(path)
+                if T.shape == (len(SELECTED_IDX), 3):
+                    _CANONICAL_FACE["T"] = T
+                else:
+                    print(f"[3D] '{path}' no coincide con SELECTED_IDX, se ignora.")
+            except Exception as e:
+                print(f"[3D] Error leyendo '{path}': {e}")
+    return _CANONICAL_FACE["T"]
+
+def set_canonical_face(T, path=CANONICAL_FACE_PATH):
+    _CANONICAL_FACE["T"], _CANONICAL_FACE["loaded"] = T, True
     try:
-        left_eye_x = face_landmarks.landmark[SELECTED_EYE_IDX[0]].x
-        right_eye_x = face_landmarks.landmark[SELECTED_EYE_IDX[1]].x
-        nose_x = face_landmarks.landmark[1].x
+        np.save(path, T)
+    except Exception as e:
+        print(f"[3D] Error guardando '{path}': {e}")
+
+def normalize_vector_3d(raw3d, template=None):
+    """
+    Embedding 3D: alinea la nube (n, 3) a la plantilla canónica (Procrustes) y la escala
+    por la distancia entre ojos, igual que normalize_vector en 2D. Sin plantilla solo
+    centra y corrige el giro en el plano con la línea de los ojos.
+    Retorna [x..., y..., z...].
+    """
+    P = np.asarray(raw3d, dtype=float).reshape(-1, 3)
+    if template is None:
+        template = get_canonical_face()
+    pos0 = SELECTED_IDX.index(SELECTED_EYE_IDX[0])
+    pos1 = SELECTED_IDX.index(SELECTED_EYE_IDX[1])
+    if template is not None and template.shape == P.shape:
+        A = procrustes_align(P, template)
+    else:
+        A = P - P.mean(axis=0)
+        ex, ey = A[pos1, 0] - A[pos0, 0], A[pos1, 1] - A[pos0, 1]
+        ang = np.arctan2(ey, ex)
+        c, s = np.cos(-ang), np.sin(-ang)
+        A = A @ np.array([[c, s, 0.0], [-s, c, 0.0], [0.0, 0.0, 1.0]])
+    eye_dist = np.linalg.norm(A[pos1] - A[pos0])
+    A = (A - (A[pos0] + A[pos1]) / 2.0) / (eye_dist + 1e-12)
+    return A.T.ravel()
+
+def embed_raw3d(raw3d, mode=None, aspect=DEFAULT_FRAME_SHAPE[1] / DEFAULT_FRAME_SHAPE[0]):
+    """Embedding de landmarks 3D crudos según el modo ("2d" = normalize_vector, "3d")."""
+    mode = mode or EMBEDDING_MODE
+    if mode == "3d":
+        return normalize_vector_3d(raw3d)
+    return normalize_vector(raw3d_to_2d(raw3d, aspect))
+
+# ---------------- Estimación de pose 3D (yaw / pitch / roll) ----------------
+def estimate_head_pose(faces, frame_shape=DEFAULT_FRAME_SHAPE):
+    """
+    Yaw, pitch y roll (grados) de TODOS los rostros en una sola llamada, en forma cerrada
+    con las coordenadas x, y, z que ya entrega FaceMesh (z en la escala de x).
+    Por rostro se arma una base ortonormal: X = ojo izq. -> ojo der., Y = frente -> mentón
+    (ortogonalizado), Z = X x Y; la nariz apunta a -Z.
+    Convenciones: yaw > 0 nariz hacia la derecha de la imagen, pitch > 0 mirando arriba,
+    roll > 0 ojo derecho más abajo. Retorna array (n_rostros, 3).
+    """
+    if not faces:
+        return np.zeros((0, 3))
+    h, w = frame_shape[:2]
+    P = np.array([[(fl.landmark[i].x * w, fl.landmark[i].y * h, fl.landmark[i].z * w) for i in POSE_IDX]
+                  for fl in faces], dtype=float)
+    ex = P[:, 1] - P[:, 0]
+    ex /= np.linalg.norm(ex, axis=1, keepdims=True) + 1e-12
+    ey = P[:, 3] - P[:, 2]
+    ey -= np.sum(ey * ex, axis=1, keepdims=True) * ex
+    ey /= np.linalg.norm(ey, axis=1, keepdims=True) + 1e-12
+    nose = -np.cross(ex, ey)
+    yaw = np.degrees(np.arctan2(nose[:, 0], -nose[:, 2]))
+    pitch = np.degrees(np.arctan2(-nose[:, 1], -nose[:, 2]))
+    roll = np.degrees(np.arctan2(ex[:, 1], ex[:, 0]))
+    return np.column_stack([yaw, pitch, roll])
+
+def estimate_yaw_deg(face_landmarks, frame_shape=DEFAULT_FRAME_SHAPE):
+    """Yaw de un solo rostro (compatibilidad; usa estimate_head_pose)."""
+    try:
+        return float(estimate_head_pose([face_landmarks], frame_shape)[0, 0])
     except Exception:
         return 0.0
-    eye_center_x = (left_eye_x + right_eye_x) / 2.0
-    eye_dist = abs(right_eye_x - left_eye_x) + 1e-6
-    dx = nose_x - eye_center_x
-    yaw_rad = np.arctan2(dx, eye_dist)
-    yaw_deg = np.degrees(yaw_rad)
-    return yaw_deg
+
+# ---------------- Muestras por ángulo ----------------
+def sample_rows(v):
+    """
+    Devuelve las muestras de un ángulo como matriz 2D (una fila por frame).
+    El formato antiguo (un solo vector promedio) se trata como una fila.
+    """
+    if v is None:
+        return None
+    try:
+        arr = np.array(v, dtype=float)
+    except Exception:
+        return None
+    if arr.size == 0:
+        return None
+    return arr.reshape(1, -1) if arr.ndim == 1 else arr
+
+def farthest_point_sampling(vecs, k=MAX_SAMPLES_PER_ANGLE, return_index=False):
+    """
+    Elige hasta k vectores diversos: empieza por el más cercano a la media y
+    agrega repetidamente el más lejano a los ya elegidos (descarta frames casi duplicados).
+    Con return_index=True retorna también los índices elegidos.
+    """
+    X = np.atleast_2d(np.asarray(vecs, dtype=float))
+    if len(X) <= k:
+        return (X, np.arange(len(X))) if return_index else X
+    chosen = [int(np.argmin(np.linalg.norm(X - X.mean(axis=0), axis=1)))]
+    min_d = np.linalg.norm(X - X[chosen[0]], axis=1)
+    while len(chosen) < k:
+        nxt = int(np.argmax(min_d))
+        chosen.append(nxt)
+        min_d = np.minimum(min_d, np.linalg.norm(X - X[nxt], axis=1))
+    return (X[chosen], np.array(chosen)) if return_index else X[chosen]
+
+# ---------------- Calidad de frame ----------------
+def face_quality(gray, fl, prev_pts=None, pose=None):
+    """
+    Puntaje barato de calidad de un rostro:
+      - blur: varianza del Laplaciano en el ROI (reducido)
+      - iod: distancia entre ojos en píxeles
+      - pitch / roll: grados (de pose = (yaw, pitch, roll) si ya se calculó con estimate_head_pose)
+      - jitter: desplazamiento medio (px) de landmarks estables vs el frame anterior
+    Retorna (dict de métricas con "ok", puntos actuales para el siguiente frame).
+    """
+    h, w = gray.shape[:2]
+    lms = fl.landmark
+    pts = np.array([(lms[i].x * w, lms[i].y * h) for i in QUALITY_JITTER_IDX], dtype=float)
+
+    # distancia entre ojos
+    (ex0, ey0), (ex1, ey1) = pts[0], pts[1]
+    iod = float(np.hypot(ex1 - ex0, ey1 - ey0))
+
+    # pitch / roll de la pose 3D
+    if pose is None:
+        pose = estimate_head_pose([fl], gray.shape)[0]
+    pitch, roll = float(pose[1]), float(pose[2])
+
+    # nitidez en el ROI
+    x1, y1, x2, y2 = landmarks_bbox(fl, w, h, margin=0)
+    roi = gray[y1:y2, x1:x2]
+    blur = 0.0
+    if roi.size > 0:
+        scale = QUALITY_ROI_MAX / max(roi.shape[:2])
+        if scale < 1.0:
+            roi = cv2.resize(roi, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        blur = float(cv2.Laplacian(roi, cv2.CV_64F).var())
+
+    jitter = 0.0
+    if prev_pts is not None and prev_pts.shape == pts.shape:
+        jitter = float(np.mean(np.linalg.norm(pts - prev_pts, axis=1)))
+
+    ok = (blur >= QUALITY_MIN_BLUR and iod >= QUALITY_MIN_IOD_PX and
+          abs(pitch) <= QUALITY_MAX_PITCH and abs(roll) <= QUALITY_MAX_ROLL and
+          jitter <= QUALITY_MAX_JITTER_PX)
+    return {"blur": blur, "iod": iod, "pitch": pitch, "roll": roll, "jitter": jitter, "ok": ok}, pts
 
 # ---------------- Construcción de matriz de entrenamiento desde BD Pickle ----------------
-def build_training_matrix_from_db(db):
-    X = []
-    y = []
+def build_sample_matrix_from_db(db):
+    """
+    Construye la matriz con UNA fila por muestra de ángulo (sin promediar).
+    Así la validación cruzada puede dejar fuera muestras reales de cada alumno.
+    Retorna: X, y, lista de ángulos de cada fila.
+    """
+    rows, y, angs = [], [], []
     for name, info in db.items():
         samples = info.get("samples", {}) or {}
-        vecs = []
         for ang in ("frontal", "derecha", "izquierda"):
-            v = samples.get(ang)
-            if v is not None:
-                try:
-                    va = np.array(v, dtype=float)
-                    va = fix_length(va, len(va))  # aseguramos array numpy
-                    vecs.append(va)
-                except Exception:
-                    pass
-        if len(vecs) == 0:
-            continue
-        avg = np.mean(np.stack(vecs), axis=0)
-        X.append(avg)
-        y.append(name)
-    if len(X) == 0:
-        return np.array([]), np.array([])
-    return np.vstack(X), np.array(y)
+            arr = sample_rows(samples.get(ang))
+            if arr is None:
+                continue
+            for va in arr:
+                if np.isnan(va).any():
+                    continue
+                rows.append(va)
+                y.append(name)
+                angs.append(ang)
+    if len(rows) == 0:
+        return np.array([]), np.array([]), []
+    # longitud más frecuente como referencia (vectores de versiones anteriores)
+    lens = Counter(r.size for r in rows)
+    target_len = lens.most_common(1)[0][0]
+    X = np.vstack([fix_length(r, target_len) for r in rows])
+    return X, np.array(y), angs
+
+# ---------------- Hiperparámetros del modelo ----------------
+def get_model_params(path=MODEL_PARAMS_PATH):
+    """Hiperparámetros por defecto, sobrescritos por el JSON guardado (si existe)."""
+    params = {
+        "C": SVM_C,
+        "gamma": SVM_GAMMA,
+        "pca_variance": PCA_VARIANCE,
+        "min_components": PCA_MIN_COMPONENTS,
+        "calibration": SVM_CALIBRATION,
+        "embedding_mode": EMBEDDING_MODE,
+        "dist_threshold_3d": DIST_FALLBACK_THRESHOLD_3D,
+    }
+    if os.path.exists(path):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                saved = json.load(f)
+            params.update({k: v for k, v in saved.items() if k in params})
+        except Exception as e:
+            print(f"[MODEL] Error leyendo '{path}': {e} — se usan valores por defecto.")
+    return params
 
-# ---------------- Entrenamiento y guardado del modelo SVM + PCA ----------------
-def train_and_save_model(db, svm_path=SVM_PATH):
-    X, y = build_training_matrix_from_db(db)
-    if X.size == 0 or len(y) < 2:
-        print("[MODEL] No hay suficientes clases/muestras para entrenar.")
-        return None, None, None
+def save_model_params(params, path=MODEL_PARAMS_PATH):
+    """Actualiza (no reemplaza) los parámetros guardados en path."""
+    saved = {}
+    if os.path.exists(path):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                saved = json.load(f)
+        except Exception:
+            saved = {}
+    saved.update(params)
+    try:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(saved, f, indent=2)
+    except Exception as e:
+        print(f"[MODEL] Error guardando '{path}': {e}")
+
+# el modo de embedding elegido con la herramienta de migración persiste en MODEL_PARAMS_PATH
+EMBEDDING_MODE = get_model_params().get("embedding_mode", EMBEDDING_MODE)
+DIST_FALLBACK_THRESHOLD_3D = float(get_model_params().get("dist_threshold_3d", DIST_FALLBACK_THRESHOLD_3D))
+
+def fallback_threshold(mode=None):
+    """Umbral de distancia del fallback para el modo de embedding (los vectores 3D son más largos)."""
+    return DIST_FALLBACK_THRESHOLD_3D if (mode or EMBEDDING_MODE) == "3d" else DIST_FALLBACK_THRESHOLD
+
+# ---------------- Ajuste de escalador + PCA + SVM sobre una matriz ----------------
+def fit_model(X, y, params=None):
+    """Ajusta StandardScaler -> PCA -> SVC sobre (X, y). Retorna clf, scaler, pca."""
+    p = params or get_model_params()
     scaler = StandardScaler()
     Xs = scaler.fit_transform(X)
 
@@ -935,23 +2270,116 @@ def train_and_save_model(db, svm_path=SVM_PATH):
         pca_tmp = PCA(n_components=max_components, svd_solver='full')
         pca_tmp.fit(Xs)
         cumvar = np.cumsum(pca_tmp.explained_variance_ratio_)
-        n_comp = np.searchsorted(cumvar, PCA_VARIANCE) + 1
+        n_comp = np.searchsorted(cumvar, p["pca_variance"]) + 1
         n_comp = max(1, n_comp)
-        # regla: intentar mínimo 20 si es posible
-        if max_components >= 20:
-            n_comp = max(20, n_comp)
+        # regla: intentar un mínimo de componentes si es posible
+        min_comp = int(p["min_components"] or 0)
+        if min_comp and max_components >= min_comp:
+            n_comp = max(min_comp, n_comp)
         n_comp = min(n_comp, max_components)
         pca = PCA(n_components=n_comp)
         Xp = pca.fit_transform(Xs)
 
-    clf = SVC(kernel="rbf", probability=True, class_weight='balanced', gamma='scale', C=1.0)
-    clf.fit(Xp, y)
+    if p.get("calibration", SVM_CALIBRATION) == "margin":
+        # "ovo": los votos se agregan vectorizados en _decision_scores
+        clf = SVC(kernel="rbf", probability=False, class_weight='balanced', gamma=p["gamma"], C=p["C"],
+                  decision_function_shape="ovo")
+        clf.fit(Xp, y)
+        clf.margin_calibrator_ = fit_margin_calibrator(clf, Xp, y)
+    else:
+        clf = SVC(kernel="rbf", probability=True, class_weight='balanced', gamma=p["gamma"], C=p["C"])
+        clf.fit(Xp, y)
+    return clf, scaler, pca
+
+# ---------------- Calibrador de márgenes (sin Platt interno de SVC) ----------------
+DEFAULT_MARGIN_CALIBRATOR = (np.array([0.5, 2.0]), -1.0)   # si no hay errores/aciertos para ajustar
+
+def margin_features(scores):
+    """(margen máximo, diferencia con el segundo) por fila de decision_function."""
+    scores = np.atleast_2d(scores)
+    if scores.shape[1] == 1:
+        scores = np.hstack([-scores, scores])   # caso binario: un solo margen
+    top2 = np.sort(scores, axis=1)[:, -2:]
+    return np.column_stack([top2[:, 1], top2[:, 1] - top2[:, 0]])
+
+def ovo_to_scores(d, n_classes):
+    """
+    Convierte márgenes uno-contra-uno (n, n_pares) en puntuaciones por clase con la
+    misma regla que sklearn (votos + confianza acotada), pero con dos productos
+    matriciales en lugar del bucle en Python de decision_function_shape="ovr".
+    """
+    d = np.atleast_2d(d)
+    i, j = np.triu_indices(n_classes, k=1)      # orden de pares de libsvm
+    Mi = np.zeros((len(i), n_classes)); Mi[np.arange(len(i)), i] = 1
+    Mj = np.zeros((len(j), n_classes)); Mj[np.arange(len(j)), j] = 1
+    votes = (d >= 0) @ Mi + (d < 0) @ Mj       # empate (d == 0) -> clase i, como libsvm/sklearn
+    conf = d @ Mi - d @ Mj
+    return votes + conf / (3 * (np.abs(conf) + 1))
+
+def _decision_scores(clf, Xp):
+    d = clf.decision_function(Xp)
+    if d.ndim == 1:
+        return d.reshape(-1, 1)
+    if getattr(clf, "decision_function_shape", "ovr") == "ovo":
+        return ovo_to_scores(d, len(clf.classes_))
+    return d
+
+def fit_margin_calibrator(clf, Xp, y):
+    """
+    Ajusta P(predicción correcta | margen) con una regresión logística de 2 variables.
+    Los márgenes salen de una validación cruzada barata (CALIBRATION_FOLDS ajustes sin
+    probability=True); si hay muy pocas muestras se usan los márgenes de entrenamiento.
+    Retorna (w, b) para conf = sigmoid(features @ w + b).
+    """
+    y = np.asarray(y)
+    classes = clf.classes_
+    min_count = min(Counter(y).values())
+    try:
+        if min_count >= 2:
+            folds = min(CALIBRATION_FOLDS, min_count)
+            base = SVC(kernel="rbf", class_weight='balanced', gamma=clf.gamma, C=clf.C,
+                       decision_function_shape=clf.decision_function_shape)
+            scores = cross_val_predict(base, Xp, y, cv=folds, method="decision_function")
+            if scores.ndim == 1:
+                scores = scores.reshape(-1, 1)
+            elif clf.decision_function_shape == "ovo":
+                scores = ovo_to_scores(scores, len(classes))
+        else:
+            scores = _decision_scores(clf, Xp)
+        feats = margin_features(scores)
+        pred_idx = np.argmax(scores, axis=1) if scores.shape[1] > 1 else (scores[:, 0] > 0).astype(int)
+        correct = (classes[pred_idx] == y).astype(int)
+        if len(set(correct)) < 2:
+            return DEFAULT_MARGIN_CALIBRATOR
+        lr = LogisticRegression()
+        lr.fit(feats, correct)
+        return lr.coef_[0].copy(), float(lr.intercept_[0])
+    except Exception as e:
+        print("[MODEL] Error ajustando calibrador de márgenes:", e)
+        return DEFAULT_MARGIN_CALIBRATOR
+
+# ---------------- Entrenamiento y guardado del modelo SVM + PCA ----------------
+def train_model(db):
+    """Ajusta el modelo con las muestras de la BD sin guardarlo. (None, None, None) si no alcanza."""
+    X, y, _ = build_sample_matrix_from_db(db)
+    if X.size == 0 or len(set(y)) < 2:
+        print("[MODEL] No hay suficientes clases/muestras para entrenar.")
+        return None, None, None
+    return fit_model(X, y)
 
+def save_model(clf, scaler, pca, svm_path=SVM_PATH):
     try:
         joblib.dump((clf, scaler, pca), svm_path)
+        return True
     except Exception as e:
         print("[MODEL] Error guardando modelo:", e)
+        return False
 
+def train_and_save_model(db, svm_path=SVM_PATH):
+    clf, scaler, pca = train_model(db)
+    if clf is None:
+        return None, None, None
+    save_model(clf, scaler, pca, svm_path)
     print(f"[MODEL] Entrenado SVM + PCA({'NO PCA' if pca is None else pca.n_components_}) y guardado en {svm_path}")
     return clf, scaler, pca
 
@@ -966,256 +2394,854 @@ def load_model(svm_path=SVM_PATH):
             return None, None, None
     return None, None, None
 
-# ---------------- Evaluación del modelo sobre la BD ----------------
-def evaluate_model_on_db(clf, scaler, pca, db):
+# ---------------- Proyección fusionada (StandardScaler + PCA) ----------------
+def build_fused_projection(scaler, pca):
     """
-    Evalúa el modelo sobre las muestras usadas para entrenar.
-    Retorna: accuracy, número de muestras y dict de {clase: cantidad}
+    Fusiona StandardScaler y PCA en una sola proyección afín: Xp = X @ W - b.
+    Evita dos transform() de sklearn (con sus validaciones) por cada rostro.
+    Retorna (W, b) o None si no hay escalador.
     """
-    try:
-        X, y = build_training_matrix_from_db(db) # matriz de entrenamiento
-        if X.size == 0 or len(y) == 0:
-            return 0.0, 0, {}
-
-        Xs = scaler.transform(X) # normalización
+    if scaler is None:
+        return None
+    mean = np.asarray(scaler.mean_, dtype=float)
+    scale = np.asarray(scaler.scale_, dtype=float) if scaler.scale_ is not None else np.ones_like(mean)
+    if pca is None:
+        W = np.diag(1.0 / scale)
+        b = mean / scale
+    else:
+        comps = np.asarray(pca.components_, dtype=float)
+        W = (comps / scale).T
+        b = (mean / scale + pca.mean_) @ comps.T
+        if getattr(pca, "whiten", False):
+            std = np.sqrt(pca.explained_variance_)
+            W = W / std
+            b = b / std
+    return W, b
+
+def project_vectors(X, proj):
+    """Aplica la proyección fusionada a uno o varios vectores (filas)."""
+    W, b = proj
+    return np.atleast_2d(X) @ W - b
+
+def classify_projected(clf, Xp):
+    """
+    Clasifica UN vector ya proyectado. Retorna (etiqueta, confianza).
+    Con calibrador de márgenes usa decision_function (más barato que predict_proba).
+    """
+    calibrator = getattr(clf, "margin_calibrator_", None)
+    if calibrator is not None:
+        scores = _decision_scores(clf, Xp)
+        idx = int(np.argmax(scores[0])) if scores.shape[1] > 1 else int(scores[0, 0] > 0)
+        w, b = calibrator
+        conf = 1.0 / (1.0 + np.exp(-(margin_features(scores)[0] @ w + b)))
+        return str(clf.classes_[idx]), float(conf)
+    probs = clf.predict_proba(Xp)[0]
+    idx = int(np.argmax(probs))
+    return str(clf.classes_[idx]), float(probs[idx])
+
+# ---------------- Validación cruzada (muestras no vistas) ----------------
+def _cv_fold(X, y, train_idx, test_idx, params):
+    """Entrena con train_idx y predice test_idx uno a uno (igual que en vivo)."""
+    y_train = y[train_idx]
+    if len(set(y_train)) < 2:
+        return None
+    clf, scaler, pca = fit_model(X[train_idx], y_train, params)
+    proj = build_fused_projection(scaler, pca)
+    preds = []
+    t0 = time.perf_counter()
+    for i in test_idx:
+        label, _ = classify_projected(clf, project_vectors(X[i], proj))
+        preds.append(label)
+    elapsed = time.perf_counter() - t0
+    return [str(t) for t in y[test_idx]], preds, elapsed
+
+def cross_validate_matrix(X, y, folds=CV_FOLDS, n_jobs=CV_N_JOBS, params=None):
+    """
+    Evalúa la receta de entrenamiento sobre (X, y) con muestras que el modelo NO vio.
+      - k-fold estratificado si cada clase tiene >= 2 muestras
+      - leave-one-sample-out en caso contrario
+    Los pliegues se ejecutan en paralelo (procesos de joblib).
+    """
+    report = {"accuracy": 0.0, "n_samples": 0, "n_folds": 0, "strategy": "-",
+              "latency_ms": 0.0, "confusions": {}, "per_class": {}}
+    if X.size == 0 or len(set(y)) < 2:
+        print("[EVAL] No hay suficientes clases/muestras para validación cruzada.")
+        return report
+    params = params or get_model_params()
+
+    counts = Counter(y)
+    min_count = min(counts.values())
+    if min_count >= 2:
+        n_splits = min(folds, min_count)
+        splitter = StratifiedKFold(n_splits=n_splits, shuffle=True, random_state=0)
+        strategy = f"stratified-{n_splits}-fold"
+    else:
+        splitter = LeaveOneOut()
+        strategy = "leave-one-sample-out"
+    splits = list(splitter.split(X, y))
 
-        if pca is not None:
-            Xp = pca.transform(Xs)
-        else:
-            Xp = Xs
+    if n_jobs == 1:
+        results = [_cv_fold(X, y, tr, te, params) for tr, te in splits]
+    else:
+        results = joblib.Parallel(n_jobs=n_jobs)(
+            joblib.delayed(_cv_fold)(X, y, tr, te, params) for tr, te in splits
+        )
 
-        preds = clf.predict(Xp) # predicciones
-        acc = (preds == y).sum() / len(y) # accuracy
+    y_true, y_pred, total_time = [], [], 0.0
+    for res in results:
+        if res is None:
+            continue
+        t, p, el = res
+        y_true.extend(t)
+        y_pred.extend(p)
+        total_time += el
+
+    if len(y_true) == 0:
+        return report
+
+    hits = sum(1 for t, p in zip(y_true, y_pred) if t == p)
+    confusions = Counter((t, p) for t, p in zip(y_true, y_pred) if t != p)
+    report.update({
+        "accuracy": hits / len(y_true),
+        "n_samples": len(y_true),
+        "n_folds": len(splits),
+        "strategy": strategy,
+        "latency_ms": 1000.0 * total_time / len(y_true),
+        "confusions": dict(confusions.most_common()),
+        "per_class": dict(counts),
+    })
+    return report
+
+def cross_validate_model(db, folds=CV_FOLDS, n_jobs=CV_N_JOBS, params=None):
+    """Validación cruzada sobre las muestras por ángulo de la BD (ver cross_validate_matrix)."""
+    X, y, _ = build_sample_matrix_from_db(db)
+    return cross_validate_matrix(X, y, folds=folds, n_jobs=n_jobs, params=params)
+
+def print_evaluation_report(report):
+    print(f"[EVAL] {report['strategy']} | accuracy={report['accuracy']:.3f} | "
+          f"muestras={report['n_samples']} | clases={len(report['per_class'])} | "
+          f"latencia={report['latency_ms']:.2f} ms/predicción")
+    for (real, pred), n in report["confusions"].items():
+        print(f"[EVAL]   {real} -> {pred}: {n}")
+
+# ---------------- Reentrenamiento en segundo plano ----------------
+class ModelRetrainer:
+    """
+    Ajuste + validación cruzada de un modelo nuevo en un hilo, para que registrar a un
+    alumno no congele el loop de la cámara. submit() toma una copia de la BD (si ya hay
+    un entrenamiento en curso, queda pendiente solo la BD más reciente) y poll(), una
+    vez por frame, entrega el resultado terminado: (clf, scaler, pca, report, segundos).
+    Nada se guarda aquí: el llamador decide con ACCEPT_ACC.
+    """
+    def __init__(self, folds=CV_FOLDS, n_jobs=CV_N_JOBS):
+        self.folds = folds
+        self.n_jobs = n_jobs
+        self.thread = None
+        self.pending = None
+        self.result = None
+        self.lock = threading.Lock()
+
+    @property
+    def busy(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def submit(self, db):
+        snapshot = copy.deepcopy(db)
+        with self.lock:
+            if self.busy:
+                self.pending = snapshot
+                return
+            self._start(snapshot)
+
+    def _start(self, db):
+        self.thread = threading.Thread(target=self._run, args=(db,), name="reentrenamiento", daemon=True)
+        self.thread.start()
 
-        per_class = {}
-        # contar por clase
-        for label in y:
-            per_class[label] = per_class.get(label, 0) + 1 
+    def _run(self, db):
+        t0 = time.perf_counter()
+        clf, scaler, pca, report = None, None, None, None
+        try:
+            clf, scaler, pca = train_model(db)
+            if clf is not None:
+                report = cross_validate_model(db, folds=self.folds, n_jobs=self.n_jobs)
+        except Exception as e:
+            print("[MODEL] Error reentrenando:", e)
+        with self.lock:
+            self.result = (clf, scaler, pca, report, time.perf_counter() - t0)
+
+    def poll(self):
+        """Resultado terminado (una sola vez) o None; arranca el pendiente si lo hay."""
+        with self.lock:
+            result, self.result = self.result, None
+            if self.pending is not None and not self.busy:
+                db, self.pending = self.pending, None
+                self._start(db)
+        return result
+
+    def wait(self):
+        """
+        Al cerrar el loop: espera el entrenamiento en curso y, si quedó una BD pendiente,
+        la entrena aquí mismo. Retorna el resultado de la BD más reciente (o None).
+        """
+        if self.thread is not None:
+            self.thread.join()
+        with self.lock:
+            result, self.result = self.result, None
+            db, self.pending = self.pending, None
+        if db is not None:
+            self._run(db)   # el resultado anterior ya quedó superado por esta BD
+            with self.lock:
+                result, self.result = self.result, None
+        return result
+# fin-ModelRetrainer
+
+def apply_retrained_model(result, recognizer=None, svm_path=SVM_PATH):
+    """
+    Acepta un resultado de ModelRetrainer solo si la validación cruzada alcanza ACCEPT_ACC:
+    entonces se guarda en svm_path y se carga en `recognizer`. Un modelo débil solo se
+    respalda en *_weak_{ts}.pkl, así load_model() nunca lo levanta. Retorna si se aceptó.
+    """
+    clf, scaler, pca, report, _ = result
+    if clf is None:
+        print("[MODEL] Reentrenado fallido: insuficientes datos.")
+        return False
+    if report:
+        print_evaluation_report(report)
+    acc = report["accuracy"] if report else 0.0
+    if acc >= ACCEPT_ACC:
+        if save_model(clf, scaler, pca, svm_path) and recognizer is not None:
+            recognizer.set_model(clf, scaler, pca)
+        print(f"[MODEL] Nuevo modelo aceptado (accuracy {acc:.3f}), guardado en {svm_path} y cargado.")
+        return True
+    backup_path = svm_path.replace(".pkl", f"_weak_{int(time.time())}.pkl")
+    if save_model(clf, scaler, pca, backup_path):
+        print(f"[MODEL] Modelo débil (accuracy {acc:.3f} < {ACCEPT_ACC}) guardado en {backup_path} (no se cargó).")
+    return False
+
+# ---------------- Búsqueda de hiperparámetros (offline, en paralelo) ----------------
+def landmark_positions(subset_idx, selected_idx=None):
+    """Posiciones de subset_idx dentro de selected_idx (los que no están se omiten)."""
+    if selected_idx is None:
+        selected_idx = SELECTED_IDX
+    pos = {p: i for i, p in enumerate(selected_idx)}
+    return [pos[p] for p in subset_idx if p in pos]
+
+def landmark_columns(subset_idx, selected_idx=None, dims=2):
+    """
+    Posiciones de columnas de subset_idx dentro de vectores normalizados construidos
+    con selected_idx (bloques [x..., y...] en 2D o [x..., y..., z...] en 3D).
+    """
+    if selected_idx is None:
+        selected_idx = SELECTED_IDX
+    keep = landmark_positions(subset_idx, selected_idx)
+    n = len(selected_idx)
+    return np.array([d * n + k for d in range(dims) for k in keep], dtype=int)
 
-        return float(acc), len(y), per_class
+def tuning_columns(num_landmarks, width):
+    """
+    Columnas de X (vectores construidos con SELECTED_IDX) para evaluar num_landmarks.
+    Solo se pueden conservar los puntos de build_selected_indices(num_landmarks) que
+    también están en SELECTED_IDX. Retorna (columnas, puntos conservados) o (None, 0)
+    si el ancho de X no corresponde a SELECTED_IDX en 2D/3D.
+    """
+    n = len(SELECTED_IDX)
+    if width not in (2 * n, 3 * n):
+        return None, 0
+    subset = build_selected_indices(num=num_landmarks)
+    cols = landmark_columns(subset, dims=width // n)
+    return cols, len(landmark_positions(subset, SELECTED_IDX))
+
+def _tune_config(X, y, config, folds, cols, kept):
+    """Evalúa una configuración (un proceso por configuración, pliegues en serie)."""
+    params = {k: config[k] for k in ("C", "gamma", "pca_variance", "min_components", "calibration")}
+    Xc = X[:, cols]
+    report = cross_validate_matrix(Xc, y, folds=folds, n_jobs=1, params=params)
+    row = dict(config)
+    row.update({
+        "landmarks_kept": kept,
+        "dim": Xc.shape[1],
+        "accuracy": report["accuracy"],
+        "latency_ms": report["latency_ms"],
+    })
+    return row
+
+def pareto_front(rows):
+    """Marca las filas no dominadas (más accuracy y menos latencia)."""
+    for r in rows:
+        r["pareto"] = not any(
+            (o["accuracy"] >= r["accuracy"] and o["latency_ms"] <= r["latency_ms"]) and
+            (o["accuracy"] > r["accuracy"] or o["latency_ms"] < r["latency_ms"])
+            for o in rows
+        )
+    return rows
+
+def tune_hyperparameters(db, grid=TUNING_GRID, n_iter=None, folds=CV_FOLDS, n_jobs=CV_N_JOBS,
+                         out_path=TUNING_RESULTS_PATH):
+    """
+    Búsqueda en rejilla (o aleatoria si n_iter) sobre C, gamma, tamaño de PCA y NUM_LANDMARKS
+    usando la BD guardada. Cada configuración se evalúa con validación cruzada en su propio
+    proceso. Reporta accuracy y latencia por frame (proyección + SVM) y marca el frente de Pareto.
+    """
+    X, y, _ = build_sample_matrix_from_db(db)
+    if X.size == 0 or len(set(y)) < 2:
+        print("[TUNE] No hay suficientes clases/muestras para ajustar.")
+        return []
+
+    keys = list(grid.keys())
+    configs = [dict(zip(keys, combo)) for combo in product(*(grid[k] for k in keys))]
+    if n_iter and n_iter < len(configs):
+        configs = random.Random(0).sample(configs, n_iter)
+
+    # columnas por tamaño de subconjunto; las que no caben en X se omiten (sin usar X completa)
+    columnas = {}
+    for num in sorted({cfg["num_landmarks"] for cfg in configs}):
+        cols, kept = tuning_columns(num, X.shape[1])
+        if cols is None or cols.size == 0:
+            print(f"[TUNE] num_landmarks={num}: los vectores de la BD ({X.shape[1]} columnas) no "
+                  f"corresponden a los {len(SELECTED_IDX)} puntos actuales; se omite.")
+            continue
+        if kept != num:
+            print(f"[TUNE] num_landmarks={num}: solo {kept} de esos puntos están en el subconjunto "
+                  f"actual; se evalúa con {kept} (columna landmarks_kept).")
+        columnas[num] = (cols, kept)
+    configs = [cfg for cfg in configs if cfg["num_landmarks"] in columnas]
+    if not configs:
+        print("[TUNE] Ninguna configuración es evaluable con la BD actual.")
+        return []
+
+    print(f"[TUNE] Evaluando {len(configs)} configuraciones con {X.shape[0]} muestras...")
+    t0 = time.time()
+    rows = joblib.Parallel(n_jobs=n_jobs)(
+        joblib.delayed(_tune_config)(X, y, cfg, folds, *columnas[cfg["num_landmarks"]]) for cfg in configs
+    )
+    rows = pareto_front(rows)
+    rows.sort(key=lambda r: (-r["accuracy"], r["latency_ms"]))
+    print(f"[TUNE] Búsqueda completada en {time.time() - t0:.1f}s")
 
+    df = pd.DataFrame(rows)
+    try:
+        df.to_csv(out_path, index=False)
+        print(f"[TUNE] Resultados guardados en {out_path}")
     except Exception as e:
-        print("[EVAL] ERROR:", e)
-        return 0.0, 0, {}
+        print(f"[TUNE] Error guardando resultados: {e}")
+    print(df.head(20).to_string())
+    return rows
 
-# ---------------- Fallback distance match (versión robusta) ----------------
-def fallback_match(vec_norm, db, threshold=DIST_FALLBACK_THRESHOLD):
+def tune_hyperparameters_menu():
+    db = load_database()
+    n_iter = input("Número de configuraciones aleatorias (ENTER = rejilla completa): ").strip()
+    rows = tune_hyperparameters(db, n_iter=int(n_iter) if n_iter.isdigit() else None)
+    if not rows:
+        return
+    front = [i for i, r in enumerate(rows) if r["pareto"]]
+    print(f"[TUNE] Frente de Pareto (índices): {front}")
+    choice = input("Índice de la configuración a aplicar (ENTER para no aplicar): ").strip()
+    if not choice.isdigit() or int(choice) >= len(rows):
+        return
+    r = rows[int(choice)]
+    save_model_params({k: r[k] for k in ("C", "gamma", "pca_variance", "min_components", "calibration")})
+    print(f"[TUNE] Hiperparámetros guardados en {MODEL_PARAMS_PATH}. Se usarán en el próximo reentreno.")
+    if r["num_landmarks"] != NUM_LANDMARKS:
+        print(f"[TUNE] Nota: NUM_LANDMARKS={r['num_landmarks']} (evaluado con {r['landmarks_kept']} puntos) "
+              f"se aplica con 'Optimizar subconjunto de puntos de referencia'.")
+
+# ---------------- Optimización del subconjunto de puntos de referencia ----------------
+def fisher_scores(X, y):
+    """Puntaje de Fisher por columna: varianza entre clases / varianza intra-clase."""
+    classes = np.unique(y)
+    mu = X.mean(axis=0)
+    between = np.zeros(X.shape[1])
+    within = np.zeros(X.shape[1])
+    for c in classes:
+        Xc = X[y == c]
+        between += len(Xc) * (Xc.mean(axis=0) - mu) ** 2
+        within += len(Xc) * Xc.var(axis=0)
+    return between / (within + 1e-12)
+
+def rank_landmarks(db, selected_idx=None):
     """
-    Compara el embedding normalizado contra la BD sin PCA (distancia cruda).
-    Esta versión es segura y evita errores cuando:
-      - Hay vectores de diferente longitud
-      - Algún ángulo está en None
-      - Los vectores contienen NaN
-      - Se intenta convertir algo que no es array
+    Ordena los índices de la malla por poder discriminante (suma del Fisher de cada
+    coordenada) sobre la BD de registro. Retorna (índices ordenados, puntajes).
     """
-
-    if vec_norm is None:
-        return None, None
-
-    best = None
-    best_d = float("inf")
-    target_len = len(vec_norm)
-
-    # Iteramos por cada persona y sus muestras de ángulos
+    if selected_idx is None:
+        selected_idx = SELECTED_IDX
+    X, y, _ = build_sample_matrix_from_db(db)
+    n = len(selected_idx)
+    if X.size == 0 or len(set(y)) < 2 or X.shape[1] not in (2 * n, 3 * n):
+        return [], np.array([])
+    f = fisher_scores(X, y)
+    per_landmark = f.reshape(-1, n).sum(axis=0)
+    order = np.argsort(per_landmark)[::-1]
+    return [selected_idx[i] for i in order], per_landmark[order]
+
+def reproject_database(db, new_idx, old_idx=None):
+    """
+    Re-proyecta los embeddings guardados al subconjunto new_idx (sin recapturar).
+    Los ojos se conservan, así que la normalización 2D sigue siendo la misma; los
+    landmarks crudos ("raw") también se recortan.
+    """
+    if old_idx is None:
+        old_idx = SELECTED_IDX
+    positions = landmark_positions(new_idx, old_idx)
+    n = len(old_idx)
     for name, info in db.items():
         samples = info.get("samples", {}) or {}
-
-        for ang, s in samples.items():
-            if s is None:
+        for ang, v in samples.items():
+            if v is None:
                 continue
-
-            # ---- Convertir a array de forma segura ----
-            try:
-                s_arr = np.array(s, dtype=float)
-            except Exception:
+            va = np.array(v, dtype=float)
+            dims = va.shape[-1] // n
+            if dims not in (2, 3) or va.shape[-1] != dims * n:
+                print(f"[LANDMARKS] {name}/{ang}: longitud {va.shape[-1]} inesperada, se descarta.")
+                samples[ang] = None
                 continue
+            samples[ang] = va[..., landmark_columns(new_idx, old_idx, dims)]
+        info["samples"] = samples
+        raw = info.get("raw") or {}
+        for ang, r in raw.items():
+            if r is not None:
+                raw[ang] = np.array(r, dtype=float)[..., positions, :]
+    T = get_canonical_face()
+    if T is not None and T.shape[0] == n:
+        set_canonical_face(T[positions])
+    return db
+
+def optimize_landmark_subset(db, tolerance=LANDMARK_ACC_TOLERANCE, sizes=LANDMARK_CANDIDATE_SIZES):
+    """
+    Busca el subconjunto más pequeño de puntos (top-k por Fisher) cuya accuracy de
+    validación cruzada queda dentro de `tolerance` respecto al conjunto completo.
+    Retorna (índices elegidos, accuracy base, accuracy elegida) o (None, ...) si no aplica.
+    """
+    ranked, _ = rank_landmarks(db)
+    if not ranked:
+        print("[LANDMARKS] No hay suficientes datos (o la BD no coincide con SELECTED_IDX).")
+        return None, 0.0, 0.0
+    X, y, _ = build_sample_matrix_from_db(db)
+    base = cross_validate_matrix(X, y)["accuracy"]
+    print(f"[LANDMARKS] Base: {len(SELECTED_IDX)} puntos, accuracy={base:.3f}")
+    for k in sorted(sizes):
+        if k >= len(SELECTED_IDX):
+            break
+        subset = sorted(set(ranked[:k]) | set(SELECTED_EYE_IDX))
+        acc = cross_validate_matrix(X[:, landmark_columns(subset, dims=X.shape[1] // len(SELECTED_IDX))], y)["accuracy"]
+        print(f"[LANDMARKS] {len(subset)} puntos -> accuracy={acc:.3f}")
+        if acc >= base - tolerance:
+            return subset, base, acc
+    return None, base, base
+
+def optimize_landmarks_menu():
+    global SELECTED_IDX
+    db = load_database()
+    subset, base, acc = optimize_landmark_subset(db)
+    if subset is None:
+        print("[LANDMARKS] Ningún subconjunto menor cumple la tolerancia. Sin cambios.")
+        return
+    print(f"[LANDMARKS] Propuesto: {len(subset)} puntos (accuracy {acc:.3f} vs {base:.3f}).")
+    conf = input("¿Aplicar, re-proyectar la BD y reentrenar? (s/n): ").strip().lower()
+    if conf != "s":
+        print("Cancelado.")
+        return
+    backup_path = DB_PATH.replace(".pkl", f"_backup_{int(time.time())}.pkl")
+    if not save_database(db, backup_path):
+        print("[LANDMARKS] No se pudo respaldar la BD. Sin cambios.")
+        return
 
-            # ---- Evitar vectores vacíos ----
-            if s_arr.size == 0:
-                continue
+    # Primero el subconjunto (SELECTED_IDX), luego la BD re-proyectada;
+    # si la BD no se puede guardar, se regresan el subconjunto y la BD anteriores.
+    previo = None
+    if os.path.exists(LANDMARKS_PATH):
+        with open(LANDMARKS_PATH, "r", encoding="utf-8") as f:
+            previo = f.read()
+    tmp = LANDMARKS_PATH + ".tmp"
+    try:
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump([int(i) for i in subset], f)   # los índices pueden venir como np.int64
+        os.replace(tmp, LANDMARKS_PATH)
+    except Exception as e:
+        print(f"[LANDMARKS] Error guardando '{LANDMARKS_PATH}': {e}. BD sin cambios.")
+        if os.path.isfile(tmp):
+            os.remove(tmp)
+        return
+    db = reproject_database(db, subset)
+    if not save_database(db):
+        print("[LANDMARKS] No se guardó la BD re-proyectada. Se restauran la BD y el subconjunto anteriores.")
+        if previo is None:
+            os.remove(LANDMARKS_PATH)
+        else:
+            with open(LANDMARKS_PATH, "w", encoding="utf-8") as f:
+                f.write(previo)
+        shutil.copyfile(backup_path, DB_PATH)
+        return
+    # el proceso sigue con el subconjunto nuevo (extracción, plantilla 3D, reconocimiento)
+    SELECTED_IDX = [int(i) for i in subset]
+    _CANONICAL_FACE["T"], _CANONICAL_FACE["loaded"] = None, False
+    train_and_save_model(db)
+    print(f"[LANDMARKS] BD re-proyectada (respaldo en {backup_path}). En uso: {len(subset)} puntos.")
+
+# ---------------- Migración de embeddings (2D <-> 3D) ----------------
+def _raw_rows(r, n):
+    """Landmarks crudos de un ángulo como (k, n, 3) o None si no coinciden con SELECTED_IDX."""
+    if r is None:
+        return None
+    arr = np.array(r, dtype=float)
+    if arr.size == 0 or arr.shape[-2:] != (n, 3):
+        return None
+    return arr.reshape(-1, n, 3)
 
-            # ---- Empatar longitud si difieren ----
-            if s_arr.size != target_len:
-                m = min(s_arr.size, target_len)
-                v1 = vec_norm[:m]
-                v2 = s_arr[:m]
-            else:
-                v1 = vec_norm
-                v2 = s_arr
+def unmigratable_entries(db, mode):
+    """
+    Alumnos que no pueden pasar al modo indicado: están en otro modo y algún ángulo con
+    muestras no tiene landmarks crudos ("raw") de los que recalcularlas.
+    """
+    n = len(SELECTED_IDX)
+    missing = []
+    for name, info in db.items():
+        if info.get("embedding_mode", "2d") == mode:
+            continue
+        raw = info.get("raw") or {}
+        for ang, v in (info.get("samples", {}) or {}).items():
+            if sample_rows(v) is not None and _raw_rows(raw.get(ang), n) is None:
+                missing.append(name)
+                break
+    return missing
 
-            # ---- Evitar vectores dañados ----
-            if np.isnan(v1).any() or np.isnan(v2).any():
-                continue
+def calibrate_threshold_3d(db):
+    """
+    Umbral de fallback para 3D: escala DIST_FALLBACK_THRESHOLD por la razón entre las
+    distancias intra-alumno 3D y 2D de las mismas muestras crudas. None si no hay datos.
+    """
+    n = len(SELECTED_IDX)
+    d2, d3 = [], []
+    for info in db.values():
+        aspect = info.get("raw_aspect") or DEFAULT_FRAME_SHAPE[1] / DEFAULT_FRAME_SHAPE[0]
+        rows = [_raw_rows(r, n) for r in (info.get("raw") or {}).values()]
+        rows = [r for r in rows if r is not None]
+        if not rows:
+            continue
+        P = np.concatenate(rows)
+        if len(P) < 2:
+            continue
+        for mode, out in (("2d", d2), ("3d", d3)):
+            E = np.vstack([embed_raw3d(p, mode, aspect) for p in P])
+            iu = np.triu_indices(len(E), 1)
+            out.append(np.linalg.norm(E[iu[0]] - E[iu[1]], axis=1))
+    if not d2:
+        return None
+    m2, m3 = np.median(np.concatenate(d2)), np.median(np.concatenate(d3))
+    if m2 <= 0:
+        return None
+    return float(DIST_FALLBACK_THRESHOLD * m3 / m2)
 
-            # ---- Distancia euclidiana ----
-            try:
-                d = np.linalg.norm(v1 - v2)
-            except Exception:
+def migrate_embeddings(db, mode, template_path=CANONICAL_FACE_PATH):
+    """
+    Recalcula los embeddings de la BD en el modo indicado a partir de los landmarks
+    crudos ("raw"). En 3D primero arma la plantilla canónica (Procrustes generalizado)
+    con las muestras frontales crudas; con template_path=None queda solo en memoria.
+    Los alumnos que no se pueden migrar (ver unmigratable_entries) conservan sus
+    muestras y su embedding_mode. Retorna la lista de esos alumnos.
+    """
+    n = len(SELECTED_IDX)
+    missing = unmigratable_entries(db, mode)
+    if mode == "3d":
+        frontal = [_raw_rows((info.get("raw") or {}).get("frontal"), n) for info in db.values()]
+        frontal = [f for f in frontal if f is not None]
+        if frontal:
+            T = build_canonical_face(np.concatenate(frontal))
+            if template_path:
+                set_canonical_face(T, template_path)
+            else:
+                _CANONICAL_FACE["T"], _CANONICAL_FACE["loaded"] = T, True
+        else:
+            print("[3D] No hay muestras crudas frontales: se alinea sin plantilla canónica.")
+
+    for name, info in db.items():
+        if name in missing:
+            continue
+        raw = info.get("raw") or {}
+        aspect = info.get("raw_aspect") or DEFAULT_FRAME_SHAPE[1] / DEFAULT_FRAME_SHAPE[0]
+        samples = info.get("samples", {}) or {}
+        for ang, r in raw.items():
+            rows = _raw_rows(r, n)
+            if rows is None:
                 continue
+            samples[ang] = np.vstack([embed_raw3d(p, mode, aspect) for p in rows])
+        info["samples"] = samples
+        info["embedding_mode"] = mode
+    return missing
+
+def migrate_embeddings_menu():
+    global EMBEDDING_MODE, DIST_FALLBACK_THRESHOLD_3D
+    mode = input(f"Modo de embedding destino (2d / 3d) [actual: {EMBEDDING_MODE}]: ").strip().lower()
+    if mode not in ("2d", "3d"):
+        print("Opción inválida.")
+        return
+    db = load_database()
+    missing = unmigratable_entries(db, mode)
+    if missing:
+        # migrar a medias dejaría la BD con vectores de dos longitudes: no se toca nada
+        print(f"[3D] Migración cancelada: sin landmarks crudos para {', '.join(missing)}. "
+              f"Deben registrarse de nuevo antes de pasar a modo {mode}.")
+        return
+    backup_path = DB_PATH.replace(".pkl", f"_backup_{int(time.time())}.pkl")
+    if not save_database(db, backup_path):
+        print("[3D] No se pudo crear el respaldo. BD sin cambios.")
+        return
+    migrate_embeddings(db, mode)
+    if not save_database(db):
+        shutil.copyfile(backup_path, DB_PATH)
+        print("[3D] No se guardó la BD migrada. Se restaura el respaldo.")
+        return
+    params = {"embedding_mode": mode}
+    if mode == "3d":
+        thr = calibrate_threshold_3d(db)
+        if thr is not None:
+            DIST_FALLBACK_THRESHOLD_3D = params["dist_threshold_3d"] = round(thr, 3)
+        print(f"[3D] Umbral de fallback 3D: {DIST_FALLBACK_THRESHOLD_3D:.3f} (2D: {DIST_FALLBACK_THRESHOLD:.2f}).")
+    save_model_params(params)
+    EMBEDDING_MODE = mode
+    print(f"[3D] BD migrada a modo {mode} (respaldo en {backup_path}).")
+    train_and_save_model(db)
+
+# ---------------- Reproducción de video / imágenes ----------------
+def iter_replay_frames(source):
+    """Frames BGR de una cámara (índice), un archivo de video o un directorio de imágenes (orden alfabético)."""
+    if isinstance(source, str) and os.path.isdir(source):
+        for fn in sorted(os.listdir(source)):
+            if fn.lower().endswith((".jpg", ".jpeg", ".png", ".bmp")):
+                frame = cv2.imread(os.path.join(source, fn))
+                if frame is not None:
+                    yield frame
+        return
+    cap = cv2.VideoCapture(source)
+    try:
+        while True:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            yield frame
+    finally:
+        cap.release()
 
-            # ---- Guardar mejor coincidencia ----
-            if d < best_d:
-                best_d = d
-                best = name
+def benchmark_embedding_modes(source, db=None, modes=("2d", "3d")):
+    """
+    Reproduce `source` con cada modo de embedding y compara cuántas veces se cae al
+    fallback (el SVM no supera SVM_PROB_THRESHOLD) y cuántos frames tarda en confirmarse
+    cada identidad. El modelo y el índice de fallback de cada modo se entrenan en
+    memoria desde los landmarks crudos de la BD; FaceMesh corre una sola vez.
+    """
+    db = db if db is not None else load_database()
+    replay = []   # por frame: [(raw3d, yaw, bbox), ...], aspect
+    with mp_face_mesh.FaceMesh(static_image_mode=False, max_num_faces=5, refine_landmarks=True,
+                               min_detection_confidence=0.5, min_tracking_confidence=0.5) as face_mesh:
+        for frame in iter_replay_frames(source):
+            results = face_mesh.process(cv2.cvtColor(apply_clahe(frame), cv2.COLOR_BGR2RGB))
+            faces = results.multi_face_landmarks if results and results.multi_face_landmarks else []
+            poses = estimate_head_pose(faces, frame.shape)
+            h, w = frame.shape[:2]
+            replay.append(([(landmarks_3d(fl, frame.shape), poses[i][0], landmarks_bbox(fl, w, h))
+                            for i, fl in enumerate(faces)], w / float(h)))
+    if not replay:
+        print(f"[BENCH] No se pudieron leer frames de '{source}'.")
+        return {}
 
-    # ---- Validar umbral ----
-    if best is not None and best_d <= threshold:
-        similarity = 1 - min(best_d, 1)   # normaliza 0–1
-        return best, similarity
+    prev_template = dict(_CANONICAL_FACE)
+    report = {}
+    for mode in modes:
+        mdb = copy.deepcopy(db)
+        for name in migrate_embeddings(mdb, mode, template_path=None):
+            mdb.pop(name)   # sin landmarks crudos: sus vectores son de otro modo
+        X, y, _ = build_sample_matrix_from_db(mdb)
+        if X.size == 0 or len(set(y)) < 2:
+            print(f"[BENCH] Modo {mode}: no hay suficientes alumnos con landmarks crudos.")
+            continue
+        clf, scaler, pca = fit_model(X, y)
+        proj = build_fused_projection(scaler, pca)
+        index = FallbackIndex(mdb)
+        vote_buffers, first_seen, confirmed_at = {}, None, {}
+        n_faces = svm_hits = fallback_calls = 0
+        for fi, (faces, aspect) in enumerate(replay):
+            if faces and first_seen is None:
+                first_seen = fi
+            for raw3d, yaw, box in faces:
+                vec = embed_raw3d(raw3d, mode, aspect)
+                n_faces += 1
+                name, score = None, None
+                if vec.size == proj[0].shape[0]:
+                    label, score = classify_projected(clf, project_vectors(vec, proj))
+                    if score >= SVM_PROB_THRESHOLD:
+                        name = label
+                        svm_hits += 1
+                if name is None:
+                    fallback_calls += 1
+                    name, _ = index.match(vec, yaw=yaw, threshold=fallback_threshold(mode))
+                buf = vote_buffers.setdefault(get_center_key(*box), deque(maxlen=CONFIRM_FRAMES + 2))
+                buf.append((name or "Desconocido", score))
+                confirmed, _ = confirm_identity(list(buf))
+                if confirmed and confirmed not in confirmed_at:
+                    confirmed_at[confirmed] = fi - (first_seen or 0) + 1
+        report[mode] = {
+            "faces": n_faces,
+            "svm_hits": svm_hits,
+            "fallback_rate": fallback_calls / n_faces if n_faces else 0.0,
+            "confirm_frames": float(np.mean(list(confirmed_at.values()))) if confirmed_at else None,
+            "confirmed": confirmed_at,
+        }
+    _CANONICAL_FACE.update(prev_template)
 
-    return None, None
+    print(f"\n===== BENCHMARK EMBEDDINGS ({len(replay)} frames) =====")
+    for mode, r in report.items():
+        cf = f"{r['confirm_frames']:.1f}" if r["confirm_frames"] is not None else "-"
+        print(f"{mode}: rostros={r['faces']} | fallback={100 * r['fallback_rate']:.1f}% | "
+              f"frames hasta confirmar={cf} | identidades={len(r['confirmed'])}")
+    return report
 
-# ---------------- UI helper: draw label robusto ----------------
-def draw_detection_label(frame, bbox, name, registro="-", score=None):
+# ---------------- Índice de fallback particionado por pose ----------------
+class FallbackIndex:
     """
-    Dibuja una barra fija en la parte inferior y centrada con el nombre y registro.
-    No se relaciona con el bounding box; es global a la ventana.
+    Índice de vecino más cercano para el fallback, particionado por bin de pose
+    (frontal / derecha / izquierda). Cada bin guarda una matriz (n, d) con todas las
+    muestras y sus nombres; una sonda se compara solo con el bin de su yaw y los vecinos.
     """
-    h, w = frame.shape[:2]
+    BINS = ("frontal", "derecha", "izquierda")
+
+    def __init__(self, db):
+        self.bins = {}
+        self.dim = 0
+        self.build(db)
+
+    def build(self, db):
+        rows = {b: [] for b in self.BINS}
+        names = {b: [] for b in self.BINS}
+        for name, info in db.items():
+            samples = info.get("samples", {}) or {}
+            for ang in self.BINS:
+                arr = sample_rows(samples.get(ang))
+                if arr is None:
+                    continue
+                for v in arr:
+                    if not np.isnan(v).any():
+                        rows[ang].append(v)
+                        names[ang].append(name)
+        lens = Counter(v.size for b in self.BINS for v in rows[b])
+        self.dim = lens.most_common(1)[0][0] if lens else 0
+        self.bins = {}
+        for b in self.BINS:
+            # solo vectores de la longitud dominante: rellenar o recortar desalinea coordenadas
+            keep = [i for i, v in enumerate(rows[b]) if v.size == self.dim]
+            if keep:
+                M = np.vstack([rows[b][i] for i in keep])
+                self.bins[b] = (M, np.array(names[b])[keep])
+        return self
+
+    def __len__(self):
+        return sum(len(n) for _, n in self.bins.values())
+
+    @staticmethod
+    def route(yaw):
+        """Bins a consultar según el yaw de la sonda (su bin + vecinos cercanos)."""
+        if yaw is None:
+            return FallbackIndex.BINS
+        t = YAW_THRESHOLD_DEGREES
+        if yaw <= -t:
+            return ("derecha", "frontal")
+        if yaw >= t:
+            return ("izquierda", "frontal")
+        if yaw <= -t / 2:
+            return ("frontal", "derecha")
+        if yaw >= t / 2:
+            return ("frontal", "izquierda")
+        return ("frontal",)
+
+    def match(self, vec_norm, yaw=None, threshold=None):
+        """
+        Vecino más cercano (distancia euclidiana sobre el embedding normalizado, sin PCA)
+        en los bins de la pose. Retorna (nombre, 1 - distancia) si no supera el umbral,
+        o (None, None); una sonda de otra longitud que la BD no se compara.
+        """
+        if vec_norm is None or not self.bins:
+            return None, None
+        if threshold is None:
+            threshold = fallback_threshold()
+        v = np.asarray(vec_norm, dtype=float)
+        if v.size != self.dim or np.isnan(v).any():   # otra longitud = otro SELECTED_IDX / modo
+            return None, None
+        bins = [b for b in self.route(yaw) if b in self.bins]
+        if not bins:
+            bins = list(self.bins.keys())   # BD sin muestras para esa pose
+        best, best_d = None, float("inf")
+        for b in bins:
+            M, nms = self.bins[b]
+            d2 = np.einsum("ij,ij->i", M - v, M - v)
+            i = int(np.argmin(d2))
+            if d2[i] < best_d:
+                best_d, best = float(d2[i]), nms[i]
+        best_d = np.sqrt(best_d)
+        if best is not None and best_d <= threshold:
+            return str(best), 1 - min(best_d, 1)
+        return None, None
+# fin-FallbackIndex
 
-    # -------- Texto --------
+# ---------------- UI helper: draw label robusto ----------------
+_TEXT_SIZE_CACHE = {}   # (texto, escala, grosor) -> getTextSize
+
+def cached_text_size(text, scale=0.7, thickness=2):
+    """cv2.getTextSize con caché: las etiquetas se repiten frame a frame."""
+    key = (text, scale, thickness)
+    size = _TEXT_SIZE_CACHE.get(key)
+    if size is None:
+        if len(_TEXT_SIZE_CACHE) > 4096:
+            _TEXT_SIZE_CACHE.clear()
+        size = _TEXT_SIZE_CACHE[key] = cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, scale, thickness)
+    return size
+
+def detection_label(name, registro="-", score=None):
+    """Texto, color y medidas (ancho, alto) de la etiqueta de un rostro."""
     if name == "Desconocido":
         text = "Desconocido - presiona 'n' para registrar"
         color = (0, 255, 255)
-    else:
-        if score is not None:
-            text = f"{name} | {registro} ({score*100:.1f}%)"
-        else:
-            text = f"{name} | {registro}"
-        color = (255, 255, 255)
-
-    # Medidas del texto
-    (text_w, text_h), _ = cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, 0.7, 2)
-
-    # -------- Posición centrada en el borde inferior --------
-    box_width = text_w + 30
-    box_height = text_h + 20
-
-    x1 = (w - box_width) // 2
-    y1 = h - box_height - 10   # 10px arriba del borde inferior
-    x2 = x1 + box_width
-    y2 = y1 + box_height
-
-    # -------- Dibujar fondo con transparencia --------
-    overlay = frame.copy()
-    cv2.rectangle(overlay, (x1, y1), (x2, y2), (0, 0, 0), -1)
-    cv2.addWeighted(overlay, 0.45, frame, 0.55, 0, frame)
-
-    # -------- Dibujar texto centrado --------
-    text_x = x1 + (box_width - text_w) // 2
-    text_y = y1 + (box_height + text_h) // 2 - 5
-
-    cv2.putText(
-        frame, text, 
-        (text_x, text_y),
-        cv2.FONT_HERSHEY_SIMPLEX,
-        0.7,
-        color,
-        2
-    )
+        (text_w, text_h), _ = cached_text_size(text)
+        return text, color, text_w, text_h
+
+    text = f"{name} | {registro}"
+    color = (255, 255, 255)
+    (text_w, text_h), _ = cached_text_size(text)
+    if score is not None:
+        # el porcentaje cambia cada frame: se mide aparte (solo hay ~1000 sufijos posibles)
+        suffix = f" ({score*100:.1f}%)"
+        (suffix_w, _), _ = cached_text_size(suffix)
+        text += suffix
+        text_w += suffix_w - 2   # los anchos Hershey se suman salvo el grosor del trazo
+    return text, color, text_w, text_h
+
+def draw_detection_labels(frame, labels):
+    """
+    Dibuja en una sola pasada las etiquetas de todos los rostros del frame: barras
+    centradas apiladas desde el borde inferior. El fondo semitransparente se mezcla
+    solo dentro de cada barra, sin copiar el frame completo.
+    `labels` es una lista de tuplas de detection_label().
+    """
+    h, w = frame.shape[:2]
+    bottom = h - 10   # 10px arriba del borde inferior
+    for text, color, text_w, text_h in labels:
+        box_width = text_w + 30
+        box_height = text_h + 20
+        x1 = (w - box_width) // 2
+        y1 = bottom - box_height
+        if y1 < 0:
+            break
 
-    return frame
+        # -------- Fondo con transparencia (45 % negro) solo en el ROI --------
+        roi = frame[y1:bottom + 1, max(x1, 0):x1 + box_width + 1]
+        frame[y1:bottom + 1, max(x1, 0):x1 + box_width + 1] = cv2.convertScaleAbs(roi, alpha=0.55)
 
-    # fin del draw_detection_label
+        # -------- Texto centrado --------
+        text_x = x1 + (box_width - text_w) // 2
+        text_y = y1 + (box_height + text_h) // 2 - 5
+        cv2.putText(frame, text, (text_x, text_y), cv2.FONT_HERSHEY_SIMPLEX, 0.7, color, 2)
+
+        bottom = y1 - 4   # la siguiente barra va encima
+    return frame
 
-# ---------------- Capture 3 angles new person (with yaw validation + retries) ----------------
-def capture_three_angles_new_person(name, cap, face_mesh, seconds=CAPTURE_SECONDS_PER_ANGLE, max_retries_per_angle=2):
-    win = "Registro 3 ángulos"
-    angles = ["frontal", "derecha", "izquierda"]
-    collected = {}
-    try:
-        for angle in angles:
-            retries = 0
-            while retries <= max_retries_per_angle:
-                print(f"[Registro] Prepárate: {angle} - presiona 'c' para comenzar ({seconds}s). Intento {retries+1}/{max_retries_per_angle+1}")
-                # esperar 'c'
-                started = False
-                while True:
-                    ret, frame = cap.read()
-                    if not ret:
-                        try: cv2.destroyWindow(win) 
-                        except: pass
-                        return None
-                    disp = frame.copy()
-                    cv2.putText(disp, f"Preparado: {angle} - presiona 'c' (Captura {retries+1})", (10,30), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0,255,255), 2)
-                    cv2.imshow(win, disp)
-                    k = cv2.waitKey(1) & 0xFF
-                    if k == ord('c'):
-                        started = True
-                        break
-                    if k == 27:
-                        try: cv2.destroyWindow(win)
-                        except: pass
-                        return None
-                if not started:
-                    retries += 1
-                    continue
-                t0 = time.time()
-                vecs = []
-                while time.time() - t0 < seconds:
-                    ret, frame = cap.read()
-                    if not ret: break
-                    rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                    try:
-                        results = face_mesh.process(rgb)
-                    except Exception as e:
-                        print("[FaceMesh] Error durante process():", e)
-                        results = None
-                    disp = frame.copy()
-                    elapsed = int(time.time()-t0)
-                    cv2.putText(disp, f"Capturando {angle}: {elapsed}s/{seconds}s", (10,30), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0,255,0), 2)
-                    if results and getattr(results, 'multi_face_landmarks', None):
-                        fl = results.multi_face_landmarks[0]
-                        yaw = estimate_yaw_deg(fl)
-                        accept = True
-                        if angle == "derecha" and yaw > -YAW_THRESHOLD_DEGREES:
-                            accept = False
-                        if angle == "izquierda" and yaw < YAW_THRESHOLD_DEGREES:
-                            accept = False
-                        if accept:
-                            raw = extract_selected_landmarks(fl)
-                            vec_norm = normalize_vector(raw)
-                            vecs.append(vec_norm)
-                            xs = [lm.x for lm in fl.landmark]
-                            ys = [lm.y for lm in fl.landmark]
-                            h, w = frame.shape[:2]
-                            x1 = max(int(min(xs)*w)-10, 0)
-                            y1 = max(int(min(ys)*h)-10, 0)
-                            x2 = min(int(max(xs)*w)+10, w-1)
-                            y2 = min(int(max(ys)*h)+10, h-1)
-                            cv2.rectangle(disp, (x1,y1), (x2,y2), DRAW_BOX_COLOR, 2)
-                            cv2.putText(disp, f"Yaw {yaw:.1f}deg", (x1, y2+20), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (200,200,200), 2)
-                        else:
-                            cv2.putText(disp, f"Pose no adecuada (yaw {yaw:.1f}deg)", (10,60), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0,0,255), 2)
-                    cv2.imshow(win, disp)
-                    if cv2.waitKey(1) & 0xFF == 27:
-                        try: cv2.destroyWindow(win)
-                        except: pass
-                        return None
-                if len(vecs) == 0:
-                    print(f"[Registro] No se obtuvieron frames válidos para ángulo {angle} en intento {retries+1}. Reintentando...")
-                    retries += 1
-                    time.sleep(0.3)
-                    continue
-                collected[angle] = np.mean(np.stack(vecs), axis=0)
-                print(f"[Registro] Ángulo {angle} completado ({len(vecs)} frames válidos).")
-                break
-            else:
-                # si agotamos reintentos para este ángulo
-                print(f"[Registro] Fallaron todos los intentos para ángulo {angle}. Cancelando registro.")
-                try: cv2.destroyWindow(win)
-                except: pass
-                return None
-        try: cv2.destroyWindow(win)
-        except: pass
-        return collected
-    except Exception as e:
-        print("[Registro] Error durante captura:", e)
-        try: cv2.destroyWindow(win)
-        except: pass
-        return None
-    # fin-capture_three_angles_new_person
-    
 # ---------------- Small helpers --------------------
 def apply_clahe(frame):
     """Aplica CLAHE sobre la luminancia para condiciones bajas de luz."""
@@ -1227,37 +3253,244 @@ def apply_clahe(frame):
     except Exception:
         return frame.copy()
 
-def capture_more_samples(name, cap, face_mesh, target_n=MORE_SAMPLES_COUNT, timeout_sec=20):
+def landmarks_bbox(fl, w, h, margin=10):
+    """Bounding box en píxeles (x1, y1, x2, y2) de los landmarks de un rostro."""
+    xs = [lm.x for lm in fl.landmark]
+    ys = [lm.y for lm in fl.landmark]
+    x1 = max(int(min(xs) * w) - margin, 0)
+    y1 = max(int(min(ys) * h) - margin, 0)
+    x2 = min(int(max(xs) * w) + margin, w - 1)
+    y2 = min(int(max(ys) * h) + margin, h - 1)
+    return x1, y1, x2, y2
+
+# ---------------- Registro no bloqueante (máquina de estados) ----------------
+class RegistrationSession:
     """
-    Captura target_n vectores válidos (no por ángulo; útil para inicializar rápidamente).
-    Devuelve dict samples con 'frontal' promedio (y deja 'derecha'/'izquierda' None).
+    Registro de un alumno paso a paso dentro del loop principal.
+    El loop llama step() una vez por frame con los rostros de SU pasada de FaceMesh,
+    por lo que los demás rostros se siguen reconociendo durante el registro.
+
+    Fases: 'multi' (muestras rápidas, opcional) -> por ángulo 'wait' (espera 'c')
+           -> 'capture' (seconds) ... -> 'done' | 'cancelled'
     """
-    t0 = time.time()
-    vecs = []
-    print(f"[Registro-Multi] Capturando hasta {target_n} vectores válidos para {name} (timeout {timeout_sec}s)")
-    while len(vecs) < target_n and (time.time() - t0) < timeout_sec:
-        ret, frame = cap.read()
-        if not ret:
-            break
-        rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        try:
-            results = face_mesh.process(rgb)
-        except Exception as e:
-            results = None
-        if results and getattr(results, "multi_face_landmarks", None):
-            fl = results.multi_face_landmarks[0]
-            raw = extract_selected_landmarks(fl)
-            vec_norm = normalize_vector(raw)
-            if vec_norm is not None:
-                vecs.append(vec_norm)
-        # pequeña pausa para no saturar
-        cv2.waitKey(5)
-    if len(vecs) == 0:
-        print("[Registro-Multi] No se obtuvieron vectores válidos.")
-        return None
-    avg = np.mean(np.stack(vecs), axis=0)
-    print(f"[Registro-Multi] Capturados {len(vecs)} vectores. Promediando y guardando como 'frontal'.")
-    return {"frontal": avg, "derecha": None, "izquierda": None}
+    ANGLES = ("frontal", "derecha", "izquierda")
+
+    def __init__(self, name, registro, group, subject, seconds=CAPTURE_SECONDS_PER_ANGLE,
+                 max_retries_per_angle=2, more_samples=MORE_SAMPLES_ON_REGISTER,
+                 target_n=MORE_SAMPLES_COUNT, multi_timeout=20):
+        self.name = name
+        self.registro = registro
+        self.group = group
+        self.subject = subject
+        self.seconds = seconds
+        self.max_retries = max_retries_per_angle
+        self.target_n = target_n
+        self.multi_timeout = multi_timeout
+        self.phase = "multi" if more_samples else "wait"
+        self.angle_i = 0
+        self.retries = 0
+        self.vecs = []
+        self.raws = []          # landmarks 3D crudos de cada vector (para migrar embeddings)
+        self.t0 = time.time()
+        self.collected = {}
+        self.collected_raw = {}
+        self.extra = None
+        self.extra_raw = None
+        self.aspect = None
+        self.face_idx = None
+        self.track_box = None   # bbox del rostro fijado en multi/captura (None = sin fijar)
+        self.lost = False
+        self.last_yaw = None
+        self.last_accept = False
+        self.prev_pts = None
+        self.last_quality = None
+
+    @property
+    def angle(self):
+        return self.ANGLES[min(self.angle_i, len(self.ANGLES) - 1)]
+
+    @property
+    def finished(self):
+        return self.phase in ("done", "cancelled")
+
+    def handle_key(self, k):
+        """'c' inicia la captura del ángulo actual; ESC cancela el registro."""
+        if k == 27:
+            print("[Registro] Cancelado por el usuario.")
+            self.phase = "cancelled"
+        elif k == ord('c') and self.phase == "wait":
+            self.phase = "capture"
+            self.t0 = time.time()
+            self.vecs = []
+            self.raws = []
+            self.prev_pts = None   # el jitter se mide desde el primer frame de la captura
+            self.track_box = None  # se fija el rostro más grande del siguiente frame
+
+    def _select_face(self, faces, w, h):
+        """
+        El rostro a registrar. En 'multi' y 'capture' se fija el más grande al empezar y
+        luego se sigue por IoU con su bbox anterior: si otro alumno se acerca más a la
+        cámara no se mezclan sus landmarks. Si el fijado se pierde, None (frame descartado).
+        Fuera de captura es simplemente el más grande.
+        """
+        if not faces:
+            self.lost = self.track_box is not None
+            return None
+        boxes = [landmarks_bbox(fl, w, h) for fl in faces]
+        if self.phase not in ("multi", "capture"):
+            self.track_box = None
+            return int(np.argmax([(x2 - x1) * (y2 - y1) for x1, y1, x2, y2 in boxes]))
+        if self.track_box is None:
+            i = int(np.argmax([(x2 - x1) * (y2 - y1) for x1, y1, x2, y2 in boxes]))
+        else:
+            ious = [bbox_iou(self.track_box, b) for b in boxes]
+            i = int(np.argmax(ious))
+            if ious[i] < REG_TRACK_MIN_IOU:
+                self.lost = True
+                return None
+        self.track_box, self.lost = boxes[i], False
+        return i
+
+    def _quality_ok(self, gray, fl, pose):
+        """Descarta frames borrosos, pequeños, inclinados o inestables."""
+        if gray is None:
+            return True
+        self.last_quality, self.prev_pts = face_quality(gray, fl, self.prev_pts, pose)
+        return self.last_quality["ok"]
+
+    def _add_sample(self, fl, frame_shape):
+        raw3d = landmarks_3d(fl, frame_shape)
+        self.aspect = frame_shape[1] / float(frame_shape[0])
+        self.vecs.append(embed_raw3d(raw3d, aspect=self.aspect))
+        self.raws.append(raw3d)
+
+    def step(self, faces, frame_shape, gray=None, poses=None):
+        """
+        Avanza un frame. Retorna el índice del rostro usado para el registro
+        (el loop no lo clasifica) o None. Con gray se aplica el filtro de calidad;
+        poses son las de estimate_head_pose para faces (se calculan si faltan).
+        """
+        if self.finished:
+            return None
+        h, w = frame_shape[:2]
+        now = time.time()
+        self.face_idx = self._select_face(faces, w, h)
+        fl = faces[self.face_idx] if self.face_idx is not None else None
+        if fl is None:
+            self.prev_pts = None
+        else:
+            if poses is None:
+                poses = estimate_head_pose(faces, frame_shape)
+            pose = poses[self.face_idx]
+        # calidad en todo frame capturable (también los que el yaw rechaza): así prev_pts
+        # siempre es el frame anterior y el jitter no compara contra uno de hace segundos
+        quality_ok = fl is not None and self.phase in ("multi", "capture") and self._quality_ok(gray, fl, pose)
+
+        if self.phase == "multi":
+            if quality_ok:
+                self._add_sample(fl, frame_shape)
+            if len(self.vecs) >= self.target_n or now - self.t0 >= self.multi_timeout:
+                if self.vecs:
+                    kept, idx = farthest_point_sampling(np.stack(self.vecs), MAX_SAMPLES_PER_ANGLE, return_index=True)
+                    self.extra = kept
+                    self.extra_raw = np.stack(self.raws)[idx]
+                    print(f"[Registro-Multi] Capturados {len(self.vecs)} vectores, {len(kept)} muestras diversas.")
+                self.vecs = []
+                self.raws = []
+                self.phase = "wait"
+                print(f"[Registro] Prepárate: {self.angle} - presiona 'c' para comenzar ({self.seconds}s).")
+
+        elif self.phase == "capture":
+            if fl is not None:
+                yaw = float(pose[0])
+                accept = True
+                if self.angle == "derecha" and yaw > -YAW_THRESHOLD_DEGREES:
+                    accept = False
+                if self.angle == "izquierda" and yaw < YAW_THRESHOLD_DEGREES:
+                    accept = False
+                if accept and quality_ok:
+                    self._add_sample(fl, frame_shape)
+                self.last_yaw, self.last_accept = yaw, accept
+            if now - self.t0 >= self.seconds:
+                self._finish_angle()
+        return self.face_idx
+
+    def _finish_angle(self):
+        if len(self.vecs) == 0:
+            self.retries += 1
+            if self.retries > self.max_retries:
+                print(f"[Registro] Fallaron todos los intentos para ángulo {self.angle}. Cancelando registro.")
+                self.phase = "cancelled"
+            else:
+                print(f"[Registro] No se obtuvieron frames válidos para ángulo {self.angle}. Reintentando...")
+                self.phase = "wait"
+            return
+        kept, idx = farthest_point_sampling(np.stack(self.vecs), MAX_SAMPLES_PER_ANGLE, return_index=True)
+        self.collected[self.angle] = kept
+        self.collected_raw[self.angle] = np.stack(self.raws)[idx]
+        print(f"[Registro] Ángulo {self.angle} completado ({len(self.vecs)} frames válidos, {len(kept)} muestras guardadas).")
+        self.vecs = []
+        self.raws = []
+        self.retries = 0
+        self.angle_i += 1
+        if self.angle_i >= len(self.ANGLES):
+            self.phase = "done"
+        else:
+            self.phase = "wait"
+            print(f"[Registro] Prepárate: {self.angle} - presiona 'c' para comenzar ({self.seconds}s).")
+
+    def samples(self):
+        """
+        Muestras finales (ángulos + muestras rápidas en 'frontal') o None si no terminó bien.
+        Los landmarks crudos correspondientes quedan en self.raw_samples.
+        """
+        if self.phase != "done":
+            return None
+        samples = dict(self.collected)
+        self.raw_samples = dict(self.collected_raw)
+        if self.extra is not None and samples.get("frontal") is not None:
+            V = np.vstack([samples["frontal"], self.extra])
+            R = np.vstack([self.raw_samples["frontal"], self.extra_raw])
+            kept, idx = farthest_point_sampling(V, MAX_SAMPLES_PER_ANGLE, return_index=True)
+            samples["frontal"], self.raw_samples["frontal"] = kept, R[idx]
+        return samples
+
+    def draw(self, display, faces):
+        h, w = display.shape[:2]
+        if self.phase == "multi":
+            txt, color = f"Registro {self.name}: muestras {len(self.vecs)}/{self.target_n}", (0, 255, 0)
+        elif self.phase == "wait":
+            txt, color = f"Registro {self.name}: {self.angle} - presiona 'c' (ESC cancela)", (0, 255, 255)
+        elif self.phase == "capture":
+            elapsed = int(time.time() - self.t0)
+            txt, color = f"Capturando {self.angle}: {elapsed}s/{self.seconds}s", (0, 255, 0)
+        else:
+            return display
+        cv2.putText(display, txt, (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.7, color, 2)
+        if self.lost:
+            cv2.putText(display, "Rostro en registro perdido: vuelva a su lugar", (10, 60), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 0, 255), 2)
+        if self.face_idx is not None and self.face_idx < len(faces):
+            x1, y1, x2, y2 = landmarks_bbox(faces[self.face_idx], w, h)
+            cv2.rectangle(display, (x1, y1), (x2, y2), DRAW_BOX_COLOR, 2)
+            if self.phase == "capture" and self.last_yaw is not None:
+                if self.last_accept:
+                    cv2.putText(display, f"Yaw {self.last_yaw:.1f}deg", (x1, y2 + 20), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (200, 200, 200), 2)
+                else:
+                    cv2.putText(display, f"Pose no adecuada (yaw {self.last_yaw:.1f}deg)", (10, 60), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 0, 255), 2)
+            if self.last_quality is not None and not self.last_quality["ok"]:
+                cv2.putText(display, "Calidad baja (enfoque / distancia / pose)", (10, 90), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 0, 255), 2)
+        return display
+# fin-RegistrationSession
+
+def bbox_iou(a, b):
+    """Intersección sobre unión de dos bbox (x1, y1, x2, y2)."""
+    iw = min(a[2], b[2]) - max(a[0], b[0])
+    ih = min(a[3], b[3]) - max(a[1], b[1])
+    if iw <= 0 or ih <= 0:
+        return 0.0
+    inter = iw * ih
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+    return inter / union if union > 0 else 0.0
 
 def get_center_key(x1, y1, x2, y2, grid=60):
     """
@@ -1293,20 +3526,614 @@ def confirm_identity(buff):
 # --------------------------------------------------
 
 
+# ---------------- Instrumentación por etapa ----------------
+class StageProfiler:
+    """
+    Duraciones por etapa (perf_counter_ns) en ventanas móviles de PROFILE_WINDOW
+    muestras. add() solo hace un append a un deque; percentiles e histogramas se
+    calculan al pedir el resumen (overlay, volcado a disco o benchmark).
+    """
+    def __init__(self, window=PROFILE_WINDOW, dump_path=PROFILE_DUMP_PATH, dump_seconds=PROFILE_DUMP_SECONDS):
+        self.window = window     # None = sin límite (benchmark)
+        self.samples = {}        # etapa -> deque de ns
+        self.totals = {}         # etapa -> [muestras, suma de ns] acumulados (no se recortan con la ventana)
+        self.dump_path = dump_path
+        self.dump_seconds = dump_seconds
+        self.last_dump = time.monotonic()
+        self._overlay = ([], 0.0)   # (líneas, instante) para no recalcular en cada frame
+
+    def add(self, stage, ns):
+        buf = self.samples.get(stage)
+        if buf is None:
+            buf = self.samples[stage] = deque(maxlen=self.window)
+            self.totals[stage] = [0, 0]
+        buf.append(ns)
+        tot = self.totals[stage]
+        tot[0] += 1
+        tot[1] += ns
+
+    def summary(self, stage):
+        """n, p50, p90, p99, media y máximo en ms, más el histograma por buckets."""
+        buf = self.samples.get(stage)
+        if not buf:
+            return None
+        a = np.array(tuple(buf), dtype=np.int64) / 1e6   # tuple(): copia atómica (lectura desde otro hilo)
+        p50, p90, p99 = np.percentile(a, [50, 90, 99])
+        edges = np.asarray(PROFILE_HIST_EDGES_US) / 1000.0
+        counts = np.bincount(np.searchsorted(edges, a), minlength=len(edges) + 1)
+        hist = {f"<={e}us": int(c) for e, c in zip(PROFILE_HIST_EDGES_US, counts)}
+        hist[f">{PROFILE_HIST_EDGES_US[-1]}us"] = int(counts[-1])
+        return {"n": int(a.size), "p50": float(p50), "p90": float(p90), "p99": float(p99),
+                "mean": float(a.mean()), "max": float(a.max()), "hist": hist}
+
+    def report(self):
+        return {st: self.summary(st) for st, buf in list(self.samples.items()) if buf}
+
+    def draw(self, display, refresh=0.5):
+        """Overlay compacto (esquina superior izquierda) con p50/p90 por etapa."""
+        lines, ts = self._overlay
+        now = time.monotonic()
+        if now - ts > refresh:
+            lines = []
+            for st, r in self.report().items():
+                lines.append(f"{st:<13}{r['p50']:6.1f}{r['p90']:7.1f} ms")
+            frame = self.summary("frame")
+            if frame and frame["mean"] > 0:
+                lines.append(f"FPS {1000.0 / frame['mean']:.1f}")
+            self._overlay = (lines, now)
+        for i, txt in enumerate(lines):
+            cv2.putText(display, txt, (8, 18 + 16 * i), cv2.FONT_HERSHEY_PLAIN, 1.0, (0, 255, 255), 1, cv2.LINE_AA)
+
+    def maybe_dump(self):
+        """Vuelca el resumen si pasaron dump_seconds desde el último volcado."""
+        if not self.dump_seconds or not self.dump_path:
+            return
+        now = time.monotonic()
+        if now - self.last_dump >= self.dump_seconds:
+            self.last_dump = now
+            self.dump()
+
+    def dump(self, path=None):
+        path = path or self.dump_path
+        report = self.report()
+        ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        try:
+            if path.endswith(".csv"):
+                rows = [dict({"timestamp": ts, "etapa": st}, **{k: v for k, v in r.items() if k != "hist"}, **r["hist"])
+                        for st, r in report.items()]
+                pd.DataFrame(rows).to_csv(path, mode="a", header=not os.path.exists(path), index=False)
+            else:
+                with open(path, "w", encoding="utf-8") as f:
+                    json.dump({"timestamp": ts, "window": self.window, "stages": report}, f, indent=2, ensure_ascii=False)
+        except Exception as e:
+            print(f"[PERF] Error guardando {path}: {e}")
+# fin-StageProfiler
+
+# ---------------- Métricas del kiosco (formato Prometheus) ----------------
+class KioskMetrics:
+    """
+    Contadores y gauges del loop de reconocimiento. El loop es el único escritor y solo
+    hace sumas sobre atributos (sin locks); el hilo HTTP los lee al generar /metrics,
+    así que un scrape puede ver un frame a medias, nunca un valor corrupto.
+    """
+    def __init__(self, db, profiler=None):
+        self.db = db
+        self.profiler = profiler        # latencias por etapa (StageProfiler o None)
+        self.frames = 0
+        self.faces = 0
+        self.faces_last_frame = 0
+        self.svm_hits = 0
+        self.fallback_hits = 0
+        self.unknown = 0
+        self.low_quality = 0
+        self.attendance_writes = 0
+        self.retrains = 0
+        self.retrain_seconds = 0.0
+        self.queue_depth = None         # callable -> int (cola de escritura de asistencias)
+        self.frame_interval_ns = 0.0    # EMA del intervalo entre frames
+        self._last_frame_ns = 0
+
+    def frame(self, n_faces):
+        now = time.perf_counter_ns()
+        if self._last_frame_ns:
+            dt = now - self._last_frame_ns
+            self.frame_interval_ns = dt if not self.frame_interval_ns else 0.9 * self.frame_interval_ns + 0.1 * dt
+        self._last_frame_ns = now
+        self.frames += 1
+        self.faces += n_faces
+        self.faces_last_frame = n_faces
+
+    def detection(self, det):
+        if not det["ok"]:
+            self.low_quality += 1
+        elif det["d_fallback"] is not None:
+            self.fallback_hits += 1
+        elif det["name_pred"] is not None:
+            self.svm_hits += 1
+        else:
+            self.unknown += 1
+
+    def render(self):
+        """Texto en formato de exposición de Prometheus (version 0.0.4)."""
+        lines = []
+
+        def metric(name, kind, help_txt, value, labels=None):
+            if kind:
+                lines.append(f"# HELP asistencia_{name} {help_txt}")
+                lines.append(f"# TYPE asistencia_{name} {kind}")
+            lbl = "{" + ",".join(f'{k}="{v}"' for k, v in labels.items()) + "}" if labels else ""
+            lines.append(f"asistencia_{name}{lbl} {value}")
+
+        fps = 1e9 / self.frame_interval_ns if self.frame_interval_ns else 0.0
+        hits = self.svm_hits + self.fallback_hits
+        metric("fps", "gauge", "Frames por segundo (media móvil).", f"{fps:.2f}")
+        metric("frames_total", "counter", "Frames procesados.", self.frames)
+        metric("faces_total", "counter", "Rostros detectados.", self.faces)
+        metric("faces_per_frame", "gauge", "Rostros en el último frame.", self.faces_last_frame)
+        metric("recognitions_total", "counter", "Rostros clasificados por origen.", self.svm_hits, {"source": "svm"})
+        metric("recognitions_total", None, "", self.fallback_hits, {"source": "fallback"})
+        metric("recognitions_total", None, "", self.unknown, {"source": "desconocido"})
+        metric("recognitions_total", None, "", self.low_quality, {"source": "baja_calidad"})
+        metric("svm_hit_ratio", "gauge", "Fracción de reconocimientos resueltos por el SVM.",
+               f"{self.svm_hits / hits:.4f}" if hits else "0")
+        metric("attendance_writes_total", "counter", "Entradas/salidas escritas.", self.attendance_writes)
+        depth = self.queue_depth() if self.queue_depth else 0
+        metric("attendance_queue_depth", "gauge", "Escrituras de asistencia pendientes.", depth)
+        metric("retrains_total", "counter", "Reentrenamientos del modelo.", self.retrains)
+        metric("retrain_duration_seconds", "gauge", "Duración del último reentrenamiento.", f"{self.retrain_seconds:.3f}")
+        metric("db_people", "gauge", "Alumnos en la base local.", len(self.db))
+        metric("db_bytes", "gauge", "Tamaño del archivo de la base local.",
+               os.path.getsize(DB_PATH) if os.path.exists(DB_PATH) else 0)
+        if self.profiler is not None:
+            first = True
+            for stage, r in self.profiler.report().items():
+                for q, key in (("0.5", "p50"), ("0.9", "p90"), ("0.99", "p99")):
+                    metric("stage_latency_ms", "summary" if first else None,
+                           "Latencia por etapa (cuantiles de la ventana móvil; _sum y _count acumulados).",
+                           f"{r[key]:.3f}", {"stage": stage, "quantile": q})
+                    first = False
+                n, total_ns = self.profiler.totals.get(stage, (0, 0))
+                metric("stage_latency_ms_sum", None, "", f"{total_ns / 1e6:.3f}", {"stage": stage})
+                metric("stage_latency_ms_count", None, "", n, {"stage": stage})
+        return "\n".join(lines) + "\n"
+# fin-KioskMetrics
+
+def start_metrics_server(metrics, host=METRICS_HOST, port=METRICS_PORT):
+    """Sirve GET /metrics en un hilo daemon. Retorna el servidor (server.shutdown() lo detiene) o None."""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass   # sin una línea por scrape en consola
+
+    try:
+        server = ThreadingHTTPServer((host, port), Handler)
+    except OSError as e:
+        print(f"[METRICS] No se pudo abrir {host}:{port}: {e}")
+        return None
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"[METRICS] Métricas en http://{host}:{port}/metrics")
+    return server
+
+# ---------------- Etapas por frame (webcam y reproducción) ----------------
+class FrameRecognizer:
+    """
+    Etapas del reconocimiento por frame: preproceso (CLAHE) -> FaceMesh -> calidad ->
+    embedding -> clasificación (SVM + fallback) -> votación. recognition_loop y
+    benchmark_pipeline usan esta misma clase, así que el benchmark mide el mismo código.
+    Con un StageProfiler en `profiler` cada etapa registra su duración; sin él, record()
+    retorna de inmediato.
+    """
+    STAGES = ("preproceso", "facemesh", "calidad", "embedding", "svm", "fallback", "votacion",
+              "dibujo", "asistencia", "pantalla", "frame")
+
+    def __init__(self, db, clf=None, scaler=None, pca=None, profiler=None):
+        self.db = db
+        self.fb_index = FallbackIndex(db)
+        self.set_model(clf, scaler, pca)
+        self.vote_buffers = {}   # key espacial -> deque de últimas predicciones [(name, score), ...]
+        self.quality_pts = {}    # key espacial -> landmarks del frame anterior (jitter)
+        self.last_raw_vec = None
+        self.profiler = profiler
+
+    def set_model(self, clf, scaler, pca):
+        self.clf = clf
+        self.proj = build_fused_projection(scaler, pca) if clf is not None else None
+
+    def record(self, stage, t0):
+        """Anota la duración de `stage` desde t0 (ns) y devuelve el instante actual."""
+        if self.profiler is None:
+            return 0
+        t1 = time.perf_counter_ns()
+        self.profiler.add(stage, t1 - t0)
+        return t1
+
+    def clock(self):
+        return time.perf_counter_ns() if self.profiler is not None else 0
+
+    def detect(self, frame, face_mesh):
+        """Preproceso + FaceMesh. Retorna (faces, gray, poses)."""
+        t0 = self.clock()
+        # preprocesado (CLAHE) para baja luz
+        rgb = cv2.cvtColor(apply_clahe(frame), cv2.COLOR_BGR2RGB)
+        t0 = self.record("preproceso", t0)
+        try:
+            results = face_mesh.process(rgb)
+        except Exception as e:
+            print("[FaceMesh] Error en process():", e)
+            results = None
+        faces = results.multi_face_landmarks if results and getattr(results, 'multi_face_landmarks', None) else []
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if faces else None
+        poses = estimate_head_pose(faces, frame.shape)   # yaw/pitch/roll de todos los rostros
+        self.record("facemesh", t0)
+        if not faces:
+            self.quality_pts.clear()
+        return faces, gray, poses
+
+    def recognize(self, frame, faces, gray, poses, skip_idx=None):
+        """
+        Clasifica cada rostro (salvo `skip_idx`, el que está en registro) y lo vota.
+        Retorna una lista de dicts: bbox, ok (pasó el filtro de calidad), name_pred,
+        score_pred, d_fallback, label (sin confirmar), confirmed y confirmed_score.
+        """
+        detections = []
+        h, w = frame.shape[:2]
+        for face_i, fl in enumerate(faces):
+            if face_i == skip_idx:
+                continue
+            x1, y1, x2, y2 = landmarks_bbox(fl, w, h)
+            det = {"bbox": (x1, y1, x2, y2), "ok": True, "name_pred": None, "score_pred": None, "d_fallback": None,
+                   "label": "Desconocido", "confirmed": None, "confirmed_score": None}
+            t0 = self.clock()
+
+            # filtro de calidad: no gastar SVM/fallback en frames malos
+            if QUALITY_GATE_RECOGNITION:
+                qkey = get_center_key(x1, y1, x2, y2)
+                quality, self.quality_pts[qkey] = face_quality(gray, fl, self.quality_pts.get(qkey), poses[face_i])
+                t0 = self.record("calidad", t0)
+                if not quality["ok"]:
+                    det["ok"] = False
+                    detections.append(det)
+                    continue
+
+            # vector del rostro con suavizado EMA
+            raw_vec = landmarks_3d(fl, frame.shape)
+            if self.last_raw_vec is None:
+                smooth_raw = raw_vec
+            else:
+                smooth_raw = SMOOTH_ALPHA * raw_vec + (1.0 - SMOOTH_ALPHA) * self.last_raw_vec
+            self.last_raw_vec = smooth_raw.copy()
+            vec_norm = embed_raw3d(smooth_raw, aspect=w / float(h))
+            t0 = self.record("embedding", t0)
+            if vec_norm is None:
+                continue
+
+            # SVM y, si no confirma, fallback por distancia
+            name_pred = score_pred = d_fallback = None
+            if self.clf is not None and self.proj is not None:
+                try:
+                    if vec_norm.size == self.proj[0].shape[0]:
+                        label_svm, score_pred = classify_projected(self.clf, project_vectors(vec_norm, self.proj))
+                        if score_pred >= SVM_PROB_THRESHOLD:
+                            name_pred = label_svm
+                except Exception as e:
+                    print("[MODEL] Error predict:", e)
+                    name_pred = None
+                t0 = self.record("svm", t0)
+            if name_pred is None:
+                fmatch, d_tmp = self.fb_index.match(vec_norm, yaw=poses[face_i][0], threshold=fallback_threshold())
+                if fmatch:
+                    name_pred = fmatch
+                    d_fallback = d_tmp
+                    score_pred = max(score_pred or 0.0, 1.0 - d_tmp)
+                t0 = self.record("fallback", t0)
+
+            # voting key (coarse spatial key to follow same face)
+            label = name_pred if name_pred is not None else "Desconocido"
+            buf = self.vote_buffers.setdefault(get_center_key(x1, y1, x2, y2), deque(maxlen=CONFIRM_FRAMES + 2))
+            buf.append((label, score_pred))
+            confirmed, confirmed_score = confirm_identity(list(buf))
+            self.record("votacion", t0)
+
+            det.update(name_pred=name_pred, score_pred=score_pred, d_fallback=d_fallback, label=label,
+                       confirmed=confirmed, confirmed_score=confirmed_score)
+            detections.append(det)
+        return detections
+# fin-FrameRecognizer
+
+ATTENDANCE_WRITTEN = ("entrada_ok", "salida_ok")   # códigos que sí escribieron una fila
+
+def new_session_state(db, label, subject=None):
+    """Estado de asistencia inicial de un alumno en la sesión."""
+    return {
+        "entry_marked": False,
+        "exit_marked": False,
+        "entry_time": None,
+        "last_seen": 0,
+        "subject_session": subject,
+        "registro_session": db.get(label, {}).get("registro", "-")
+    }
+
+def attendance_step(label, db, state, now_ts, path=EXCEL_PATH):
+    """
+    Control de entrada/salida de un rostro confirmado que ya tiene materia de sesión.
+    Retorna el código de add_or_update_attendance ("entrada_ok", "salida_duplicada", ...)
+    o None si en este frame no se intentó registrar nada.
+    """
+    st = state[label]
+    # debounce: evitar múltiples registros por frames muy seguidos
+    if now_ts - st.get("last_seen", 0) < 1.2:
+        st["last_seen"] = now_ts
+        return None
+
+    event = None
+    # registrar entrada (si no hay)
+    if not st.get("entry_marked", False):
+        event = registrar_entrada(label, db, state, path=path)
+        st["entry_marked"] = True
+        st["entry_time"] = now_ts
+        print(f"[ENTRY] {label}: entrada marcada")
+
+    # si ya había entrada y no salida -> intentar marcar salida si pasó tiempo
+    elif st.get("entry_marked") and not st.get("exit_marked", False):
+        if st.get("entry_time") and (now_ts - st["entry_time"] >= EXIT_SECONDS_AFTER_ENTRY):
+            event = registrar_salida(label, db, state, path=path)
+            st["exit_marked"] = True
+            print(f"[EXIT] {label}: salida marcada")
+
+    # actualizar tiempos
+    st["last_seen"] = now_ts
+    return event
+
+# ---------------- Benchmark de extremo a extremo (reproducción) ----------------
+def benchmark_pipeline(source, db=None, excel_path=None, max_frames=None):
+    """
+    Pasa un video o directorio de imágenes por el mismo pipeline de recognition_loop
+    (FrameRecognizer + attendance_step) sin cámara, ventanas ni popups. La materia de
+    cada alumno sale de la BD en lugar del diálogo y la asistencia se escribe en una
+    copia temporal del Excel (o en `excel_path`), nunca en EXCEL_PATH.
+    Reporta latencia por etapa (p50/p90/p99), FPS de extremo a extremo y tiempo hasta
+    confirmar cada identidad (frames y segundos desde que su rostro aparece).
+    """
+    global SHOW_POPUPS
+    db = db if db is not None else load_database()
+    clf, scaler, pca = load_model()
+    if clf is None:
+        X, y, _ = build_sample_matrix_from_db(db)
+        if X.size and len(set(y)) >= 2:
+            clf, scaler, pca = fit_model(X, y)
+
+    tmp_dir = None
+    if excel_path is None:
+        tmp_dir = tempfile.mkdtemp(prefix="bench_asistencias_")
+        excel_path = os.path.join(tmp_dir, os.path.basename(EXCEL_PATH))
+        if os.path.exists(EXCEL_PATH):
+            shutil.copy2(EXCEL_PATH, excel_path)
+    ensure_excel_exists(excel_path)
+
+    profiler = StageProfiler(window=None, dump_seconds=0)
+    recognizer = FrameRecognizer(db, clf, scaler, pca, profiler=profiler)
+    state, events = {}, []
+    first_seen, confirmed_at = {}, {}   # key espacial -> (frame, t) | identidad -> (frames, segundos)
+    saved_timers, saved_popups = dict(timers), SHOW_POPUPS
+    timers.clear()
+    SHOW_POPUPS = False
+    n_frames = n_faces = 0
+    t_start = time.perf_counter()
+    try:
+        with mp_face_mesh.FaceMesh(static_image_mode=False, max_num_faces=5, refine_landmarks=True,
+                                   min_detection_confidence=0.5, min_tracking_confidence=0.5) as face_mesh:
+            for frame in iter_replay_frames(source):
+                if max_frames and n_frames >= max_frames:
+                    break
+                t_frame = time.perf_counter()
+                ns_frame = recognizer.clock()
+                faces, gray, poses = recognizer.detect(frame, face_mesh)
+                n_faces += len(faces)
+                for det in recognizer.recognize(frame, faces, gray, poses):
+                    key = get_center_key(*det["bbox"])
+                    first_seen.setdefault(key, (n_frames, t_frame))
+                    label = det["confirmed"]
+                    if not label:
+                        continue
+                    if label not in confirmed_at:
+                        f0, t0 = first_seen[key]
+                        confirmed_at[label] = (n_frames - f0 + 1, time.perf_counter() - t0)
+                    if label not in state:
+                        state[label] = new_session_state(db, label, db.get(label, {}).get("subject", "-"))
+                    t0 = recognizer.clock()
+                    event = attendance_step(label, db, state, time.time(), path=excel_path)
+                    recognizer.record("asistencia", t0)
+                    if event in ATTENDANCE_WRITTEN:
+                        events.append((n_frames, label, event))
+                recognizer.record("frame", ns_frame)
+                n_frames += 1
+    finally:
+        SHOW_POPUPS = saved_popups
+        timers.clear()
+        timers.update(saved_timers)
+        if tmp_dir:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    wall = time.perf_counter() - t_start
+
+    if not n_frames:
+        print(f"[BENCH] No se pudieron leer frames de '{source}'.")
+        return {}
+
+    frame = profiler.summary("frame")
+    report = {
+        "frames": n_frames,
+        "faces": n_faces,
+        "fps": 1000.0 / frame["mean"] if frame["mean"] > 0 else 0.0,
+        "fps_with_decode": n_frames / wall if wall > 0 else 0.0,
+        "frame": frame,
+        "stages": {st: profiler.summary(st) for st in FrameRecognizer.STAGES if st != "frame" and st in profiler.samples},
+        "time_to_confirm": {lbl: {"frames": f, "seconds": sec} for lbl, (f, sec) in confirmed_at.items()},
+        "events": events,
+    }
+
+    print(f"\n===== BENCHMARK PIPELINE ({n_frames} frames, {n_faces} rostros) =====")
+    print(f"{'etapa':<14}{'n':>7}{'p50':>9}{'p90':>9}{'p99':>9}  (ms)")
+    for st, r in list(report["stages"].items()) + [("frame", report["frame"])]:
+        print(f"{st:<14}{r['n']:>7}{r['p50']:>9.2f}{r['p90']:>9.2f}{r['p99']:>9.2f}")
+    print(f"FPS pipeline: {report['fps']:.1f} | con decodificación: {report['fps_with_decode']:.1f}")
+    if confirmed_at:
+        print("Tiempo hasta confirmar:")
+        for lbl, r in report["time_to_confirm"].items():
+            print(f"  {lbl}: {r['frames']} frames ({r['seconds']:.2f} s)")
+    else:
+        print("Ninguna identidad confirmada.")
+    destino = "copia temporal del Excel" if tmp_dir else excel_path
+    print(f"Registros de asistencia: {len(events)} ({destino})")
+    return report
+
+# ---------------- Modo sin ventana (headless) ----------------
+def load_schedule(path=SCHEDULE_PATH):
+    """Horario por grupo (ver SCHEDULE_PATH). {} si no existe o no se puede leer."""
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception as e:
+        print(f"[HORARIO] Error leyendo {path}: {e}")
+        return {}
+
+def scheduled_subject(group, schedule, when=None):
+    """Materia que el horario asigna a `group` en `when` (lunes = 0), o None."""
+    when = when or datetime.now()
+    hhmm = when.strftime("%H:%M")
+    for block in schedule.get(group, []):
+        if when.weekday() in block.get("dias", range(7)) and block["inicio"] <= hhmm < block["fin"]:
+            return block["materia"]
+    return None
+
+class EventStream:
+    """Eventos del reconocimiento como JSON por línea (archivo en modo append o stdout)."""
+    def __init__(self, path=EVENTS_PATH):
+        self.fh = sys.stdout if path == "-" else open(path, "a", encoding="utf-8")
+
+    def emit(self, evento, **data):
+        rec = {"ts": datetime.now().isoformat(timespec="milliseconds"), "evento": evento}
+        rec.update(data)
+        self.fh.write(json.dumps(rec, ensure_ascii=False) + "\n")
+        self.fh.flush()
+
+    def close(self):
+        if self.fh is not sys.stdout:
+            self.fh.close()
+
+def headless_loop(source=HEADLESS_SOURCE, events_path=EVENTS_PATH, max_frames=None):
+    """
+    Reconocimiento sin imshow, sin copias del frame para dibujar y sin diálogos Tk.
+    La materia sale del horario (SCHEDULE_PATH), de HEADLESS_SUBJECT o de la BD, en
+    ese orden. Las asistencias van al Excel como siempre y cada confirmación, registro
+    y salida de escena se emite en `events_path`. Termina al acabarse la fuente o con Ctrl+C.
+    """
+    global SHOW_POPUPS
+    db = load_database()
+    ensure_excel_exists(EXCEL_PATH)
+    if ARCHIVE_ON_START:
+        archive_attendance(EXCEL_PATH)
+    clf, scaler, pca = load_model()
+    schedule = load_schedule()
+    profiler = StageProfiler() if (PROFILE_ENABLED or METRICS_ENABLED) else None
+    recognizer = FrameRecognizer(db, clf, scaler, pca, profiler=profiler)
+    metrics = KioskMetrics(db, profiler)
+    metrics.queue_depth = attendance_writer(EXCEL_PATH).depth
+    metrics_server = start_metrics_server(metrics) if METRICS_ENABLED else None
+    events = EventStream(events_path)
+    events.emit("inicio", fuente=str(source), alumnos=len(db), modelo=clf is not None)
+
+    state = {}
+    n_frames = 0
+    saved_popups, SHOW_POPUPS = SHOW_POPUPS, False   # sin diálogos Tk; se restaura al salir
+    try:
+        with mp_face_mesh.FaceMesh(static_image_mode=False, max_num_faces=5, refine_landmarks=True,
+                                   min_detection_confidence=0.5, min_tracking_confidence=0.5) as face_mesh:
+            for frame in iter_replay_frames(source):
+                if max_frames and n_frames >= max_frames:
+                    break
+                ns_frame = recognizer.clock()
+                faces, gray, poses = recognizer.detect(frame, face_mesh)
+                metrics.frame(len(faces))
+                now_ts = time.time()
+
+                for det in recognizer.recognize(frame, faces, gray, poses):
+                    metrics.detection(det)
+                    label = det["confirmed"]
+                    if not label:
+                        continue
+                    info = db.get(label, {})
+                    if label not in state:
+                        subject = (scheduled_subject(info.get("group"), schedule)
+                                   or HEADLESS_SUBJECT or info.get("subject", "-"))
+                        state[label] = new_session_state(db, label, subject)
+                        events.emit("confirmado", alumno=label, registro=info.get("registro", "-"),
+                                    grupo=info.get("group"), materia=subject, score=det["confirmed_score"], frame=n_frames)
+                    t0 = recognizer.clock()
+                    res = attendance_step(label, db, state, now_ts)
+                    recognizer.record("asistencia", t0)
+                    if res:
+                        if res in ATTENDANCE_WRITTEN:
+                            metrics.attendance_writes += 1
+                        events.emit("asistencia", alumno=label, resultado=res, grupo=info.get("group"),
+                                    materia=state[label]["subject_session"], frame=n_frames)
+
+                # quien no se ve en RESET_STATE_SECONDS sale de la sesión (su próxima materia se vuelve a resolver)
+                for lbl, st in list(state.items()):
+                    if now_ts - st.get("last_seen", 0) > RESET_STATE_SECONDS:
+                        state.pop(lbl)
+                        events.emit("fuera_de_escena", alumno=lbl, frame=n_frames)
+
+                recognizer.record("frame", ns_frame)
+                if profiler is not None:
+                    profiler.maybe_dump()
+                n_frames += 1
+    except KeyboardInterrupt:
+        pass
+    finally:
+        SHOW_POPUPS = saved_popups
+        events.emit("fin", frames=n_frames, rostros=metrics.faces, asistencias=metrics.attendance_writes)
+        events.close()
+        if profiler is not None and PROFILE_DUMP_PATH:
+            profiler.dump()
+        if metrics_server is not None:
+            metrics_server.shutdown()
+    print(f"[HEADLESS] {n_frames} frames procesados, {metrics.attendance_writes} asistencias registradas.")
+
 # ---------------- Recognition loop (versión corregida) ----------------
 def recognition_loop():
     db = load_database()
     ensure_excel_exists(EXCEL_PATH)
     # cargar modelo (puede ser None si no hay)
     clf, scaler, pca = load_model()
+    recognizer = FrameRecognizer(db, clf, scaler, pca, profiler=StageProfiler() if PROFILE_ENABLED else None)
+    show_profile = PROFILE_OVERLAY
 
     cap = cv2.VideoCapture(0)
     if not cap.isOpened():
         print("[ERROR] No se pudo abrir la cámara.")
         return
 
+    # métricas del kiosco (el endpoint necesita las latencias por etapa)
+    if METRICS_ENABLED and recognizer.profiler is None:
+        recognizer.profiler = StageProfiler()
+    metrics = KioskMetrics(db, recognizer.profiler)
+    metrics.queue_depth = attendance_writer(EXCEL_PATH).depth
+    metrics_server = start_metrics_server(metrics) if METRICS_ENABLED else None
+    retrainer = ModelRetrainer()   # fit + validación cruzada fuera del loop de la cámara
+
     # estructuras auxiliares
-    vote_buffers = {}   # key -> deque de últimas predicciones [(name, score), ...]
     last_seen_global = {}  # label -> last seen ts (por seguridad reset)
     try:
         # Mediapipe Face Mesh para detección y landmarks
@@ -1320,7 +4147,7 @@ def recognition_loop():
             state = {}
             subject_dialogs = {}
             pending_registration = {"active": False, "name": None, "registro": None, "group": None, "subject": None}
-            last_raw_vec = None
+            registration = None   # RegistrationSession activa (o None)
 
             def registration_callback(name, registro, group, subject):
                 pending_registration["active"] = True
@@ -1342,7 +4169,7 @@ def recognition_loop():
                     print(f"[Dialog] {person_name}: registro = {s['registro_session']}, materia = {s['subject_session']}, grupo = {s['group_session']}")
                 return cb
 
-            print("Comandos: 'n' registrar nuevo, 'q' o ESC salir.")
+            print("Comandos: 'n' registrar nuevo, 'p' tiempos por etapa, 'q' o ESC salir.")
 
             while True:
                 ret, frame = cap.read()
@@ -1350,21 +4177,16 @@ def recognition_loop():
                     print("[WARN] Frame no leído, saliendo.")
                     break
 
-                # preprocesado (CLAHE) para baja luz
-                frame_proc = apply_clahe(frame)
-
-                rgb = cv2.cvtColor(frame_proc, cv2.COLOR_BGR2RGB)
-
-                try:
-                    results = face_mesh.process(rgb)
-                except Exception as e:
-                    print("[FaceMesh] Error en process():", e)
-                    results = None
+                ns_frame = recognizer.clock()
+                # preproceso + FaceMesh + pose
+                faces, gray, poses = recognizer.detect(frame, face_mesh)
+                metrics.frame(len(faces))
 
-                display = frame.copy()
+                # se dibuja directo sobre el frame: gray y landmarks ya se calcularon
+                display = frame
 
-                # Si hay registro pendiente, iniciar captura (mejor: multisamples si activado)
-                if pending_registration["active"]:
+                # Registro pendiente -> sesión no bloqueante que avanza un paso por frame
+                if pending_registration["active"] and registration is None:
                     reg = pending_registration.copy()
                     pending_registration["active"] = False
                     name_reg = reg["name"] or "SinNombre"
@@ -1372,120 +4194,54 @@ def recognition_loop():
                     grp_reg = reg["group"] or GROUP_OPTIONS[0]
                     subj_reg = reg["subject"] or "-"
                     print(f"[Registro] Iniciando captura para {name_reg} con el registro = {registro} (grupo {grp_reg}, materia {subj_reg})")
-                    samples = None
-                    if MORE_SAMPLES_ON_REGISTER:
-                        samples = capture_more_samples(name_reg, cap, face_mesh, target_n=MORE_SAMPLES_COUNT)
-                        samples = capture_three_angles_new_person(name_reg, cap, face_mesh)
-                    # si no hubo multisamples, caer en la captura por 3 ángulos ya implementada
-                    if samples is None:
-                        samples = capture_three_angles_new_person(name_reg, cap, face_mesh)
-                    if samples is None:
-                        print("[Registro] Captura cancelada o fallida.")
-                    else:
-                        db[name_reg] = {"registro": registro, "group": grp_reg, "subject": subj_reg, "samples": samples}
-                        save_database(db)
-                        print(f"[Registro] Guardado {name_reg} en base local.")
-                        # reentrenar modelo si hay >=2 clases
-                        if len(db) >= 2:
-                            print("[MODEL] Re-entrenando modelo...")
-                            # entrenar con PCA fija si quieres (opcional)
-                            clf_new, scaler_new, pca_new = train_and_save_model(db)
-                            if clf_new is None:
-                                print("[MODEL] Reentrenado fallido: insuficientes datos.")
-                            else:
-                                try:
-                                    acc, nsamp, per_class = evaluate_model_on_db(clf_new, scaler_new, pca_new, db)
-                                except:
-                                    acc, nsamp, per_class = 0.0, 0, {}
-                                print(f"[EVAL] accuracy={acc:.3f} | muestras={nsamp} | clases={len(per_class)}")
-                                ACCEPT_ACC = 0.70
-                                if acc >= ACCEPT_ACC:
-                                    clf, scaler, pca = clf_new, scaler_new, pca_new
-                                    print("[MODEL] Nuevo modelo aceptado y cargado.")
-                                else:
-                                    ts = int(time.time())
-                                    try:
-                                        backup_path = SVM_PATH.replace(".pkl", f"_weak_{ts}.pkl")
-                                        joblib.dump((clf_new, scaler_new, pca_new), backup_path)
-                                        print(f"[MODEL] Modelo débil guardado en {backup_path} (no se cargó).")
-                                    except Exception:
-                                        pass
-                                    # no tocar global DIST_FALLBACK_THRESHOLD de forma peligrosa aquí
-
-                # detección y reconocimiento
-                if results and getattr(results, 'multi_face_landmarks', None):
-
-                    for fl in results.multi_face_landmarks:
-
-                        # calcular bounding box de los landmarks
-                        xs = [lm.x for lm in fl.landmark]
-                        ys = [lm.y for lm in fl.landmark]
-                        h, w = frame.shape[:2]
-
-                        x1 = max(int(min(xs) * w) - 10, 0)
-                        y1 = max(int(min(ys) * h) - 10, 0)
-                        x2 = min(int(max(xs) * w) + 10, w - 1)
-                        y2 = min(int(max(ys) * h) + 10, h - 1)
-
-
-                        # ----------------------------------------
-#                        EXTRAER Y PREPARAR EL VECTOR DEL ROSTRO
-                        # ----------------------------------------
-                        raw_vec = extract_selected_landmarks(fl)
-
-                        # EMA smoothing
-                        if last_raw_vec is None:
-                            smooth_raw = raw_vec
+                    registration = RegistrationSession(name_reg, registro, grp_reg, subj_reg)
+
+                reg_face_idx = None
+                if registration is not None:
+                    reg_face_idx = registration.step(faces, frame.shape, gray, poses)
+                    registration.draw(display, faces)
+                    if registration.finished:
+                        samples = registration.samples()
+                        name_reg, registro = registration.name, registration.registro
+                        grp_reg, subj_reg = registration.group, registration.subject
+                        raw_samples, raw_aspect = getattr(registration, "raw_samples", None), registration.aspect
+                        registration = None
+                        if samples is None:
+                            print("[Registro] Captura cancelada o fallida.")
                         else:
-                            smooth_raw = SMOOTH_ALPHA * raw_vec + (1.0 - SMOOTH_ALPHA) * last_raw_vec
-                        last_raw_vec = smooth_raw.copy()
-
-                        vec_norm = normalize_vector(smooth_raw)
-                        if vec_norm is None:
+                            db[name_reg] = {"registro": registro, "group": grp_reg, "subject": subj_reg, "samples": samples,
+                                            "raw": raw_samples, "raw_aspect": raw_aspect, "embedding_mode": EMBEDDING_MODE}
+                            save_database(db)
+                            recognizer.fb_index.build(db)
+                            print(f"[Registro] Guardado {name_reg} en base local.")
+                            # reentrenar modelo si hay >=2 clases (en segundo plano; se acepta en poll)
+                            if len(db) >= 2:
+                                print("[MODEL] Re-entrenando modelo en segundo plano...")
+                                retrainer.submit(db)
+
+                # modelo reentrenado listo: se acepta solo por validación cruzada (muestras no vistas)
+                retrained = retrainer.poll()
+                if retrained is not None:
+                    metrics.retrains += 1
+                    metrics.retrain_seconds = retrained[4]
+                    apply_retrained_model(retrained, recognizer)
+
+                # detección y reconocimiento (el rostro en registro no se clasifica)
+                detections = recognizer.recognize(frame, faces, gray, poses, skip_idx=reg_face_idx)
+                labels = []   # etiquetas del frame, se dibujan juntas al final
+                if detections:
+
+                    for det in detections:
+
+                        t0 = recognizer.clock()
+                        metrics.detection(det)
+                        x1, y1, x2, y2 = det["bbox"]
+                        if not det["ok"]:
+                            cv2.rectangle(display, (x1, y1), (x2, y2), (128, 128, 128), 2)
                             continue
-                        vec_norm = fix_length(vec_norm, max(len(vec_norm), 1))
-
-                        # ----------------------------------------
-                        # RECONOCIMIENTO DEL ROSTRO (SVM + fallback)
-                        # ----------------------------------------
-                        name_pred = None
-                        score_pred = None
-
-                        # INTENTO SVM
-                        if clf is not None and scaler is not None and pca is not None:
-                            try:
-                                if vec_norm.size == scaler.mean_.shape[0]:
-                                    Xs = scaler.transform([vec_norm])
-                                    Xp = pca.transform(Xs)
-                                    probs = clf.predict_proba(Xp)[0]
-                                    idx = int(np.argmax(probs))
-                                    score_pred = float(probs[idx])
-                                    if score_pred >= SVM_PROB_THRESHOLD:
-                                        name_pred = str(clf.classes_[idx])
-                            except Exception as e:
-                                print("[MODEL] Error predict:", e)
-                                name_pred = None
-
-                        # FALLBACK SI SVM NO CONFIRMA
-                        d_fallback = None   # importante!
-
-                        if name_pred is None:
-                            fmatch, d_tmp = fallback_match(vec_norm, db, threshold=DIST_FALLBACK_THRESHOLD)
-                            if fmatch:
-                                name_pred = fmatch
-                                d_fallback = d_tmp
-                                score_pred = max(score_pred or 0.0, 1.0 - d_tmp)
-
-                        # VALOR FINAL USADO EN LA ETIQUETA
-                        if name_pred is not None:
-                            if d_fallback is not None:
-                                dist = d_fallback
-                            else:
-                                dist = 1.0 - (score_pred if score_pred is not None else 0.0)
-                        else:
-                            dist = 1.0
 
-                        name = name_pred if name_pred is not None else "Desconocido"
+                        name_pred, score_pred, d_fallback = det["name_pred"], det["score_pred"], det["d_fallback"]
+                        name = det["label"]
 
                         # COLOR FINAL SEGÚN EL ORIGEN DEL RECONOCIMIENTO
                         if name_pred is not None:
@@ -1497,7 +4253,7 @@ def recognition_loop():
                                     box_color = (0, 0, 255)   # rojo
                             else:
                                 # Si vino de fallback
-                                if d_fallback <= DIST_FALLBACK_THRESHOLD:
+                                if d_fallback <= fallback_threshold():
                                     box_color = (0, 255, 0)   # verde
                                 else:
                                     box_color = (0, 0, 255)   # rojo
@@ -1536,6 +4292,8 @@ def recognition_loop():
                                         subject=db[name]["subject"],
                                         tipo=tipo_auto
                                     )
+                                    if res in ATTENDANCE_WRITTEN:
+                                        metrics.attendance_writes += 1
 
                                     timer["done"] = True
                                     timers[name] = timer
@@ -1555,7 +4313,7 @@ def recognition_loop():
 
                             # Mostrar texto
                             h, w = display.shape[:2]
-                            (tw, th), baseline = cv2.getTextSize(txt, cv2.FONT_HERSHEY_SIMPLEX, 1, 2)
+                            (tw, th), baseline = cached_text_size(txt, 1, 2)
                             x = (w - tw) // 2
                             y = th + 20
 
@@ -1568,36 +4326,18 @@ def recognition_loop():
 
                         # fin_timer display
 
-                        # preparar etiqueta temporal
-                        label_shown = name_pred if name_pred is not None else "Desconocido"
+                        # etiqueta confirmada por votación (si no, se trata como desconocido)
+                        label_shown = det["label"]
                         registro = db.get(label_shown, {}).get("registro", "-") if label_shown != "Desconocido" else "-"
-
-                        # voting key (coarse spatial key to follow same face)
-                        key = get_center_key(x1, y1, x2, y2)
-                        if key not in vote_buffers:
-                            from collections import deque
-                            vote_buffers[key] = deque(maxlen=CONFIRM_FRAMES + 2)
-                        vote_buffers[key].append((label_shown, score_pred))
-
-                        # confirmar identidad desde buffer
-                        confirmed_name, confirmed_score = confirm_identity(list(vote_buffers[key]))
-                        # si no confirmada, tratar como desconocido al dibujar/registrar
-                        final_label = confirmed_name if confirmed_name else "Desconocido"
-                        # usar score de confirmed si disponible
-                        draw_detection_label(display, (x1, y1, x2, y2), final_label, registro if final_label!="Desconocido" else "-", score=confirmed_score)
+                        final_label = det["confirmed"] if det["confirmed"] else "Desconocido"
+                        labels.append(detection_label(final_label, registro if final_label!="Desconocido" else "-", det["confirmed_score"]))
+                        recognizer.record("dibujo", t0)
 
                         # si confirmado -> control de asistencia
                         if final_label != "Desconocido":
                             now_ts = time.time()
                             # crear estado si no existe
-                            st = state.setdefault(final_label, {
-                                "entry_marked": False,
-                                "exit_marked": False,
-                                "entry_time": None,
-                                "last_seen": 0,
-                                "subject_session": None,
-                                "registro_session": db.get(final_label, {}).get("registro", "-")
-                            })
+                            st = state.setdefault(final_label, new_session_state(db, final_label))
 
                             # abrir dialogo materia si falta
                             if not st.get("subject_session") and final_label not in subject_dialogs:
@@ -1610,31 +4350,17 @@ def recognition_loop():
                                 state[final_label] = st
                                 continue
 
-                            # debounce: evitar múltiples registros por frames muy seguidos
-                            if now_ts - st.get("last_seen", 0) < 1.2:
-                                st["last_seen"] = now_ts
-                                state[final_label] = st
-                                continue
-
-                            # registrar entrada (si no hay)
-                            if not st.get("entry_marked", False):
-                                registrar_entrada(final_label, db, state)
-                                st["entry_marked"] = True
-                                st["entry_time"] = now_ts
-                                print(f"[ENTRY] {final_label}: entrada marcada")
-
-                            # si ya había entrada y no salida -> intentar marcar salida si pasó tiempo
-                            elif st.get("entry_marked") and not st.get("exit_marked", False):
-                                if st.get("entry_time") and (now_ts - st["entry_time"] >= EXIT_SECONDS_AFTER_ENTRY):
-                                    registrar_salida(final_label, db, state)
-                                    st["exit_marked"] = True
-                                    print(f"[EXIT] {final_label}: salida marcada")
-
-                            # actualizar tiempos
-                            st["last_seen"] = now_ts
-                            state[final_label] = st
+                            t0 = recognizer.clock()
+                            if attendance_step(final_label, db, state, now_ts) in ATTENDANCE_WRITTEN:
+                                metrics.attendance_writes += 1
+                            recognizer.record("asistencia", t0)
                             last_seen_global[final_label] = now_ts
 
+                if labels:
+                    t0 = recognizer.clock()
+                    draw_detection_labels(display, labels)
+                    recognizer.record("dibujo", t0)
+
                 # limpiar subject_dialogs si ya seleccionaron materia
                 for name_in_state in list(subject_dialogs.keys()):
                     if state.get(name_in_state, {}).get("subject_session"):
@@ -1645,19 +4371,30 @@ def recognition_loop():
                 for lbl, st in list(state.items()):
                     if now_all - st.get("last_seen", 0) > RESET_STATE_SECONDS:
                         # reset medio: mantener registro_session pero permitir nueva entrada mañana
-                        state[lbl] = {
-                            "entry_marked": False,
-                            "exit_marked": False,
-                            "entry_time": None,
-                            "last_seen": 0,
-                            "subject_session": None,
-                            "registro_session": db.get(lbl, {}).get("registro", "-")
-                        }
+                        state[lbl] = new_session_state(db, lbl)
+
+                profiler = recognizer.profiler
+                if profiler is not None:
+                    if show_profile:
+                        profiler.draw(display)
+                    profiler.maybe_dump()
 
+                t0 = recognizer.clock()
                 cv2.imshow("Asistencia - Webcam (presiona tecla 'n' para registrar)", display)
                 k = cv2.waitKey(1) & 0xFF
+                recognizer.record("pantalla", t0)
+                recognizer.record("frame", ns_frame)
+                # durante un registro, 'c' y ESC pertenecen a la sesión
+                if registration is not None and k in (27, ord('c')):
+                    registration.handle_key(k)
+                    continue
                 if k == 27 or k == ord('q'):
                     break
+                if k == ord('p'):
+                    # activa la instrumentación en caliente y alterna el overlay
+                    if recognizer.profiler is None:
+                        recognizer.profiler = metrics.profiler = StageProfiler()
+                    show_profile = not show_profile
                 if k == ord('n'):
                     print("[UI] Abriendo dialogo para registrar nuevo alumno (no bloqueante).")
                     NonBlockingDialog(title="Registrar Nuevo Alumno", ask_name=True, default_group=None, callback=registration_callback)
@@ -1665,6 +4402,15 @@ def recognition_loop():
     except Exception as e:
         print("[ERROR] Error en reconocimiento principal:", e)
     finally:
+        if retrainer.busy:
+            print("[MODEL] Esperando el reentrenamiento en curso...")
+        retrained = retrainer.wait()
+        if retrained is not None:
+            apply_retrained_model(retrained)
+        if recognizer.profiler is not None and PROFILE_DUMP_PATH:
+            recognizer.profiler.dump()
+        if metrics_server is not None:
+            metrics_server.shutdown()
         try:
             cap.release()
         except:
@@ -1691,15 +4437,122 @@ def mostrar_tabla():
 
 
 # --- Funciones de las tablas ---
+class AttendanceViewer:
+    """
+    Visor paginado de asistencias sobre AttendanceQuery. Los filtros (grupo, materia,
+    alumno por texto, rango de fechas) se resuelven con los índices del almacén y el
+    orden con los códigos de los categóricos o las horas ya parseadas, todo sobre
+    posiciones de fila; solo se da formato a la página visible. Abre acotado al mes en
+    curso (filtro "desde"): las particiones anteriores del archivo solo se leen si el
+    usuario amplía el rango.
+    """
+    SORTABLE = {"fecha": "Fecha", "alumno": "Alumno", "materia": "Materia", "entrada": "Entrada", "salida": "Salida"}
+
+    def __init__(self, store, grupo=None, desde=None, page_size=VIEWER_PAGE_SIZE):
+        self.store = store
+        self.page_size = page_size
+        desde = desde or datetime.now().strftime("%Y-%m-01")
+        self.filters = {"grupo": grupo, "materia": None, "alumno": None, "desde": desde, "hasta": None}
+        self.sort_key, self.ascending = "fecha", False   # lo más reciente primero
+        self.page = 0
+        self.pos = None
+        self.builds = None   # store.builds con el que se calcularon las posiciones
+
+    def refresh(self):
+        """Recalcula las posiciones filtradas y ordenadas (sin tocar las filas)."""
+        f = self.filters
+        store = self.store
+        pos = store.positions(grupo=f["grupo"], materia=f["materia"], desde=f["desde"], hasta=f["hasta"])
+        self.builds = store.builds
+        if f["alumno"] and len(pos):
+            texto = store.normalize("alumno", f["alumno"])
+            sel = [p for nombre, p in store.index.get("alumno", {}).items() if texto in nombre]
+            pos = np.intersect1d(pos, np.concatenate(sel), assume_unique=True) if sel else pos[:0]
+        self.pos = pos[self.order(pos)]
+        self.page = min(self.page, max(0, self.pages() - 1))
+
+    def order(self, pos):
+        key = self.sort_key
+        if key in ("entrada", "salida"):
+            vals = self.store.parsed()[f"{key}_s"].to_numpy()[pos]
+        elif key in self.store.keys.columns:
+            vals = self.store.keys[key].cat.codes.to_numpy()[pos].astype(float)   # categorías en orden léxico
+        else:
+            return np.arange(len(pos))
+        if not self.ascending:
+            vals = -vals
+        return np.argsort(np.where(np.isnan(vals), np.inf, vals), kind="stable")   # sin hora al final
+
+    def pages(self):
+        return max(1, -(-len(self.pos) // self.page_size))
+
+    def render(self):
+        # otro kiosco/proceso pudo escribir el Excel: frame() lo recarga y las filas se corren
+        frame = self.store.frame()
+        if self.store.builds != self.builds:
+            self.refresh()
+            frame = self.store.frame()
+        inicio = self.page * self.page_size
+        visibles = self.pos[inicio:inicio + self.page_size]
+        activos = ", ".join(f"{k}={v}" for k, v in self.filters.items() if v) or "ninguno"
+        orden = f"{self.SORTABLE[self.sort_key]} {'asc' if self.ascending else 'desc'}"
+        print(f"\n===== ASISTENCIAS: página {self.page + 1}/{self.pages()} · {len(self.pos)} registros =====")
+        print(f"Filtros: {activos} | Orden: {orden}")
+        if len(visibles) == 0:
+            print("[TABLA] No hay registros para la selección realizada.")
+        else:
+            print(frame.iloc[visibles].to_string(index=False))
+
+    def ask_filters(self):
+        print("Deje vacío para quitar el filtro, '.' para conservarlo.")
+        print("Ampliar 'Desde' (o dejarlo vacío) lee los meses anteriores del archivo.")
+        for key, prompt in (("materia", "Materia"), ("alumno", "Alumno (texto)"),
+                            ("desde", "Desde (YYYY-MM-DD)"), ("hasta", "Hasta (YYYY-MM-DD)")):
+            valor = input(f"{prompt} [{self.filters[key] or ''}]: ").strip()
+            if valor == ".":
+                continue
+            if valor and key in ("desde", "hasta"):
+                try:
+                    datetime.strptime(valor, "%Y-%m-%d")
+                except ValueError:
+                    print(f"[ERROR] Fecha inválida '{valor}', se conserva el filtro anterior.")
+                    continue
+            self.filters[key] = valor or None
+        self.page = 0
+
+    def run(self):
+        self.refresh()
+        while True:
+            self.render()
+            cmd = input("[n]ext [p]rev [g N] ir [f]iltros [o col asc|desc] ordenar [q]salir: ").strip().lower().split()
+            if not cmd or cmd[0] == "n":
+                self.page = min(self.page + 1, self.pages() - 1)
+            elif cmd[0] == "p":
+                self.page = max(self.page - 1, 0)
+            elif cmd[0] == "g" and len(cmd) > 1 and cmd[1].isdigit():
+                self.page = min(max(int(cmd[1]) - 1, 0), self.pages() - 1)
+            elif cmd[0] == "f":
+                self.ask_filters()
+                self.refresh()
+            elif cmd[0] == "o" and len(cmd) > 1 and cmd[1] in self.SORTABLE:
+                self.sort_key = cmd[1]
+                self.ascending = not (len(cmd) > 2 and cmd[2] == "desc")
+                self.refresh()
+            elif cmd[0] == "q":
+                break
+            else:
+                print(f"Comando inválido. Columnas para ordenar: {', '.join(self.SORTABLE)}")
+# fin-AttendanceViewer
+
 def mostrar_tabla_excel(ruta_excel="asistencias.xlsx"):
     try:
-        dfs = pd.read_excel(ruta_excel, sheet_name=None)  # Cargar TODAS las hojas
-        df = pd.concat(dfs.values(), ignore_index=True)   # Unificar
+        store = attendance_query(ruta_excel)   # día en curso + archivo, en caché
+        df = store.frame()
     except Exception as e:
         print(f"[ERROR] No se pudo leer el archivo Excel: {e}")
         return
 
-    if df.empty:
+    if df.empty and not store.available:
         print("[TABLA] No hay registros de asistencias.")
         return
 
@@ -1710,41 +4563,24 @@ def mostrar_tabla_excel(ruta_excel="asistencias.xlsx"):
     
     opcion = input("Seleccione una opción: ").strip()
 
-    # Normalizamos columna
     if "Grupo" not in df.columns:
         print("[ERROR] La tabla no contiene la columna 'Grupo'.")
         return
-    
-    df["Grupo"] = df["Grupo"].astype(str).str.upper()
 
     # ------------------------------
-    # Filtrar según opción elegida
+    # Grupo inicial del visor (los demás filtros se cambian dentro)
     # ------------------------------
     if opcion == "1":
-        df_filtrado = df[df["Grupo"] == "7O"]
-        titulo = "REGISTROS GRUPO 7O"
-
+        grupo = "7O"
     elif opcion == "2":
-        df_filtrado = df[df["Grupo"] == "7P"]
-        titulo = "REGISTROS GRUPO 7P"
-
+        grupo = "7P"
     elif opcion == "3":
-        df_filtrado = df
-        titulo = "REGISTROS DE TODOS LOS GRUPOS"
-
+        grupo = None
     else:
         print("Opción inválida.")
         return
 
-    # ------------------------------
-    # Mostrar resultados
-    # ------------------------------
-    if df_filtrado.empty:
-        print("[TABLA] No hay registros para la selección realizada.")
-        return
-
-    print(f"\n===== {titulo} =====")
-    print(df_filtrado.to_string(index=False))
+    AttendanceViewer(store, grupo=grupo).run()
     print("\n")
 # fin-mostrar_tabla_excel
 
@@ -1780,7 +4616,13 @@ def admin_menu():
         print("2) Actualizar usuario")
         print("3) Eliminar usuario")
         print("4) Listar todos los usuarios")
-        print("5) Salir")
+        print("5) Evaluar modelo (validación cruzada)")
+        print("6) Ajustar hiperparámetros (búsqueda en paralelo)")
+        print("7) Optimizar subconjunto de puntos de referencia")
+        print("8) Migrar embeddings (2D / 3D)")
+        print("9) Benchmark de embeddings 2D vs 3D (video)")
+        print("10) Benchmark del pipeline completo (video)")
+        print("11) Salir")
 
         opcion = input("Seleccione una opción: ").strip()
 
@@ -1793,6 +4635,20 @@ def admin_menu():
         elif opcion == "4":
             admin_mostrar_usuarios()
         elif opcion == "5":
+            print_evaluation_report(cross_validate_model(load_database()))
+        elif opcion == "6":
+            tune_hyperparameters_menu()
+        elif opcion == "7":
+            optimize_landmarks_menu()
+        elif opcion == "8":
+            migrate_embeddings_menu()
+        elif opcion == "9":
+            source = input("Ruta del video o directorio de imágenes: ").strip()
+            benchmark_embedding_modes(source)
+        elif opcion == "10":
+            source = input("Ruta del video o directorio de imágenes: ").strip()
+            benchmark_pipeline(source)
+        elif opcion == "11":
             break
         else:
             print("Opción inválida.")
@@ -1906,6 +4762,8 @@ def main():
     print(df.columns)  
     # Garantizar que el archivo Excel existe antes de comenzar
     ensure_excel_exists(EXCEL_PATH)
+    if ARCHIVE_ON_START:
+        archive_attendance(EXCEL_PATH)
 
     while True:
         print("\n===== SISTEMA DE ASISTENCIAS =====")
@@ -1915,7 +4773,10 @@ def main():
         print("4) Exportar PDF por grupo/materia")
         print("5) Exportar PDF por grupo/materia/fecha")
         print("6) Panel de administración")
-        print("7) Salir")
+        print("7) Exportar todos los PDF grupo/materia/fecha (lote)")
+        print("8) Resumen de asistencia (PDF + CSV)")
+        print("9) Exportar historial completo a Excel")
+        print("10) Salir")
 
         opcion = input("Seleccione una opción: ")
 
@@ -1955,11 +4816,43 @@ def main():
         elif opcion == "6": # Panel de administración
             admin_menu()
 
-        elif opcion == "7":
+        elif opcion == "7": # Exportación por lote
+            try:
+                exportar_pdfs_lote()
+            except Exception as e:
+                print(f"[ERROR] No se pudo completar la exportación: {e}")
+
+        elif opcion == "8": # Resumen por alumno
+            grupo = input("Ingrese el grupo (7O / 7P): ").strip()
+            materia = input("Ingrese la materia (ML / PDI) o deje vacío para todas: ").strip()
+            desde = input("Desde (YYYY-MM-DD) o vacío: ").strip()
+            hasta = input("Hasta (YYYY-MM-DD) o vacío: ").strip()
+            try:
+                exportar_resumen(grupo, materia, desde, hasta)
+            except Exception as e:
+                print(f"[ERROR] No se pudo generar el resumen: {e}")
+
+        elif opcion == "9": # Historial completo (archivo + día en curso)
+            destino = input("Archivo destino (ENTER = asistencias_historial.xlsx): ").strip()
+            try:
+                exportar_excel_historial(destino or "asistencias_historial.xlsx")
+            except Exception as e:
+                print(f"[ERROR] No se pudo exportar el historial: {e}")
+
+        elif opcion == "10":
             print("Saliendo del sistema de asistencias.")
             break
         else:
             print("Opción inválida. Intente nuevamente.")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Sistema de asistencias con reconocimiento facial.")
+    parser.add_argument("--headless", action="store_true", help="reconocer sin ventana ni diálogos (servidor)")
+    parser.add_argument("--source", default=None, help="índice de cámara, video o directorio de imágenes (headless)")
+    parser.add_argument("--events", default=EVENTS_PATH, help="archivo JSONL de eventos, '-' = stdout (headless)")
+    args = parser.parse_args()
+    if args.headless:
+        source = HEADLESS_SOURCE if args.source is None else (int(args.source) if args.source.isdigit() else args.source)
+        headless_loop(source, args.events)
+    else:
+        main()
\ No newline at end of file